@@ -52,6 +52,8 @@ private:
       }
       bool compression_enabled() { return compression & 0x1; }
       bool dummy_transfer() { return dummy & 0x1; }
+      bool resumable_transfer() { return dummy & 0x2; }
+      bool append_transfer() { return dummy & 0x4; }
       static char* filename() { return data; }
       private:
         uint8_t dummy, compression;
@@ -59,10 +61,10 @@ private:
     };
   };
 
-  static bool file_open(char *filename) {
+  static bool file_open(char *filename, const bool append=false) {
     if (!dummy_transfer) {
       card.mount();
-      card.openFileWrite(filename);
+      card.openFileWrite(filename, append);
       if (!card.isFileOpen()) return false;
     }
     transfer_active = true;
@@ -115,6 +117,51 @@ private:
     return true;
   }
 
+  // Size and Adler-32 of a file on the media, so a host can skip sending a file that is already there
+  static bool file_checksum(const char * const filename, uint32_t &size, uint32_t &checksum) {
+    card.mount();
+    if (!card.isMounted()) return false;
+
+    MediaFile *dir, file;
+    const char * const fname = card.diveToFile(false, dir, filename);
+    const bool opened = fname && file.open(dir, fname, O_READ);
+    int16_t count = -1;
+    if (opened) {
+      size = file.fileSize();
+      uint8_t buffer[64];
+      uint32_t a = 1, b = 0;
+      uint16_t pending = 0;     // bytes summed since the last reduction
+      while ((count = file.read(buffer, sizeof(buffer))) > 0) {
+        for (int16_t i = 0; i < count; ++i) { a += buffer[i]; b += a; }
+        // Reducing every 5552 bytes at most keeps the sums within 32 bits
+        pending += count;
+        if (pending >= 5552 - sizeof(buffer)) { a %= 65521; b %= 65521; pending = 0; hal.watchdog_refresh(); }
+      }
+      checksum = ((b % 65521) << 16) | (a % 65521);
+      file.close();
+    }
+    card.release();
+    return opened && count == 0;
+  }
+
+  // Rename a file, replacing any file with the new name in the same folder.
+  // A host can upload to a name a bootloader ignores and only give it the final name once it's complete.
+  static bool file_rename(const char * const filename, const char * const newname) {
+    card.mount();
+    if (!card.isMounted()) return false;
+
+    MediaFile *dir, file;
+    const char * const fname = card.diveToFile(false, dir, filename);
+    bool renamed = false;
+    if (fname && file.open(dir, fname, O_WRITE)) {
+      MediaFile::remove(dir, newname);
+      renamed = file.rename(dir, newname);
+      file.close();
+    }
+    card.release();
+    return renamed;
+  }
+
   static void transfer_abort() {
     if (!dummy_transfer) {
       card.closefile();
@@ -126,19 +173,22 @@ private:
     return;
   }
 
-  enum class FileTransfer : uint8_t { QUERY, OPEN, CLOSE, WRITE, ABORT };
+  enum class FileTransfer : uint8_t { QUERY, OPEN, CLOSE, WRITE, ABORT, CHECKSUM, RENAME };
 
   static size_t data_waiting, transfer_timeout, idle_timeout;
-  static bool transfer_active, dummy_transfer, compression;
+  static bool transfer_active, dummy_transfer, compression, resumable;
 
 public:
 
   static void idle() {
-    // If a transfer is interrupted and a file is left open, abort it after TIMEOUT ms
+    // If a transfer is interrupted and a file is left open, abort it after TIMEOUT ms.
+    // A resumable transfer keeps what was written so far, so the host can append the rest.
     const millis_t ms = millis();
     if (transfer_active && ELAPSED(ms, idle_timeout)) {
       idle_timeout = ms + IDLE_PERIOD;
-      if (ELAPSED(ms, transfer_timeout)) transfer_abort();
+      if (ELAPSED(ms, transfer_timeout)) {
+        if (resumable) file_close(); else transfer_abort();
+      }
     }
   }
 
@@ -161,8 +211,13 @@ public:
             auto packet = Packet::Open::decode(buffer);
             compression = packet.compression_enabled();
             dummy_transfer = packet.dummy_transfer();
-            if (file_open(packet.filename())) {
-              SERIAL_ECHOLNPGM("PFT:success");
+            resumable = packet.resumable_transfer() && !dummy_transfer;
+            if (file_open(packet.filename(), resumable && packet.append_transfer())) {
+              // A resumable transfer reports the bytes already on the media, the host continues from there
+              if (resumable)
+                SERIAL_ECHOLN(F("PFT:success:"), card.getFileSize());
+              else
+                SERIAL_ECHOLNPGM("PFT:success");
               break;
             }
           }
@@ -188,13 +243,34 @@ public:
         transfer_abort();
         SERIAL_ECHOLNPGM("PFT:success");
         break;
+      case FileTransfer::CHECKSUM:
+        if (transfer_active)
+          SERIAL_ECHOLNPGM("PFT:busy");
+        else {
+          uint32_t size, checksum;
+          if (length && buffer[length - 1] == '\0' && file_checksum(buffer, size, checksum))
+            SERIAL_ECHOLN(F("PFT:checksum:"), size, C(':'), checksum);
+          else
+            SERIAL_ECHOLNPGM("PFT:fail");
+        }
+        break;
+      case FileTransfer::RENAME: {
+        // Payload: filename, null, new filename, null
+        const size_t namelen = strnlen(buffer, length);
+        if (transfer_active)
+          SERIAL_ECHOLNPGM("PFT:busy");
+        else if (namelen + 1 < length && buffer[length - 1] == '\0' && file_rename(buffer, &buffer[namelen + 1]))
+          SERIAL_ECHOLNPGM("PFT:success");
+        else
+          SERIAL_ECHOLNPGM("PFT:fail");
+      } break;
       default:
         SERIAL_ECHOLNPGM("PTF:invalid");
         break;
     }
   }
 
-  static const uint16_t VERSION_MAJOR = 0, VERSION_MINOR = 1, VERSION_PATCH = 0, TIMEOUT = 10000, IDLE_PERIOD = 1000;
+  static const uint16_t VERSION_MAJOR = 0, VERSION_MINOR = 4, VERSION_PATCH = 0, TIMEOUT = 10000, IDLE_PERIOD = 1000;
 };
 
 class BinaryStream {
@@ -767,9 +767,9 @@ inline void echo_write_to_file(const char * const fname) {
 }
 
 //
-// Open a file by DOS path for write
+// Open a file by DOS path for write, optionally appending to an existing file
 //
-void CardReader::openFileWrite(const char * const path) {
+void CardReader::openFileWrite(const char * const path, const bool append/*=false*/) {
   if (!isMounted()) return;
 
   announceOpen(2, path);
@@ -782,8 +782,9 @@ void CardReader::openFileWrite(const char * const path) {
   if (!fname) return openFailed(path);
 
   #if DISABLED(SDCARD_READONLY)
-    if (file.open(diveDir, fname, O_CREAT | O_APPEND | O_WRITE | O_TRUNC)) {
+    if (file.open(diveDir, fname, O_CREAT | O_APPEND | O_WRITE | (append ? 0 : O_TRUNC))) {
       flag.saving = true;
+      filesize = append ? file.fileSize() : 0;
       selectFileByName(fname);
       TERN_(EMERGENCY_PARSER, emergency_parser.disable());
       echo_write_to_file(fname);
@@ -192,6 +192,9 @@ if pioutil.is_pio_build():
         # Build the actual equivalent build_src_filter list based on the inclusions by the features.
         # PlatformIO doesn't do it this way, but maybe in the future....
         cur_srcs = set()
+        # Patterns under Marlin/src are matched against an index of the tree
+        from source_index import load_source_index
+        srcindex = load_source_index(marlinbasedir, os.path.join(env['PROJECT_BUILD_DIR'], '.srcindex.json'))
         # Remove the references to the same folder
         my_srcs = re.findall(r'([+-]<.*?>)', build_filters)
         for d in my_srcs:
@@ -207,19 +210,27 @@ if pioutil.is_pio_build():
                             blab("Added src file %s " % relp, 3)
                         cur_srcs.add(relp)
 
+                def srepl(matchi):
+                    g0 = matchi.group(0)
+                    return r"**" + g0[1:]
+
                 # Special rule: If a direct folder is specified add all files within.
                 fullplain = os.path.join(marlinbasedir, plain)
-                if os.path.isdir(fullplain):
+                if srcindex.covers(plain):
+                    if srcindex.isdir(plain):
+                        blab("Directory content addition for %s " % plain, 3)
+                        found, info = srcindex.under(plain), "dca"
+                    else:
+                        found, info = srcindex.match(re.sub(r'[*]($|[^*])', srepl, plain)), None
+                    for relp in found:
+                        addentry(os.path.join(marlinbasedir, relp), info)
+                elif os.path.isdir(fullplain):
                     blab("Directory content addition for %s " % plain, 3)
                     gpattern = os.path.join(fullplain, "**")
                     for fname in glob.glob(gpattern, recursive=True):
                         addentry(fname, "dca")
                 else:
                     # Add all the things from the pattern by GLOB.
-                    def srepl(matchi):
-                        g0 = matchi.group(0)
-                        return r"**" + g0[1:]
-
                     gpattern = re.sub(r'[*]($|[^*])', srepl, plain)
                     gpattern = os.path.join(marlinbasedir, gpattern)
 
@@ -234,7 +245,7 @@ if pioutil.is_pio_build():
                         blab("Removed src file %s " % relp, 3)
 
                 fullplain = os.path.join(marlinbasedir, plain)
-                if os.path.isdir(fullplain):
+                if srcindex.isdir(plain) if srcindex.covers(plain) else os.path.isdir(fullplain):
                     blab("Directory content removal for %s " % plain, 2)
 
                     def filt(x):
@@ -253,7 +264,12 @@ if pioutil.is_pio_build():
 
                     cur_srcs = set(filter(filt, cur_srcs))
         # Transform the resulting set into a string.
-        for x in cur_srcs:
+        # Optionally list whole folders instead of all the files in them.
+        try:
+            compact = env.GetProjectOption('custom_compact_src_filter') in ('yes', 'true', '1')
+        except:
+            compact = False
+        for x in srcindex.collapse(cur_srcs) if compact else cur_srcs:
             if build_src_filter != "": build_src_filter += ' '
             build_src_filter += "+<" + x + ">"
 
@@ -280,25 +296,69 @@ if pioutil.is_pio_build():
             marlin_features[feature] = definition
         env['MARLIN_FEATURES'] = marlin_features
 
+    #
+    # Index of MARLIN_FEATURES by lowercase name, with the resolved state of
+    # the features looked up so far. Rebuilt if MARLIN_FEATURES is replaced.
+    # Keys that are patterns (e.g. 'HAS_(FSMC|SPI|LTDC)_TFT') are matched
+    # against all the features once, and their matches kept.
+    #
+    feature_index = {}
+    feature_matches = {}
+    feature_state = {}
+    indexed_features = None
+
+    def index_marlin_features():
+        global indexed_features
+        features = env['MARLIN_FEATURES']
+        if indexed_features is features:
+            return
+        feature_index.clear()
+        feature_matches.clear()
+        feature_state.clear()
+        for f in features:
+            feature_index.setdefault(f.lower(), []).append(f)
+        indexed_features = features
+
     #
     # Return True if a matching feature is enabled
     #
     def MarlinHas(env, feature):
         load_marlin_features()
-        r = re.compile('^' + feature + '$', re.IGNORECASE)
-        found = list(filter(r.match, env['MARLIN_FEATURES']))
+        index_marlin_features()
+        return marlin_feature_on(feature.lower(), set())
+
+    # The features named by a key, a plain name or a pattern
+    def matching_features(key):
+        if re.fullmatch(r'\w+', key):
+            return feature_index.get(key, [])
+        if key not in feature_matches:
+            r = re.compile('^' + key + '$', re.IGNORECASE)
+            feature_matches[key] = list(filter(r.match, indexed_features))
+        return feature_matches[key]
+
+    def marlin_feature_on(key, resolving):
+        if key in feature_state:
+            return feature_state[key]
+
+        # A feature defined (through others) as itself is not enabled
+        if key in resolving:
+            blab("Circular definition of %s" % key, 2)
+            return False
+        resolving.add(key)
 
         # Defines could still be 'false' or '0', so check
         some_on = False
-        if len(found):
-            for f in found:
-                val = env['MARLIN_FEATURES'][f]
-                if val in [ '', '1', 'true' ]:
-                    some_on = True
-                elif val in env['MARLIN_FEATURES']:
-                    some_on = env.MarlinHas(val)
-
-        #blab("%s is %s" % (feature, str(some_on)), 2)
+        for f in matching_features(key):
+            val = indexed_features[f]
+            if val in [ '', '1', 'true' ]:
+                some_on = True
+            elif val in indexed_features:
+                some_on = marlin_feature_on(val.lower(), resolving)
+
+        resolving.discard(key)
+        feature_state[key] = some_on
+
+        #blab("%s is %s" % (key, str(some_on)), 2)
 
         return some_on
 
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# preprocess-envs.py
+#
+#  Resolve the enabled Marlin features (MARLIN_FEATURES) of many PlatformIO
+#  environments at once, ahead of a build matrix (e.g. 'mftest -a' or
+#  'build_all_examples -m'). Envs are preprocessed on a pool of processes, and
+#  envs with the same compiler and defines share a single preprocessor run.
+#
+#  Results go to the preprocessor cache of each env (.pio/build/<env>/.preprocessor),
+#  which common-dependencies.py reads instead of running the preprocessor again,
+#  as long as the configuration and the headers it includes haven't changed.
+#
+#  usage: preprocess-envs.py [-h] [-j JOBS] [-o FILE] [-v] [env ...]
+#
+#  positional arguments:
+#    env                  Environments to preprocess. (Default: all envs in platformio.ini)
+#
+#  optional arguments:
+#    -h, --help           show this help message and exit
+#    -j JOBS, --jobs JOBS Number of preprocessor processes. (Default: number of CPUs)
+#    -o FILE, --output FILE
+#                         Also write the features of every env to a JSON file.
+#    -v, --verbose        Print the preprocessor commands.
+#
+#  Run from the Marlin repo root with PlatformIO installed, using the same
+#  Configuration.h / Configuration_adv.h as the builds that follow.
+#
+import os, sys, glob, json, shlex, shutil, argparse, concurrent.futures
+import preprocessor
+
+try:
+    from platformio.project.config import ProjectConfig
+    platformio_exists = True
+except ImportError:
+    platformio_exists = False
+
+#
+# The -D flags in a list of build_flags, like the CPPDEFINES of SCons ParseFlags
+#
+def build_flags_defines(build_flags):
+    defines = []
+    args = shlex.split(' '.join(build_flags))
+    for n, arg in enumerate(args):
+        if arg == '-D' and n + 1 < len(args):
+            define = args[n + 1]
+        elif arg.startswith('-D') and len(arg) > 2:
+            define = arg[2:]
+        else:
+            continue
+        name, eq, value = define.partition('=')
+        defines.append((name, value) if eq else name)
+    return defines
+
+#
+# The g++ in a toolchain bin folder, as picked by preprocessor.search_compiler
+#
+def toolchain_compiler(bin_dir):
+    exe = '*g++.exe' if sys.platform == 'win32' else '*g++'
+    for gpath in sorted(glob.glob(os.path.join(bin_dir, exe))):
+        # Skip '*-elf-g++' (crosstool-NG) except for xtensa32
+        if not os.path.basename(gpath).endswith(('-elf-g++', '-elf-g++.exe')) or "xtensa32" in gpath:
+            return os.path.realpath(gpath)
+    return None
+
+def env_compiler(config, pioenv):
+    section = 'env:' + pioenv
+    gccpath = config.get(section, 'custom_gcc', None)
+    if gccpath:
+        return gccpath
+
+    # The toolchain package of the env's platform, if it's installed
+    try:
+        from platformio.platform.factory import PlatformFactory
+        platform = PlatformFactory.new(config.get(section, 'platform'))
+        platform.configure_project_packages(pioenv)
+        for name, options in platform.packages.items():
+            if options.get('type') != 'toolchain' or options.get('optional'):
+                continue
+            package_dir = platform.get_package_dir(name)
+            gccpath = package_dir and toolchain_compiler(os.path.join(package_dir, 'bin'))
+            if gccpath:
+                return gccpath
+    except Exception:
+        pass
+
+    # Native and simulator envs use the host compiler
+    gccpath = shutil.which('g++')
+    return gccpath and os.path.realpath(gccpath)
+
+#
+# The preprocessor commands of the given envs: [(pioenv, cmd, key, cache_path), ...]
+# The key comes from preprocessor.preprocessor_cache_key, as in the builds.
+#
+def project_targets(envs):
+    config = ProjectConfig.get_instance(os.path.join(os.getcwd(), 'platformio.ini'))
+    build_dir = config.get('platformio', 'build_dir')
+    envs = envs or config.envs()
+    filename = 'buildroot/share/PlatformIO/scripts/common-dependencies.h'
+    targets = []
+    for pioenv in envs:
+        if not config.has_section('env:' + pioenv):
+            print("Unknown environment '%s'" % pioenv)
+            continue
+        cxx = env_compiler(config, pioenv)
+        if not cxx:
+            print("%s: No compiler found" % pioenv)
+            continue
+        defines = build_flags_defines(config.get('env:' + pioenv, 'build_flags'))
+        cmd = preprocessor.preprocessor_command(cxx, defines, filename)
+        key = preprocessor.preprocessor_cache_key(cxx, defines, filename)
+        targets.append((pioenv, cmd, key, preprocessor.preprocessor_cache_path(build_dir, pioenv, filename)))
+    return targets
+
+#
+# Run the preprocessor for the targets, return { pioenv: MARLIN_FEATURES }
+#
+def resolve_features(targets, jobs=None):
+    # Envs with the same cache key share one run
+    groups = {}
+    for pioenv, cmd, key, cache_path in targets:
+        groups.setdefault((key, cmd), []).append((pioenv, cache_path))
+
+    features = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        runs = { executor.submit(preprocessor.preprocess, cmd, key, envs[0][1]): envs for (key, cmd), envs in groups.items() }
+        for run in concurrent.futures.as_completed(runs):
+            envs = runs[run]
+            define_list = run.result()
+            if not define_list:
+                for pioenv, _ in envs:
+                    print("%s: Preprocessor failed" % pioenv)
+                continue
+
+            marlin_features = {}
+            for define in define_list:
+                feature = define[8:].strip().decode().split(' ')
+                feature, definition = feature[0], ' '.join(feature[1:])
+                marlin_features[feature] = definition
+
+            # Give the other envs in the group a copy of the cache entry
+            source = envs[0][1] + '.json'
+            for pioenv, cache_path in envs:
+                if cache_path + '.json' != source and os.path.exists(source):
+                    try:
+                        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                        shutil.copyfile(source, cache_path + '.json')
+                    except OSError:
+                        pass
+                features[pioenv] = marlin_features
+                print("%s: %d features" % (pioenv, len(marlin_features)))
+
+    return features
+
+def main():
+    parser = argparse.ArgumentParser(description='Resolve the Marlin features of PlatformIO environments in parallel.')
+    parser.add_argument('envs', nargs='*', metavar='env', help='Environments to preprocess. (Default: all envs in platformio.ini)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of preprocessor processes. (Default: number of CPUs)')
+    parser.add_argument('-o', '--output', help='Also write the features of every env to a JSON file.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the preprocessor commands.')
+    args = parser.parse_args()
+
+    if not os.path.isdir('Marlin/src'):
+        print("Please 'cd' to the Marlin repo root.")
+        sys.exit(1)
+    if not platformio_exists:
+        print("PlatformIO is required to read the environments. Install it with 'pip install platformio'.")
+        sys.exit(1)
+
+    preprocessor.verbose = args.verbose
+    targets = project_targets(args.envs)
+    features = resolve_features(targets, args.jobs)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(features, outfile, indent=2, sort_keys=True)
+
+    if len(features) < len(targets):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,193 @@
 #
 # preprocessor.py
 #
-import subprocess
+import subprocess, os, re, json, hashlib
 
 nocache = 1
+diskcache = 1   # Keep preprocessor results in the build folder across runs
 verbose = 0
 
 def blab(str):
     if verbose:
         print(str)
 
+################################################################################
+#
+# Persistent cache of preprocessor results, in the env build folder.
+# An entry is valid for the same defines, input file and compiler binary (see
+# preprocessor_cache_key), as long as every header listed in the depfile (-MD) of the run
+# that produced it has the same content. Unchanged size and mtime are taken as
+# unchanged content, otherwise the header is hashed.
+# Headers probed with __has_include (e.g. Marlin/Config.h) aren't in the depfile
+# when they're missing, so each probed path is also kept with whether it existed.
+#
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def file_stamp(path):
+    st = os.stat(path)
+    return [ st.st_size, st.st_mtime_ns ]
+
+def compiler_fingerprint(cxx):
+    # The resolved path with its size and mtime, a new toolchain version replaces the binary
+    try:
+        path = os.path.realpath(cxx)
+        return [ path ] + file_stamp(path)
+    except OSError:
+        return [ cxx ]
+
+def parse_depfile(text):
+    # Make syntax: 'target: dep dep \<newline> dep', with spaces in names escaped
+    deps = text.replace('\\\n', ' ').split(': ', 1)[-1]
+    return [ d.replace('\\ ', ' ') for d in re.split(r'(?<!\\)\s+', deps.strip()) if d ]
+
+# __has_include("path") or __has_include(STRINGIFY(path with macros))
+has_include_re = re.compile(r'__has_include\s*\(\s*(?:"([^"]+)"|STRINGIFY\s*\(([^)]+)\))\s*\)')
+
+def include_probes(deps, define_list):
+    # The paths probed by the headers, relative to each header, and whether they exist
+    macros = {}
+    for line in define_list:
+        parts = line.decode(errors='ignore').split(None, 2)
+        if len(parts) == 3 and parts[0] == '#define': macros[parts[1]] = parts[2].strip('"')
+    probes = {}
+    for dep in deps:
+        try:
+            with open(dep, errors='ignore') as f:
+                text = f.read()
+        except OSError:
+            continue
+        if '__has_include' not in text: continue
+        for m in has_include_re.finditer(text):
+            name = m[1] or re.sub(r'\w+', lambda w: macros.get(w[0], w[0]), m[2].replace(' ', ''))
+            path = os.path.normpath(os.path.join(os.path.dirname(dep), name))
+            probes[path] = os.path.exists(path)
+    return [ [ path, exists ] for path, exists in probes.items() ]
+
+def preprocessor_cache_path(build_dir, pioenv, filename):
+    name = os.path.basename(filename) + '-' + hashlib.sha1(filename.encode()).hexdigest()[:12]
+    return os.path.join(build_dir, pioenv, '.preprocessor', name)
+
+def load_cached_defines(cache_path, key):
+    try:
+        with open(cache_path + '.json') as f:
+            entry = json.load(f)
+        if entry['key'] != key:
+            return None
+        for path, existed in entry['probes']:
+            if os.path.exists(path) != existed:
+                blab("Preprocessor cache: %s %s" % (path, 'removed' if existed else 'added'))
+                return None
+        restamped = False
+        for dep in entry['deps']:
+            path, stamp, digest = dep
+            current = file_stamp(path)
+            if current == stamp:
+                continue
+            if file_sha1(path) != digest:
+                blab("Preprocessor cache: %s changed" % path)
+                return None
+            dep[1], restamped = current, True   # touched, not changed
+        if restamped:
+            save_cached_defines(cache_path, entry)
+        return [ line.encode() for line in entry['defines'] ]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_cached_defines(cache_path, entry):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(cache_path + '.tmp', cache_path + '.json')
+    except OSError:
+        pass
+
 ################################################################################
 #
 # Invoke GCC to run the preprocessor and extract enabled features
 #
 preprocessor_cache = {}
 
-def run_preprocessor(env, fn=None):
-    filename = fn or 'buildroot/share/PlatformIO/scripts/common-dependencies.h'
-    if filename in preprocessor_cache:
-        return preprocessor_cache[filename]
+preprocessor_flags = '-D__MARLIN_DEPS__ -w -dM -E -x c++'
 
-    # Process defines
-    build_flags = env.get('BUILD_FLAGS')
-    build_flags = env.ParseFlagsExtended(build_flags)
+# CPPDEFINES as '-D' arguments: NAME or NAME=VALUE
+def define_args(cppdefines):
+    return [ '-D%s=%s' % tuple(s) if isinstance(s, (tuple, list)) else '-D' + s for s in cppdefines ]
 
-    cxx = search_compiler(env)
+def preprocessor_command(cxx, cppdefines, filename):
     cmd = ['"' + cxx + '"']
 
     # Build flags from board.json
     #if 'BOARD' in env:
     #   cmd += [env.BoardConfig().get("build.extra_flags")]
-    for s in build_flags['CPPDEFINES']:
-        if isinstance(s, tuple):
-            cmd += ['-D' + s[0] + '=' + str(s[1])]
-        else:
-            cmd += ['-D' + s]
+    cmd += define_args(cppdefines)
 
-    cmd += ['-D__MARLIN_DEPS__ -w -dM -E -x c++']
+    cmd += [preprocessor_flags]
     depcmd = cmd + [ filename ]
-    cmd = ' '.join(depcmd)
+    return ' '.join(depcmd)
+
+def preprocessor_cache_key(cxx, cppdefines, filename):
+    # The disk cache key for a run, shared by the builds and preprocess-envs.py.
+    # Made from the resolved compiler, not the command, so the path naming it doesn't matter.
+    return hashlib.sha256(json.dumps([ compiler_fingerprint(cxx), define_args(cppdefines), preprocessor_flags, filename ]).encode()).hexdigest()
+
+cache_misses = 0
+
+def preprocess(cmd, key=None, cache_path=None):
+    # Run the preprocessor command, through the disk cache when a key and path are given
+    global cache_misses
+    if key and cache_path:
+        define_list = load_cached_defines(cache_path, key)
+        if define_list is not None:
+            blab("Preprocessor output from cache")
+            return define_list
+        cache_misses += 1
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        cmd += ' -MD -MF "%s.d"' % cache_path
+    else:
+        cache_path = None
+
     blab(cmd)
     try:
         define_list = subprocess.check_output(cmd, shell=True).splitlines()
     except:
-        define_list = {}
+        return {}
+
+    if cache_path:
+        # Record the headers the preprocessor read, with their content hash
+        try:
+            with open(cache_path + '.d') as f:
+                deps = [ os.path.abspath(d) for d in parse_depfile(f.read()) ]
+            os.remove(cache_path + '.d')
+            save_cached_defines(cache_path, { 'key': key, 'deps': [ [ d, file_stamp(d), file_sha1(d) ] for d in deps ],
+                                              'probes': include_probes(deps, define_list),
+                                              'defines': [ line.decode() for line in define_list ] })
+        except (OSError, UnicodeDecodeError):
+            pass
+    return define_list
+
+def run_preprocessor(env, fn=None):
+    filename = fn or 'buildroot/share/PlatformIO/scripts/common-dependencies.h'
+    if filename in preprocessor_cache:
+        return preprocessor_cache[filename]
+
+    # Process defines
+    build_flags = env.get('BUILD_FLAGS')
+    build_flags = env.ParseFlagsExtended(build_flags)
+
+    cxx = search_compiler(env)
+    cppdefines = build_flags['CPPDEFINES']
+    cmd = preprocessor_command(cxx, cppdefines, filename)
+
+    if diskcache:
+        misses = cache_misses
+        define_list = preprocess(cmd, preprocessor_cache_key(cxx, cppdefines, filename), preprocessor_cache_path(env['PROJECT_BUILD_DIR'], env['PIOENV'], filename))
+        if cache_misses != misses:
+            print("Preprocessor cache miss for %s (%s)" % (env['PIOENV'], os.path.basename(filename)))
+    else:
+        define_list = preprocess(cmd)
     preprocessor_cache[filename] = define_list
     return define_list
 
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+#
+# schema-bench.py
+#
+#  Time schema.py on the current Configuration.h / Configuration_adv.h and
+#  check its output against golden files saved from a known-good version.
+#
+#  usage: schema-bench.py [-h] [-n RUNS] [--save DIR] [--golden DIR]
+#
+#  optional arguments:
+#    -h, --help    show this help message and exit
+#    -n RUNS       Number of timed runs. (Default: 20)
+#    --save DIR    Save schema.json and schema_grouped.json to DIR as golden files.
+#    --golden DIR  Compare the output with the golden files in DIR.
+#
+#  Run from the Marlin repo root, e.g. to check a change to schema.py:
+#    git stash ; schema-bench.py --save /tmp/golden ; git stash pop
+#    schema-bench.py --golden /tmp/golden
+#
+import sys, time, json, copy, argparse
+from pathlib import Path
+import schema
+
+def timed(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return result, times[0], times[len(times) // 2]
+
+def as_json(data):
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark and verify schema.py.')
+    parser.add_argument('-n', dest='runs', type=int, default=20, help='Number of timed runs. (Default: 20)')
+    parser.add_argument('--save', help='Save schema.json and schema_grouped.json to DIR as golden files.', metavar='DIR')
+    parser.add_argument('--golden', help='Compare the output with the golden files in DIR.', metavar='DIR')
+    args = parser.parse_args()
+
+    if not Path('Marlin/Configuration.h').is_file():
+        print("Please 'cd' to the Marlin repo root.")
+        sys.exit(1)
+
+    lines = sum(len(Path('Marlin', fn).read_text(encoding='utf-8').splitlines()) for fn in ('Configuration.h', 'Configuration_adv.h'))
+    sch, best, median = timed(schema.extract, args.runs)
+    count = sum(len(s) for f in sch.values() for s in f.values())
+    print("extract:       %6.1fms best, %6.1fms median (%d lines, %d options, %.0f lines/ms)" % (best * 1000, median * 1000, lines, count, lines / best / 1000))
+
+    def grouped():
+        g = copy.deepcopy(sch)
+        schema.group_options(g)
+        return g
+    grp, best, median = timed(grouped, args.runs)
+    print("group_options: %6.1fms best, %6.1fms median (with copy)" % (best * 1000, median * 1000))
+
+    outputs = { 'schema.json': as_json(sch), 'schema_grouped.json': as_json(grp) }
+
+    if args.save:
+        Path(args.save).mkdir(parents=True, exist_ok=True)
+        for name, text in outputs.items():
+            Path(args.save, name).write_text(text, encoding='utf-8')
+        print("Saved golden files to %s" % args.save)
+
+    if args.golden:
+        ok = True
+        for name, text in outputs.items():
+            golden = Path(args.golden, name).read_text(encoding='utf-8')
+            if golden == text:
+                print("%s: same as golden" % name)
+                continue
+            ok = False
+            glines, tlines = golden.splitlines(), text.splitlines()
+            diff = next((n for n, (a, b) in enumerate(zip(glines, tlines)) if a != b), min(len(glines), len(tlines)))
+            print("%s: DIFFERS from golden at line %d" % (name, diff + 1))
+            print("  golden: %s" % (glines[diff] if diff < len(glines) else '<end>'))
+            print("  output: %s" % (tlines[diff] if diff < len(tlines) else '<end>'))
+        if not ok: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
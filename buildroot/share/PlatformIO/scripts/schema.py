@@ -9,19 +9,12 @@
 #
 # This script is a companion to abm/js/schema.js in the MarlinFirmware/AutoBuildMarlin project, which has
 # been extended to evaluate conditions and can determine what options are actually enabled, not just which
-# options are uncommented. That will be migrated to this script for standalone migration.
+# options are uncommented. This script can also evaluate the conditions of each option (see CondEvaluator)
+# to give its effective state, as far as the configuration files alone can tell.
 #
-import re, json
+import re, io, json, hashlib
 from pathlib import Path
 
-def extend_dict(d:dict, k:tuple):
-    if len(k) >= 1 and k[0] not in d:
-        d[k[0]] = {}
-    if len(k) >= 2 and k[1] not in d[k[0]]:
-        d[k[0]][k[1]] = {}
-    if len(k) >= 3 and k[2] not in d[k[0]][k[1]]:
-        d[k[0]][k[1]][k[2]] = {}
-
 grouping_patterns = [
     re.compile(r'^([XYZIJKUVW]|[XYZ]2|Z[34]|E[0-7])$'),
     re.compile(r'^AXIS\d$'),
@@ -31,54 +24,184 @@ grouping_patterns = [
     re.compile(r'^(HOTENDS|BED|PROBE|COOLER)$'),
     re.compile(r'^[XYZIJKUVW]M(IN|AX)$')
 ]
-# If the indexed part of the option name matches a pattern
-# then add it to the dictionary.
-def find_grouping(gdict, filekey, sectkey, optkey, pindex):
-    optparts = optkey.split('_')
-    if 1 < len(optparts) > pindex:
-        for patt in grouping_patterns:
-            if patt.match(optparts[pindex]):
-                subkey = optparts[pindex]
-                modkey = '_'.join(optparts)
-                optparts[pindex] = '*'
-                wildkey = '_'.join(optparts)
-                kkey = f'{filekey}|{sectkey}|{wildkey}'
-                if kkey not in gdict: gdict[kkey] = []
-                gdict[kkey].append((subkey, modkey))
-
-# Build a list of potential groups. Only those with multiple items will be grouped.
+
+# Does a part of an option name match a grouping pattern?
+# Parts recur across names (X, Y, MIN, ...) so each one is only tested once.
+grouping_parts = {}
+
+def is_grouping_part(part):
+    hit = grouping_parts.get(part)
+    if hit is None:
+        hit = grouping_parts[part] = any(patt.match(part) for patt in grouping_patterns)
+    return hit
+
+# Grouping looks at name parts 10 down to 0
+GROUP_MAX_PINDEX = 10
+
+# Add an option to the lists of names, by part index, that could be grouped on that part
+def index_grouping(byindex, optkey, optparts, limit):
+    if len(optparts) < 2: return
+    for pindex in range(min(len(optparts), limit)):
+        if is_grouping_part(optparts[pindex]):
+            byindex.setdefault(pindex, []).append((optkey, optparts))
+
+#
+# Group options whose names only differ in one groupable part, e.g. X_MIN_POS, Y_MIN_POS, Z_MIN_POS
+# become X, Y and Z in a 'wildcard' group *_MIN_POS. Only groups with multiple items are made.
+# Part indexes are handled from last to first, so groups can themselves be grouped on an earlier part.
+# Each name is split and checked once, then each part index only visits the names grouped on it.
+#
 def group_options(schema):
-    for pindex in range(10, -1, -1):
-        found_groups = {}
-        for filekey, f in schema.items():
-            for sectkey, s in f.items():
-                for optkey in s:
-                    find_grouping(found_groups, filekey, sectkey, optkey, pindex)
-
-        fkeys = [ k for k in found_groups.keys() ]
-        for kkey in fkeys:
-            items = found_groups[kkey]
-            if len(items) > 1:
-                f, s, w = kkey.split('|')
-                extend_dict(schema, (f, s, w))                      # Add wildcard group to schema
-                for subkey, optkey in items:                        # Add all items to wildcard group
-                    schema[f][s][w][subkey] = schema[f][s][optkey]  # Move non-wildcard item to wildcard group
-                    del schema[f][s][optkey]
-            del found_groups[kkey]
-
-# Extract all board names from boards.h
-def load_boards():
+    sections = []
+    for f in schema.values():
+        for s in f.values():
+            byindex = {}
+            for optkey in s:
+                index_grouping(byindex, optkey, optkey.split('_'), GROUP_MAX_PINDEX + 1)
+            sections.append((s, byindex))
+
+    for pindex in range(GROUP_MAX_PINDEX, -1, -1):
+        for s, byindex in sections:
+            # Potential groups in the order their first item appears in the section
+            found_groups = {}
+            for optkey, optparts in byindex.pop(pindex, ()):
+                if optkey not in s: continue                # Moved into a group on a later part
+                wildparts = optparts[:]
+                wildparts[pindex] = '*'
+                wildkey = '_'.join(wildparts)
+                if wildkey not in found_groups: found_groups[wildkey] = (wildparts, [])
+                found_groups[wildkey][1].append((optparts[pindex], optkey))
+
+            for wildkey, (wildparts, items) in found_groups.items():
+                if len(items) > 1:
+                    if wildkey not in s:                    # Add wildcard group to the section
+                        s[wildkey] = {}
+                        index_grouping(byindex, wildkey, wildparts, pindex)
+                    for subkey, optkey in items:            # Move non-wildcard item to wildcard group
+                        s[wildkey][subkey] = s[optkey]
+                        del s[optkey]
+
+# Extract all board names (and their numbers) from boards.h
+# The list is kept for as long as boards.h is unchanged.
+boards_cache = {}
+
+def read_boards():
     bpath = Path("Marlin/src/core/boards.h")
-    if bpath.is_file():
+    try:
+        stat = bpath.stat()
+    except OSError:
+        return '', {}
+    bkey = (str(bpath.resolve()), stat.st_mtime_ns, stat.st_size)
+    if bkey not in boards_cache:
         with bpath.open() as bfile:
-            boards = []
+            boards, numbers = [], {}
             for line in bfile:
                 if line.startswith("#define BOARD_"):
-                    bname = line.split()[1]
+                    parts = line.split()
+                    bname = parts[1]
+                    if len(parts) > 2: numbers[bname] = parts[2]
                     if bname != "BOARD_UNKNOWN": boards.append(bname)
-            return "['" + "','".join(boards) + "']"
+        boards_cache.clear()
+        boards_cache[bkey] = ("['" + "','".join(boards) + "']", numbers)
+    return boards_cache[bkey]
+
+def load_boards():
+    return read_boards()[0]
+
+# The BOARD_* macros, for conditions on MOTHERBOARD
+def load_board_macros():
+    return read_boards()[1]
+
+# Parsing states
+class Parse:
+    NORMAL          = 0 # No condition yet
+    BLOCK_COMMENT   = 1 # Looking for the end of the block comment
+    EOL_COMMENT     = 2 # EOL comment started, maybe add the next comment?
+    SLASH_COMMENT   = 3 # Block-like comment, starting with aligned //
+    GET_SENSORS     = 4 # Gathering temperature sensor options
+    ERROR           = 9 # Syntax error
+
+# Regex for #define NAME [VALUE] [COMMENT] with sanitized line
+defgrep = re.compile(r'^(//)?\s*(#define)\s+([A-Za-z0-9_]+)\s*(.*?)\s*(//.+)?$')
+# Pattern to match a float value
+flt = r'[-+]?\s*(\d+\.|\d*\.\d+)([eE][-+]?\d+)?[fF]?'
+
+# Patterns used by the parser, compiled once
+section_re      = re.compile(r'@section\s*(.+)')
+sensors_re      = re.compile(r'temperature sensors.*:', re.IGNORECASE)
+sensor_re       = re.compile(r'^\s*(-?\d+)\s*:\s*(.+)$')
+comment_def_re  = re.compile(r'^//\s*#define')
+atom_re         = re.compile(r'^[A-Za-z0-9_]*(\([^)]+\))?$')
+atom_eq_re      = re.compile(r'^[A-Za-z0-9_]+ == \d+?$')
+units_re        = re.compile(r'^\(([^)]+)\)')
+
+# Patterns for the type of a value, tested in order
+value_types = (
+    ('int',     re.compile(r'^[-+]?\s*\d+$')),
+    ('ints',    re.compile(r'^([-+]?\s*\d+)(\s*,\s*[-+]?\s*\d+)+$')),
+    ('floats',  re.compile(rf'({flt}(\s*,\s*{flt})+)')),
+    ('float',   re.compile(f'^({flt})$'))
+)
+value_types_late = (
+    ('enum',    re.compile(r'^[A-Za-z0-9_]{3,}$')),
+    ('int[]',   re.compile(r'^{\s*[-+]?\s*\d+(\s*,\s*[-+]?\s*\d+)*\s*}$')),
+    ('float[]', re.compile(r'^{{\s*{flt}(\s*,\s*{flt})*\s*}}$'))
+)
+
+# Type is based on the value
+def value_type_of(val):
+    if val == '': return 'switch'
+    for vtype, vre in value_types:
+        if vre.match(val): return vtype
+    if val[0] == '"': return 'string'
+    if val[0] == "'": return 'char'
+    if val in ('true', 'false'): return 'bool'
+    if val in ('HIGH', 'LOW'): return 'state'
+    for vtype, vre in value_types_late:
+        if vre.match(val): return vtype
+    if val[0] == '{': return 'array'
     return ''
 
+# Comment lines that use_comment doesn't just add to the comment
+special_comment = (':', '@section', '========')
+
+#
+# Add the given comment line to the comment buffer, unless:
+# - The line starts with ':' and JSON values to assign to 'opt'.
+# - The line starts with '@section' so a new section needs to be returned.
+# - The line starts with '======' so just skip it.
+#
+def use_comment(c, opt, sec, bufref):
+    '''
+    c       - The comment line to parse
+    opt     - Options JSON string to return (if not updated)
+    sec     - Section to return (if not updated)
+    bufref  - The comment buffer to add to
+    '''
+    sc = c.strip()                      # Strip for special patterns
+    if sc.startswith(':'):              # If the comment starts with : then it has magic JSON
+        d = sc[1:].strip()              # Strip the leading : and spaces
+        # Look for a JSON container
+        cbr = sc.rindex('}') if d.startswith('{') else sc.rindex(']') if d.startswith('[') else 0
+        if cbr:
+            opt, cmt = sc[1:cbr+1].strip(), sc[cbr+1:].strip()
+            if cmt != '': bufref.append(cmt)
+        else:
+            opt = sc[1:].strip()        # Some literal value not in a JSON container?
+    else:
+        m = section_re.match(sc) if sc.startswith('@section') else None # Start a new section?
+        if m:
+            sec = m[1]
+        elif not sc.startswith('========'):
+            bufref.append(c)            # Anything else is part of the comment
+    return opt, sec
+
+# Parenthesize the given expression if needed
+def atomize(s):
+    if s == '' or atom_re.match(s) or atom_eq_re.match(s):
+        return s
+    return f'({s})'
+
 #
 # Extract the specified configuration files in the form of a structured schema.
 # Contains the full schema for the configuration files, not just the enabled options,
@@ -100,346 +223,764 @@ def load_boards():
 #    - comment  = The comment for the define, if it has one
 #    - units    = The units for the define, if it has one
 #    - options  = The options for the define, if it has any
+#    - effective = With 'evaluate', True if the define is enabled and its conditions are met,
+#                  None if the conditions can't be evaluated from the configuration files alone
 #
-def extract_files(filekey):
-    # Load board names from boards.h
-    boards = load_boards()
-
-    # Parsing states
-    class Parse:
-        NORMAL          = 0 # No condition yet
-        BLOCK_COMMENT   = 1 # Looking for the end of the block comment
-        EOL_COMMENT     = 2 # EOL comment started, maybe add the next comment?
-        SLASH_COMMENT   = 3 # Block-like comment, starting with aligned //
-        GET_SENSORS     = 4 # Gathering temperature sensor options
-        ERROR           = 9 # Syntax error
+# With a 'cache_dir' the schema of each file is saved there, keyed by the file content,
+# the parsing state at the start of the file and boards.h. Only the changed files are
+# parsed again, and the cached ones are renumbered to follow the sid of the file before.
+#
+def extract_files(filekey, cache_dir=None, evaluate=False):
+    # Board names from boards.h, only loaded if a file has to be parsed
+    boards = None
+    bpath = Path("Marlin/src/core/boards.h")
+    boards_hash = hashlib.sha256(bpath.read_bytes()).hexdigest() if bpath.is_file() else ''
 
     # A JSON object to store the data
     sch_out = { key:{} for key in filekey.values() }
-    # Regex for #define NAME [VALUE] [COMMENT] with sanitized line
-    defgrep = re.compile(r'^(//)?\s*(#define)\s+([A-Za-z0-9_]+)\s*(.*?)\s*(//.+)?$')
-    # Pattern to match a float value
-    flt = r'[-+]?\s*(\d+\.|\d*\.\d+)([eE][-+]?\d+)?[fF]?'
     # Start with unknown state
     state = Parse.NORMAL
     # Serial ID
     sid = 0
+    # All the #defines, in order
+    all_defines = []
     # Loop through files and parse them line by line
     for fn, fk in filekey.items():
-        with Path("Marlin", fn).open(encoding='utf-8') as fileobj:
-            section = 'none'        # Current Settings section
-            line_number = 0         # Counter for the line number of the file
-            conditions = []         # Create a condition stack for the current file
-            comment_buff = []       # A temporary buffer for comments
-            prev_comment = ''       # Copy before reset for an EOL comment
-            options_json = ''       # A buffer for the most recent options JSON found
-            eol_options = False     # The options came from end of line, so only apply once
-            join_line = False       # A flag that the line should be joined with the previous one
-            line = ''               # A line buffer to handle \ continuation
-            last_added_ref = {}     # Reference to the last added item
-            # Loop through the lines in the file
-            for the_line in fileobj.readlines():
-                line_number += 1
-
-                # Clean the line for easier parsing
-                the_line = the_line.strip()
-
-                if join_line:   # A previous line is being made longer
-                    line += (' ' if line else '') + the_line
-                else:           # Otherwise, start the line anew
-                    line, line_start = the_line, line_number
-
-                # If the resulting line ends with a \, don't process now.
-                # Strip the end off. The next line will be joined with it.
-                join_line = line.endswith("\\")
-                if join_line:
-                    line = line[:-1].strip()
-                    continue
+        data = Path("Marlin", fn).read_bytes()
+        key = hashlib.sha256(f'{SCHEMA_CACHE_VERSION}:{state}:{boards_hash}:'.encode() + data).hexdigest()
+        cached = load_cached_schema(cache_dir, fk, key) if cache_dir else None
+        if cached:
+            fsch, count, state, defines = cached['schema'], cached['count'], cached['state'], cached['defines']
+        else:
+            if boards is None: boards = load_boards()
+            fsch, defines = {}, []
+            lines = io.StringIO(data.decode('utf-8'), newline=None).readlines()
+            count, end_state = extract_lines(lines, fsch, boards, 0, state, defines)
+            if cache_dir: save_cached_schema(cache_dir, fk, { 'key': key, 'count': count, 'state': end_state, 'schema': fsch, 'defines': defines })
+            state = end_state
+
+        # Serial IDs follow the previous file
+        if sid:
+            for sect in fsch.values():
+                for info in sect.values():
+                    for define_info in info if isinstance(info, list) else [ info ]:
+                        define_info['sid'] += sid
+            for define in defines: define[0] += sid
+        sch_out[fk] = fsch
+        all_defines += defines
+        sid += count
+
+    # Add the effective state of each option
+    if evaluate:
+        effective = evaluate_defines(all_defines, load_board_macros())
+        for fsch in sch_out.values():
+            for sect in fsch.values():
+                for info in sect.values():
+                    for define_info in info if isinstance(info, list) else [ info ]:
+                        define_info['effective'] = effective[define_info['sid']]
+
+    return sch_out
+
+#
+# Per-file schema cache
+#
+SCHEMA_CACHE_VERSION = 2
+
+def load_cached_schema(cache_dir, fk, key):
+    try:
+        with Path(cache_dir, f'schema-{fk}.json').open(encoding='utf-8') as cfile:
+            cached = json.load(cfile)
+        if cached['key'] == key:
+            return cached
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_cached_schema(cache_dir, fk, cached):
+    try:
+        cpath = Path(cache_dir, f'schema-{fk}.json')
+        cpath.parent.mkdir(parents=True, exist_ok=True)
+        tpath = cpath.with_suffix('.tmp')
+        with tpath.open('w', encoding='utf-8') as cfile:
+            json.dump(cached, cfile, ensure_ascii=False)
+        tpath.replace(cpath)
+    except OSError:
+        pass
+
+#
+# Parse the lines of a configuration file into its schema dict 'fsch'.
+# Serial IDs and the parsing state continue from the previous file.
+# Every #define is also added to the 'defines' list, if given, as
+# [sid, name, enabled, value, requires], including repeated names.
+# Return the last serial ID used and the final state.
+#
+def extract_lines(lines, fsch, boards, sid, state=Parse.NORMAL, defines=None):
+    # Parsing states and patterns as locals, for speed
+    NORMAL, BLOCK_COMMENT, EOL_COMMENT, SLASH_COMMENT, GET_SENSORS = \
+        Parse.NORMAL, Parse.BLOCK_COMMENT, Parse.EOL_COMMENT, Parse.SLASH_COMMENT, Parse.GET_SENSORS
+    define_match = defgrep.match
+
+    section = 'none'        # Current Settings section
+    conditions = []         # Create a condition stack for the current file
+    requires = ''           # The conditions joined up, for the defines in the block
+    comment_buff = []       # A temporary buffer for comments
+    prev_comment = ''       # Copy before reset for an EOL comment
+    options_json = ''       # A buffer for the most recent options JSON found
+    eol_options = False     # The options came from end of line, so only apply once
+    join_line = False       # A flag that the line should be joined with the previous one
+    line = ''               # A line buffer to handle \ continuation
+    last_added_ref = {}     # Reference to the last added item
+    # Loop through the lines in the file
+    for line_number, the_line in enumerate(lines, 1):
+
+        # Clean the line for easier parsing
+        the_line = the_line.strip()
+
+        if join_line:   # A previous line is being made longer
+            line += (' ' if line else '') + the_line
+        else:           # Otherwise, start the line anew
+            line, line_start = the_line, line_number
+
+        # If the resulting line ends with a \, don't process now.
+        # Strip the end off. The next line will be joined with it.
+        join_line = line.endswith("\\")
+        if join_line:
+            line = line[:-1].strip()
+            continue
+
+        # Only a line containing '#define' can be a define
+        defmatch = define_match(line) if '#define' in line else None
+
+        # Special handling for EOL comments after a #define.
+        # At this point the #define is already digested and inserted,
+        # so we have to extend it
+        if state == EOL_COMMENT:
+            # If the line is not a comment, we're done with the EOL comment
+            if not defmatch and the_line.startswith('//'):
+                comment_buff.append(the_line[2:].strip())
+            else:
+                state = NORMAL
+                cline = ' '.join(comment_buff)
+                comment_buff = []
+                if cline != '':
+                    # A (block or slash) comment was already added
+                    cfield = 'notes' if 'comment' in last_added_ref else 'comment'
+                    last_added_ref[cfield] = cline
+
+        # For slash comments, capture consecutive slash comments.
+        # The comment will be applied to the next #define.
+        if state == SLASH_COMMENT:
+            if not defmatch and the_line.startswith('//'):
+                cline = the_line[2:].strip()
+                if cline.startswith(special_comment):
+                    options_json, section = use_comment(cline, options_json, section, comment_buff)
+                else:
+                    comment_buff.append(cline)
+                continue
+            else:
+                state = NORMAL
+
+        # In a block comment, capture lines up to the end of the comment.
+        # Assume nothing follows the comment closure.
+        if state in (BLOCK_COMMENT, GET_SENSORS):
+            endpos = line.find('*/')
+            if endpos < 0:
+                cline = line
+            else:
+                cline, line = line[:endpos].strip(), line[endpos+2:].strip()
+
+                # Temperature sensors are done
+                if state == GET_SENSORS:
+                    options_json = f'[ {options_json[:-2]} ]'
+                state = NORMAL
+
+            # Strip the leading '* ' from block comments
+            if cline.startswith('*'): cline = cline[2:] if cline.startswith('* ') else cline[1:]
+
+            # Collect temperature sensors
+            if state == GET_SENSORS:
+                sens = sensor_re.match(cline)
+                if sens:
+                    s2 = sens[2].replace("'", "''")
+                    options_json += f"{sens[1]}:'{sens[1]} - {s2}', "
+
+            elif state == BLOCK_COMMENT:
+
+                # Look for temperature sensors
+                if cline[:1] in 'Tt' and sensors_re.match(cline):
+                    state, cline = GET_SENSORS, "Temperature Sensors"
+
+                # Most lines are just comment text
+                if cline.lstrip().startswith(special_comment):
+                    options_json, section = use_comment(cline, options_json, section, comment_buff)
                 else:
-                    line_end = line_number
+                    comment_buff.append(cline)
+
+        # For the normal state we're looking for any non-blank line
+        elif state == NORMAL:
+            # Skip a commented define when evaluating comment opening
+            st = 2 if line.startswith('//') and comment_def_re.match(line) else 0
+            cpos1 = line.find('/*')     # Start a block comment on the line?
+            cpos2 = line.find('//', st) # Start an end of line comment on the line?
+
+            # Only the first comment starter gets evaluated
+            cpos = -1
+            if cpos1 != -1 and (cpos1 < cpos2 or cpos2 == -1):
+                cpos = cpos1
+                comment_buff = []
+                state = BLOCK_COMMENT
+                eol_options = False
+            elif cpos2 != -1 and (cpos2 < cpos1 or cpos1 == -1):
+                cpos = cpos2
+
+                # Comment after a define may be continued on the following lines
+                if defmatch is not None and cpos > 10:
+                    state = EOL_COMMENT
+                    prev_comment = '\n'.join(comment_buff)
+                    comment_buff = []
+                else:
+                    state = SLASH_COMMENT
 
-                defmatch = defgrep.match(line)
+            # Process the start of a new comment
+            if cpos != -1:
+                comment_buff = []
+                cline, line = line[cpos+2:].strip(), line[:cpos].strip()
 
-                # Special handling for EOL comments after a #define.
-                # At this point the #define is already digested and inserted,
-                # so we have to extend it
-                if state == Parse.EOL_COMMENT:
-                    # If the line is not a comment, we're done with the EOL comment
-                    if not defmatch and the_line.startswith('//'):
-                        comment_buff.append(the_line[2:].strip())
-                    else:
-                        state = Parse.NORMAL
-                        cline = ' '.join(comment_buff)
-                        comment_buff = []
-                        if cline != '':
-                            # A (block or slash) comment was already added
-                            cfield = 'notes' if 'comment' in last_added_ref else 'comment'
-                            last_added_ref[cfield] = cline
-
-                #
-                # Add the given comment line to the comment buffer, unless:
-                # - The line starts with ':' and JSON values to assign to 'opt'.
-                # - The line starts with '@section' so a new section needs to be returned.
-                # - The line starts with '======' so just skip it.
-                #
-                def use_comment(c, opt, sec, bufref):
-                    '''
-                    c       - The comment line to parse
-                    opt     - Options JSON string to return (if not updated)
-                    sec     - Section to return (if not updated)
-                    bufref  - The comment buffer to add to
-                    '''
-                    sc = c.strip()                      # Strip for special patterns
-                    if sc.startswith(':'):              # If the comment starts with : then it has magic JSON
-                        d = sc[1:].strip()              # Strip the leading : and spaces
-                        # Look for a JSON container
-                        cbr = sc.rindex('}') if d.startswith('{') else sc.rindex(']') if d.startswith('[') else 0
-                        if cbr:
-                            opt, cmt = sc[1:cbr+1].strip(), sc[cbr+1:].strip()
-                            if cmt != '': bufref.append(cmt)
-                        else:
-                            opt = sc[1:].strip()        # Some literal value not in a JSON container?
-                    else:
-                        m = re.match(r'@section\s*(.+)', sc) # Start a new section?
-                        if m:
-                            sec = m[1]
-                        elif not sc.startswith('========'):
-                            bufref.append(c)            # Anything else is part of the comment
-                    return opt, sec
-
-                # For slash comments, capture consecutive slash comments.
-                # The comment will be applied to the next #define.
-                if state == Parse.SLASH_COMMENT:
-                    if not defmatch and the_line.startswith('//'):
-                        options_json, section = use_comment(the_line[2:].strip(), options_json, section, comment_buff)
-                        continue
-                    else:
-                        state = Parse.NORMAL
-
-                # In a block comment, capture lines up to the end of the comment.
-                # Assume nothing follows the comment closure.
-                if state in (Parse.BLOCK_COMMENT, Parse.GET_SENSORS):
-                    endpos = line.find('*/')
-                    if endpos < 0:
-                        cline = line
+                if state == BLOCK_COMMENT:
+                    # Strip leading '*' from block comments
+                    if cline.startswith('*'): cline = cline[2:] if cline.startswith('* ') else cline[1:]
+                else:
+                    # Expire end-of-line options after first use
+                    if cline.startswith(':'): eol_options = True
+
+                # Buffer a non-empty comment start
+                if cline.startswith(special_comment):
+                    options_json, section = use_comment(cline, options_json, section, comment_buff)
+                elif cline != '':
+                    comment_buff.append(cline)
+
+            # If the line has nothing before the comment, go to the next line
+            if line == '':
+                options_json = ''
+                continue
+
+            #
+            # The conditions stack is an array containing condition-arrays.
+            # Each condition-array lists the conditions for the current block.
+            # IF/N/DEF adds a new condition-array to the stack.
+            # ELSE/ELIF/ENDIF pop the condition-array.
+            # ELSE/ELIF negate the last item in the popped condition-array.
+            # ELIF adds a new condition to the end of the array.
+            # ELSE/ELIF re-push the condition-array.
+            #
+            directive = line.split(None, 1)[0]
+            iselif, iselse = directive == '#elif', directive == '#else'
+            if iselif or iselse or directive == '#endif':
+                if len(conditions) == 0:
+                    raise Exception(f'no #if block at line {line_number}')
+
+                # Pop the last condition-array from the stack
+                prev = conditions.pop()
+
+                if iselif or iselse:
+                    prev[-1] = '!' + prev[-1] # Invert the last condition
+                    if iselif: prev.append(atomize(line[5:].strip()))
+                    conditions.append(prev)
+                requires = None
+
+            elif directive == '#if':
+                conditions.append([ atomize(line[3:].strip()) ])
+                requires = None
+            elif directive == '#ifdef':
+                conditions.append([ f'defined({line[6:].strip()})' ])
+                requires = None
+            elif directive == '#ifndef':
+                conditions.append([ f'!defined({line[7:].strip()})' ])
+                requires = None
+
+            # Handle a complete #define line
+            elif defmatch is not None:
+
+                # Get the match groups into vars
+                enabled, define_name, val = defmatch[1] is None, defmatch[3], defmatch[4]
+
+                # Increment the serial ID
+                sid += 1
+
+                # Create a new dictionary for the current #define
+                define_info = {
+                    'section': section,
+                    'name': define_name,
+                    'enabled': enabled,
+                    'line': line_start,
+                    'sid': sid
+                }
+
+                value_type = value_type_of(val)
+
+                val = (val == 'true')           if value_type == 'bool' \
+                else int(val)                   if value_type == 'int' \
+                else val.replace('f','')        if value_type == 'floats' \
+                else float(val.replace('f','')) if value_type == 'float' \
+                else val
+
+                if val != '': define_info['value'] = val
+                if value_type != '': define_info['type'] = value_type
+
+                # Join up accumulated conditions with &&
+                if conditions:
+                    if requires is None: requires = '(' + ') && ('.join(sum(conditions, [])) + ')'
+                    define_info['requires'] = requires
+
+                if defines is not None:
+                    defines.append([ sid, define_name, enabled, defmatch[4], requires if conditions else '' ])
+
+                # If the comment_buff is not empty, add the comment to the info
+                if comment_buff:
+                    full_comment = '\n'.join(comment_buff).strip()
+
+                    # An EOL comment will be added later
+                    # The handling could go here instead of above
+                    if state == EOL_COMMENT:
+                        define_info['comment'] = ''
                     else:
-                        cline, line = line[:endpos].strip(), line[endpos+2:].strip()
-
-                        # Temperature sensors are done
-                        if state == Parse.GET_SENSORS:
-                            options_json = f'[ {options_json[:-2]} ]'
-                        state = Parse.NORMAL
-
-                    # Strip the leading '* ' from block comments
-                    cline = re.sub(r'^\* ?', '', cline)
-
-                    # Collect temperature sensors
-                    if state == Parse.GET_SENSORS:
-                        sens = re.match(r'^\s*(-?\d+)\s*:\s*(.+)$', cline)
-                        if sens:
-                            s2 = sens[2].replace("'", "''")
-                            options_json += f"{sens[1]}:'{sens[1]} - {s2}', "
-
-                    elif state == Parse.BLOCK_COMMENT:
-
-                        # Look for temperature sensors
-                        if re.match(r'temperature sensors.*:', cline, re.IGNORECASE):
-                            state, cline = Parse.GET_SENSORS, "Temperature Sensors"
-
-                        options_json, section = use_comment(cline, options_json, section, comment_buff)
-
-                # For the normal state we're looking for any non-blank line
-                elif state == Parse.NORMAL:
-                    # Skip a commented define when evaluating comment opening
-                    st = 2 if re.match(r'^//\s*#define', line) else 0
-                    cpos1 = line.find('/*')     # Start a block comment on the line?
-                    cpos2 = line.find('//', st) # Start an end of line comment on the line?
-
-                    # Only the first comment starter gets evaluated
-                    cpos = -1
-                    if cpos1 != -1 and (cpos1 < cpos2 or cpos2 == -1):
-                        cpos = cpos1
-                        comment_buff = []
-                        state = Parse.BLOCK_COMMENT
-                        eol_options = False
-                    elif cpos2 != -1 and (cpos2 < cpos1 or cpos1 == -1):
-                        cpos = cpos2
-
-                        # Comment after a define may be continued on the following lines
-                        if defmatch is not None and cpos > 10:
-                            state = Parse.EOL_COMMENT
-                            prev_comment = '\n'.join(comment_buff)
-                            comment_buff = []
-                        else:
-                            state = Parse.SLASH_COMMENT
-
-                    # Process the start of a new comment
-                    if cpos != -1:
+                        define_info['comment'] = full_comment
                         comment_buff = []
-                        cline, line = line[cpos+2:].strip(), line[:cpos].strip()
-
-                        if state == Parse.BLOCK_COMMENT:
-                            # Strip leading '*' from block comments
-                            cline = re.sub(r'^\* ?', '', cline)
-                        else:
-                            # Expire end-of-line options after first use
-                            if cline.startswith(':'): eol_options = True
-
-                        # Buffer a non-empty comment start
-                        if cline != '':
-                            options_json, section = use_comment(cline, options_json, section, comment_buff)
-
-                    # If the line has nothing before the comment, go to the next line
-                    if line == '':
-                        options_json = ''
-                        continue
-
-                    # Parenthesize the given expression if needed
-                    def atomize(s):
-                        if s == '' \
-                        or re.match(r'^[A-Za-z0-9_]*(\([^)]+\))?$', s) \
-                        or re.match(r'^[A-Za-z0-9_]+ == \d+?$', s):
-                            return s
-                        return f'({s})'
-
-                    #
-                    # The conditions stack is an array containing condition-arrays.
-                    # Each condition-array lists the conditions for the current block.
-                    # IF/N/DEF adds a new condition-array to the stack.
-                    # ELSE/ELIF/ENDIF pop the condition-array.
-                    # ELSE/ELIF negate the last item in the popped condition-array.
-                    # ELIF adds a new condition to the end of the array.
-                    # ELSE/ELIF re-push the condition-array.
-                    #
-                    cparts = line.split()
-                    iselif, iselse = cparts[0] == '#elif', cparts[0] == '#else'
-                    if iselif or iselse or cparts[0] == '#endif':
-                        if len(conditions) == 0:
-                            raise Exception(f'no #if block at line {line_number}')
-
-                        # Pop the last condition-array from the stack
-                        prev = conditions.pop()
-
-                        if iselif or iselse:
-                            prev[-1] = '!' + prev[-1] # Invert the last condition
-                            if iselif: prev.append(atomize(line[5:].strip()))
-                            conditions.append(prev)
-
-                    elif cparts[0] == '#if':
-                        conditions.append([ atomize(line[3:].strip()) ])
-                    elif cparts[0] == '#ifdef':
-                        conditions.append([ f'defined({line[6:].strip()})' ])
-                    elif cparts[0] == '#ifndef':
-                        conditions.append([ f'!defined({line[7:].strip()})' ])
-
-                    # Handle a complete #define line
-                    elif defmatch is not None:
-
-                        # Get the match groups into vars
-                        enabled, define_name, val = defmatch[1] is None, defmatch[3], defmatch[4]
-
-                        # Increment the serial ID
-                        sid += 1
-
-                        # Create a new dictionary for the current #define
-                        define_info = {
-                            'section': section,
-                            'name': define_name,
-                            'enabled': enabled,
-                            'line': line_start,
-                            'sid': sid
-                        }
-
-                        # Type is based on the value
-                        value_type = \
-                             'switch'  if val == '' \
-                        else 'int'     if re.match(r'^[-+]?\s*\d+$', val) \
-                        else 'ints'    if re.match(r'^([-+]?\s*\d+)(\s*,\s*[-+]?\s*\d+)+$', val) \
-                        else 'floats'  if re.match(rf'({flt}(\s*,\s*{flt})+)', val) \
-                        else 'float'   if re.match(f'^({flt})$', val) \
-                        else 'string'  if val[0] == '"' \
-                        else 'char'    if val[0] == "'" \
-                        else 'bool'    if val in ('true', 'false') \
-                        else 'state'   if val in ('HIGH', 'LOW') \
-                        else 'enum'    if re.match(r'^[A-Za-z0-9_]{3,}$', val) \
-                        else 'int[]'   if re.match(r'^{\s*[-+]?\s*\d+(\s*,\s*[-+]?\s*\d+)*\s*}$', val) \
-                        else 'float[]' if re.match(r'^{{\s*{flt}(\s*,\s*{flt})*\s*}}$', val) \
-                        else 'array'   if val[0] == '{' \
-                        else ''
-
-                        val = (val == 'true')           if value_type == 'bool' \
-                        else int(val)                   if value_type == 'int' \
-                        else val.replace('f','')        if value_type == 'floats' \
-                        else float(val.replace('f','')) if value_type == 'float' \
-                        else val
-
-                        if val != '': define_info['value'] = val
-                        if value_type != '': define_info['type'] = value_type
-
-                        # Join up accumulated conditions with &&
-                        if conditions: define_info['requires'] = '(' + ') && ('.join(sum(conditions, [])) + ')'
-
-                        # If the comment_buff is not empty, add the comment to the info
-                        if comment_buff:
-                            full_comment = '\n'.join(comment_buff).strip()
-
-                            # An EOL comment will be added later
-                            # The handling could go here instead of above
-                            if state == Parse.EOL_COMMENT:
-                                define_info['comment'] = ''
-                            else:
-                                define_info['comment'] = full_comment
-                                comment_buff = []
-
-                            # If the comment specifies units, add that to the info
-                            units = re.match(r'^\(([^)]+)\)', full_comment)
-                            if units:
-                                units = units[1]
-                                if units in ('s', 'sec'): units = 'seconds'
-                                define_info['units'] = units
-
-                        if 'comment' not in define_info or define_info['comment'] == '':
-                            if prev_comment:
-                                define_info['comment'] = prev_comment
-                                prev_comment = ''
-
-                        if 'comment' in define_info and define_info['comment'] == '':
-                            del define_info['comment']
-
-                        # Set the options for the current #define
-                        if define_name == "MOTHERBOARD" and boards != '':
-                            define_info['options'] = boards
-                        elif options_json != '':
-                            define_info['options'] = options_json
-                            if eol_options: options_json = ''
-
-                        # Create section dict if it doesn't exist yet
-                        if section not in sch_out[fk]: sch_out[fk][section] = {}
-
-                        # If define has already been seen...
-                        if define_name in sch_out[fk][section]:
-                            info = sch_out[fk][section][define_name]
-                            if isinstance(info, dict): info = [ info ]  # Convert a single dict into a list
-                            info.append(define_info)                    # Add to the list
-                        else:
-                            # Add the define dict with name as key
-                            sch_out[fk][section][define_name] = define_info
-
-                        if state == Parse.EOL_COMMENT:
-                            last_added_ref = define_info
 
-    return sch_out
+                    # If the comment specifies units, add that to the info
+                    units = units_re.match(full_comment)
+                    if units:
+                        units = units[1]
+                        if units in ('s', 'sec'): units = 'seconds'
+                        define_info['units'] = units
+
+                if 'comment' not in define_info or define_info['comment'] == '':
+                    if prev_comment:
+                        define_info['comment'] = prev_comment
+                        prev_comment = ''
+
+                if 'comment' in define_info and define_info['comment'] == '':
+                    del define_info['comment']
+
+                # Set the options for the current #define
+                if define_name == "MOTHERBOARD" and boards != '':
+                    define_info['options'] = boards
+                elif options_json != '':
+                    define_info['options'] = options_json
+                    if eol_options: options_json = ''
+
+                # Create section dict if it doesn't exist yet
+                if section not in fsch: fsch[section] = {}
+
+                # If define has already been seen...
+                if define_name in fsch[section]:
+                    info = fsch[section][define_name]
+                    if isinstance(info, dict): info = [ info ]  # Convert a single dict into a list
+                    info.append(define_info)                    # Add to the list
+                else:
+                    # Add the define dict with name as key
+                    fsch[section][define_name] = define_info
+
+                if state == EOL_COMMENT:
+                    last_added_ref = define_info
+
+    return sid, state
+
+#
+# Evaluate the conditions of options like the C preprocessor does, to know
+# which options are actually enabled and not only uncommented.
+#
+# Only the configuration files are read, so macros derived in the Conditionals
+# headers (HAS_*, etc.) are unknown. Any result that depends on an unknown
+# macro is None, while 0 && x and 1 || x are still known, as in C.
+#
+
+# Preprocessor tokens: identifier, number, char, string, punctuator
+pp_token_re = re.compile(r'''\s*(?:([A-Za-z_]\w*)|(\.?\d(?:[eEpP][-+]|[\w.])*)|('(?:\\.|[^\\'])*')|("(?:\\.|[^\\"])*")|(##|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%<>!~&|^?:(),#]))''')
+pp_int_re = re.compile(r'^(0[xX][0-9a-fA-F]+|0[bB][01]+|\d+)[uUlL]*$')
+
+# Values that ENABLED() takes as 'on'
+enabled_values = ('', '1', '0x1', 'true')
+
+# Drivers that AXIS_IS_TMC_CONFIG() looks for
+tmc_config_drivers = ('TMC2130', 'TMC2160', 'TMC2208', 'TMC2209', 'TMC2660', 'TMC5130', 'TMC5160')
+
+# Binary operators and their precedence
+binary_ops = {
+    '*': 10, '/': 10, '%': 10, '+': 9, '-': 9, '<<': 8, '>>': 8,
+    '<': 7, '<=': 7, '>': 7, '>=': 7, '==': 6, '!=': 6,
+    '&': 5, '^': 4, '|': 3, '&&': 2, '||': 1
+}
+
+class EvalError(Exception):
+    pass
+
+class CondEvaluator(object):
+    '''
+    A small C preprocessor expression evaluator with Marlin's option macros.
+    macros    - Object-like macros, name -> value text
+    functions - Function-like macros, name -> (params, body text)
+    known     - Names that are defined or not according to 'macros' alone
+    Names that aren't known evaluate as None (unknown) instead of 0.
+    '''
+    def __init__(self, known=()):
+        self.macros = {}
+        self.known = set(known)
+        self.functions = {
+            'TEMP_SENSOR':           ([ 'N' ], 'TEMP_SENSOR_##N'),
+            'TEMP_SENSOR_IS_MAX_TC': ([ 'T' ], '(TEMP_SENSOR(T) == -5 || TEMP_SENSOR(T) == -3 || TEMP_SENSOR(T) == -2)'),
+            'PIN_EXISTS':            ([ 'PN' ], '(defined(PN##_PIN) && PN##_PIN >= 0)')
+        }
+        self.builtins = {
+            'ENABLED':            self.all_enabled,
+            'ALL':                self.all_enabled,
+            'DISABLED':           self.none_enabled,
+            'NONE':               self.none_enabled,
+            'ANY':                self.any_enabled,
+            'EITHER':             self.any_enabled,
+            'BOTH':               self.all_enabled,
+            'MANY':               self.many_enabled,
+            'COUNT_ENABLED':      self.count_enabled,
+            'DGUS_UI_IS':         self.dgus_ui_is,
+            'AXIS_IS_TMC_CONFIG': self.axis_is_tmc
+        }
+
+    def define(self, name, value=''):
+        self.macros[name] = value
+        self.known.add(name)
+
+    def undefine(self, name, known=True):
+        self.macros.pop(name, None)
+        if known: self.known.add(name)
+        else: self.known.discard(name)
+
+    @staticmethod
+    def tokens(text):
+        toks, pos, text = [], 0, text.rstrip()
+        while pos < len(text):
+            m = pp_token_re.match(text, pos)
+            if not m: raise EvalError(f"Bad token in '{text}'")
+            toks.append(m[0].strip())
+            pos = m.end()
+        return toks
+
+    # Split the arguments of a call at toks[i] == '(' into token lists
+    @staticmethod
+    def arguments(toks, i):
+        args, arg, depth = [], [], 0
+        for j in range(i + 1, len(toks)):
+            t = toks[j]
+            if t == ')' and depth == 0:
+                args.append(arg)
+                return args, j + 1
+            if t == ',' and depth == 0:
+                args.append(arg)
+                arg = []
+                continue
+            if t == '(': depth += 1
+            elif t == ')': depth -= 1
+            arg.append(t)
+        raise EvalError("Unterminated macro call")
+
+    # Replace macros until only values and operators remain. None is an unknown value.
+    def expand(self, toks):
+        out, i, budget = [], 0, 1000
+        while i < len(toks):
+            t = toks[i]
+            i += 1
+            if t is None or not (t[0].isalpha() or t[0] == '_'):
+                out.append(t)
+                continue
+            if t == 'defined':
+                paren = i < len(toks) and toks[i] == '('
+                if paren: i += 1
+                if i >= len(toks): raise EvalError("Missing name for 'defined'")
+                name = toks[i]
+                i += 1
+                if paren:
+                    if i >= len(toks) or toks[i] != ')': raise EvalError("Missing ')' after 'defined'")
+                    i += 1
+                out.append(self.is_defined(name))
+                continue
+
+            budget -= 1
+            if budget < 0: raise EvalError("Recursive macro")
+
+            call = i < len(toks) and toks[i] == '('
+            if call and t in self.builtins:
+                args, i = self.arguments(toks, i)
+                out.append(self.builtins[t](args))
+            elif call and t in self.functions:
+                args, i = self.arguments(toks, i)
+                toks, i = self.substitute(t, args) + toks[i:], 0
+            elif t in self.macros:
+                toks, i = self.tokens(self.macros[t]) + toks[i:], 0
+            elif call and t not in self.known:
+                _, i = self.arguments(toks, i)      # A function-like macro from elsewhere
+                out.append(None)
+            else:
+                out.append(t)
+        return out
+
+    # The body of a function-like macro with the arguments in place
+    def substitute(self, name, args):
+        params, body = self.functions[name]
+        values = {}
+        for n, p in enumerate(params):
+            if p.endswith('...'):
+                values[p[:-3]] = sum(([','] + a for a in args[n+1:]), args[n] if n < len(args) else [])
+            else:
+                values[p] = args[n] if n < len(args) else []
+        btoks = self.tokens(body)
+        out = []
+        for n, t in enumerate(btoks):
+            if t in values:
+                pasted = (n > 0 and btoks[n-1] == '##') or (n + 1 < len(btoks) and btoks[n+1] == '##')
+                out += values[t] if pasted else self.expand(values[t])
+            else:
+                out.append(t)
+        # Paste tokens on either side of ##
+        pasted, glue = [], False
+        for t in out:
+            if t == '##':
+                glue = True
+            elif glue and pasted:
+                pasted[-1] = (pasted[-1] or '') + (t or '')
+                glue = False
+            else:
+                pasted.append(t)
+        return pasted
+
+    def is_defined(self, name):
+        if name in self.macros: return '1'
+        return '0' if name in self.known else None
+
+    # Is a single option enabled? True, False or None.
+    def option_state(self, arg):
+        toks = self.expand(arg)
+        if None in toks: return None
+        text = ''.join(toks)
+        if text in enabled_values: return True
+        if len(toks) == 1 and (toks[0][0].isalpha() or toks[0][0] == '_') and toks[0] not in self.known: return None
+        return False
+
+    def states(self, args):
+        return [ self.option_state(a) for a in args if a ]
+
+    def all_enabled(self, args):
+        s = self.states(args)
+        return '0' if False in s else None if None in s else '1'
+
+    def none_enabled(self, args):
+        s = self.states(args)
+        return '0' if True in s else None if None in s else '1'
+
+    def any_enabled(self, args):
+        s = self.states(args)
+        return '1' if True in s else None if None in s else '0'
+
+    def many_enabled(self, args):
+        s = self.states(args)
+        if s.count(True) > 1: return '1'
+        return '0' if s.count(True) + s.count(None) <= 1 else None
+
+    def count_enabled(self, args):
+        s = self.states(args)
+        return None if None in s else str(s.count(True))
+
+    def dgus_ui_is(self, args):
+        ui = self.expand([ 'DGUS_LCD_UI' ])
+        if None in ui: return None
+        return '1' if ''.join(ui) in (''.join(a) for a in args) else '0'
+
+    def axis_is_tmc(self, args):
+        axis = ''.join(args[0]) if args else ''
+        driver = self.expand([ axis + '_DRIVER_TYPE' ])
+        if None in driver: return None
+        if ''.join(driver) not in tmc_config_drivers: return '0'
+        # Extra steppers also depend on derived macros like NUM_Z_STEPPERS
+        return '1' if axis in 'XYZIJKUVW' else None
+
+    # Evaluate an expanded token list, with C operator precedence
+    def evaluate(self, toks):
+        self.toks, self.pos = toks, 0
+        val = self.ternary()
+        if self.pos < len(self.toks): raise EvalError(f"Unexpected '{self.toks[self.pos]}'")
+        return val
+
+    def peek(self):
+        return self.toks[self.pos] if self.pos < len(self.toks) else ''
+
+    def take(self, tok):
+        if self.peek() != tok: raise EvalError(f"Expected '{tok}'")
+        self.pos += 1
+
+    def ternary(self):
+        cond = self.binary(1)
+        if self.peek() != '?': return cond
+        self.pos += 1
+        a = self.ternary()
+        self.take(':')
+        b = self.ternary()
+        if cond is None: return a if a == b else None
+        return a if cond else b
+
+    def binary(self, prec):
+        left = self.unary()
+        while True:
+            op = self.peek()
+            oprec = binary_ops.get(op) if isinstance(op, str) else None
+            if oprec is None or oprec < prec: return left
+            self.pos += 1
+            left = self.apply(op, left, self.binary(oprec + 1))
+
+    @staticmethod
+    def apply(op, a, b):
+        # Logical operators know their result from one side if it's 0 (&&) or non-0 (||)
+        if op == '&&':
+            if a == 0 or b == 0: return 0
+            return None if a is None or b is None else 1
+        if op == '||':
+            if a or b: return 1
+            return None if a is None or b is None else 0
+        if a is None or b is None: return None
+        if op in ('/', '%'):
+            if b == 0: return None      # An error, unless skipped by && or ||
+            q = abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+            return q if op == '/' else a - q * b
+        return {
+            '*': lambda: a * b, '+': lambda: a + b, '-': lambda: a - b,
+            '<<': lambda: a << b, '>>': lambda: a >> b,
+            '<': lambda: int(a < b), '<=': lambda: int(a <= b), '>': lambda: int(a > b), '>=': lambda: int(a >= b),
+            '==': lambda: int(a == b), '!=': lambda: int(a != b),
+            '&': lambda: a & b, '^': lambda: a ^ b, '|': lambda: a | b
+        }[op]()
+
+    def unary(self):
+        tok = self.peek()
+        if tok in ('!', '~', '-', '+'):
+            self.pos += 1
+            val = self.unary()
+            if val is None: return None
+            return int(not val) if tok == '!' else ~val if tok == '~' else -val if tok == '-' else val
+        if tok == '(':
+            self.pos += 1
+            val = self.ternary()
+            self.take(')')
+            return val
+        return self.primary()
+
+    def primary(self):
+        if self.pos >= len(self.toks): raise EvalError("Missing value")
+        tok = self.toks[self.pos]
+        self.pos += 1
+        if tok is None: return None
+        if tok[0].isdigit() or tok[0] == '.':
+            m = pp_int_re.match(tok)
+            if not m: raise EvalError(f"Not an integer: {tok}")
+            num = m[1]
+            return int(num, 8) if len(num) > 1 and num[0] == '0' and num[1].isdigit() else int(num, 0)
+        if tok[0] == "'":
+            ch = tok[1:-1]
+            if len(ch) == 1: return ord(ch)
+            esc = { '\\n': 10, '\\t': 9, '\\r': 13, '\\0': 0, "\\'": 39, '\\"': 34, '\\\\': 92 }
+            if ch in esc: return esc[ch]
+            raise EvalError(f"Unsupported character {tok}")
+        if tok[0].isalpha() or tok[0] == '_':
+            if tok in ('true', 'false'): return int(tok == 'true')
+            return 0 if tok in self.known else None
+        raise EvalError(f"Unexpected '{tok}'")
+
+    def test(self, expr):
+        '''
+        Is the condition true? True, False, or None if it can't be known.
+        '''
+        if not expr: return True
+        try:
+            val = self.evaluate(self.expand(self.tokens(expr)))
+        except EvalError:
+            return None
+        return None if val is None else bool(val)
+
+#
+# Get the effective state of every #define from extract_lines, in order:
+#  True  - Uncommented and its conditions are met
+#  False - Commented out or its conditions aren't met
+#  None  - Uncommented, but the conditions depend on unknown macros
+# 'macros' are other known macros, like the BOARD_* values.
+# Return a dict of sid -> state.
+#
+def evaluate_defines(defines, macros=None):
+    ev = CondEvaluator(set(d[1] for d in defines))
+    for name, value in (macros or {}).items(): ev.define(name, value)
+    effective = {}
+    for sid, name, enabled, value, requires in defines:
+        state = ev.test(requires) if enabled else False
+        if state:
+            ev.define(name, value)
+        elif state is None:
+            ev.undefine(name, known=False)
+        effective[sid] = state
+    return effective
 
 #
 # Extract the current configuration files in the form of a structured schema.
 #
-def extract():
+def extract(cache_dir=None, evaluate=False):
     # List of files to process, with shorthand
-    return extract_files({ 'Configuration.h':'basic', 'Configuration_adv.h':'advanced' })
+    return extract_files({ 'Configuration.h':'basic', 'Configuration_adv.h':'advanced' }, cache_dir, evaluate)
+
+#
+# The schema as JSON text, exactly as json.dump(indent=2, ensure_ascii=False) would write it,
+# in pieces down to the given depth. Scalars use the C encoder, unlike json.dump with an indent.
+#
+def iter_json(obj, depth=0, pieces=3):
+    if depth >= pieces or not isinstance(obj, dict) or not obj:
+        yield json_text(obj, depth)
+        return
+    indent = '\n' + '  ' * (depth + 1)
+    sep = '{' + indent
+    for key, val in obj.items():
+        yield sep + json_key(key) + ': '
+        yield from iter_json(val, depth + 1, pieces)
+        sep = ',' + indent
+    yield '\n' + '  ' * depth + '}'
+
+def json_text(obj, depth=0):
+    if isinstance(obj, dict):
+        if not obj: return '{}'
+        indent = ',\n' + '  ' * (depth + 1)
+        items = [ json_key(key) + ': ' + json_text(val, depth + 1) for key, val in obj.items() ]
+        return '{' + indent[1:] + indent.join(items) + '\n' + '  ' * depth + '}'
+    if isinstance(obj, (list, tuple)):
+        if not obj: return '[]'
+        indent = ',\n' + '  ' * (depth + 1)
+        items = [ json_text(val, depth + 1) for val in obj ]
+        return '[' + indent[1:] + indent.join(items) + '\n' + '  ' * depth + ']'
+    return json_scalar(obj)
+
+json_encoder = json.JSONEncoder(ensure_ascii=False)
+
+def json_scalar(obj):
+    if isinstance(obj, str): return json_string(obj)
+    if obj is True: return 'true'
+    if obj is False: return 'false'
+    if obj is None: return 'null'
+    if type(obj) is int: return int.__repr__(obj)
+    return json_encoder.encode(obj)
+
+json_string = json.encoder.encode_basestring
+
+# Object keys are strings in JSON
+def json_key(key):
+    if isinstance(key, str): return json_scalar(key)
+    if key is not None and not isinstance(key, (bool, int, float)):
+        raise TypeError(f"Keys must be str, int, float, bool or None, not {type(key).__name__}")
+    return json_scalar(json_scalar(key))
 
 def dump_json(schema:dict, jpath:Path):
     with jpath.open('w', encoding='utf-8') as jfile:
-        json.dump(schema, jfile, ensure_ascii=False, indent=2)
+        jfile.writelines(iter_json(schema))
 
 def dump_yaml(schema:dict, ypath:Path):
     import yaml
@@ -454,40 +995,92 @@ def dump_yaml(schema:dict, ypath:Path):
 
     yaml.add_representer(str, str_literal_representer)
 
+    # Emit the top two levels as events and each section as a whole,
+    # so the section is written before the next one is represented.
+    # The output is the same as yaml.dump with sorted keys.
     with ypath.open('w', encoding='utf-8') as yfile:
-        yaml.dump(schema, yfile, default_flow_style=False, width=120, indent=2)
+        dumper = yaml.Dumper(yfile, default_flow_style=False, width=120, indent=2)
+
+        def emit_data(data):
+            node = dumper.represent_data(data)
+            dumper.represented_objects, dumper.object_keeper, dumper.alias_key = {}, [], None
+            dumper.anchor_node(node)
+            dumper.serialize_node(node, None, None)
+            dumper.anchors, dumper.serialized_nodes = {}, {}
+
+        def start_mapping():
+            dumper.emit(yaml.MappingStartEvent(anchor=None, tag='tag:yaml.org,2002:map', implicit=True, flow_style=False))
+
+        try:
+            dumper.open()
+            dumper.emit(yaml.DocumentStartEvent(explicit=dumper.use_explicit_start, version=dumper.use_version, tags=dumper.use_tags))
+            start_mapping()
+            for filekey, fsch in sorted(schema.items()):
+                emit_data(filekey)
+                start_mapping()
+                for sectkey, sect in sorted(fsch.items()):
+                    emit_data(sectkey)
+                    emit_data(sect)
+                dumper.emit(yaml.MappingEndEvent())
+            dumper.emit(yaml.MappingEndEvent())
+            dumper.emit(yaml.DocumentEndEvent(explicit=dumper.use_explicit_end))
+            dumper.close()
+        finally:
+            dumper.dispose()
+
+# Compact binary schema with an index by option name. Read it with schema_pack.SchemaPack.
+def dump_pack(schema:dict, ppath:Path):
+    import schema_pack
+    with ppath.open('wb') as pfile:
+        schema_pack.write_pack(schema, pfile)
 
 def main():
+    # Get the command line arguments after the script name
+    import sys
+    args = sys.argv[1:]
+    if len(args) == 0: args = ['some']
+
     try:
-        schema = extract()
+        schema = extract(Path('.pio', 'schema'), 'enabled' in args)
     except Exception as exc:
         print("Error: " + str(exc))
         schema = None
 
     if schema:
 
-        # Get the command line arguments after the script name
-        import sys
-        args = sys.argv[1:]
-        if len(args) == 0: args = ['some']
-
         # Does the given array intersect at all with args?
         def inargs(c): return len(set(args) & set(c)) > 0
 
         # Help / Unknown option
-        unk = not inargs(['some','json','jsons','group','yml','yaml'])
+        unk = not inargs(['some','json','jsons','group','yml','yaml','pack','enabled'])
         if (unk): print(f"Unknown option: '{args[0]}'")
         if inargs(['-h', '--help']) or unk:
-            print("Usage: schema.py [some|json|jsons|group|yml|yaml]...")
-            print("       some  = json + yml")
-            print("       jsons = json + group")
+            print("Usage: schema.py [some|json|jsons|group|yml|yaml|pack|enabled]...")
+            print("       some    = json + yml")
+            print("       jsons   = json + group")
+            print("       pack    = Binary schema with an index by option name (see schema_pack.py)")
+            print("       enabled = List the options that are effectively enabled (? = can't tell)")
             return
 
+        # Effectively enabled options
+        if inargs(['enabled']):
+            for fsch in schema.values():
+                for sect in fsch.values():
+                    for name, info in sect.items():
+                        for define_info in info if isinstance(info, list) else [ info ]:
+                            if define_info['effective'] is not False:
+                                print(('' if define_info['effective'] else '? ') + f"{name} {define_info.get('value', '')}".rstrip())
+
         # JSON schema
         if inargs(['some', 'json', 'jsons']):
             print("Generating JSON ...")
             dump_json(schema, Path('schema.json'))
 
+        # Binary schema, indexed by option name
+        if inargs(['pack']):
+            print("Generating schema.pack ...")
+            dump_pack(schema, Path('schema.pack'))
+
         # JSON schema (wildcard names)
         if inargs(['group', 'jsons']):
             group_options(schema)
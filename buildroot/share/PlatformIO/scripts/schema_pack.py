@@ -0,0 +1,281 @@
+#
+# schema_pack.py
+#
+# A compact binary form of the schema made by schema.py, for tools that only
+# need a few options at a time. The options are MessagePack-encoded and can
+# be looked up by name through a sorted index, without reading the rest.
+#
+# Layout (little-endian):
+#   Header      '<4sHHIIII' : magic 'MSCP', version, 0, option count,
+#                             offset of the sections, names and index
+#   Records     One MessagePack array per option: [ section number, info ]
+#   Sections    MessagePack array of [ filekey, sectkey ], by section number
+#   Names       The UTF-8 option names, back to back
+#   Index       '<IIII' per option: name offset, name length, record offset,
+#               record length. Sorted by name, then by record offset.
+#
+# Records are in schema order, so the whole schema can also be read back.
+# Any MessagePack decoder can read a record, with no need for this module.
+#
+# Usage:
+#   with SchemaPack('schema.pack') as pack:
+#       for filekey, sectkey, info in pack.find('X_BED_SIZE'): ...
+#
+import mmap, struct
+
+PACK_MAGIC = b'MSCP'
+PACK_VERSION = 1
+
+header_struct = struct.Struct('<4sHHIIII')
+index_struct = struct.Struct('<IIII')
+
+#
+# MessagePack encoding of the types found in a schema
+#
+def pack_value(obj, out:bytearray):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True or obj is False:
+        out.append(0xc3 if obj else 0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -0x20 <= obj < 0:
+            out.append(obj & 0xff)
+        elif obj > 0:
+            if obj < 0x100: out += bytes((0xcc, obj))
+            elif obj < 0x10000: out += b'\xcd' + struct.pack('>H', obj)
+            elif obj < 0x100000000: out += b'\xce' + struct.pack('>I', obj)
+            elif obj < 0x10000000000000000: out += b'\xcf' + struct.pack('>Q', obj)
+            else: raise OverflowError(f"Integer too large to pack: {obj}")
+        else:
+            if obj >= -0x80: out += b'\xd0' + struct.pack('>b', obj)
+            elif obj >= -0x8000: out += b'\xd1' + struct.pack('>h', obj)
+            elif obj >= -0x80000000: out += b'\xd2' + struct.pack('>i', obj)
+            elif obj >= -0x8000000000000000: out += b'\xd3' + struct.pack('>q', obj)
+            else: raise OverflowError(f"Integer too large to pack: {obj}")
+    elif isinstance(obj, float):
+        out += b'\xcb' + struct.pack('>d', obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        n = len(data)
+        if n < 0x20: out.append(0xa0 | n)
+        elif n < 0x100: out += bytes((0xd9, n))
+        elif n < 0x10000: out += b'\xda' + struct.pack('>H', n)
+        else: out += b'\xdb' + struct.pack('>I', n)
+        out += data
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 0x10: out.append(0x90 | n)
+        elif n < 0x10000: out += b'\xdc' + struct.pack('>H', n)
+        else: out += b'\xdd' + struct.pack('>I', n)
+        for item in obj: pack_value(item, out)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 0x10: out.append(0x80 | n)
+        elif n < 0x10000: out += b'\xde' + struct.pack('>H', n)
+        else: out += b'\xdf' + struct.pack('>I', n)
+        for key, item in obj.items():
+            pack_value(key, out)
+            pack_value(item, out)
+    else:
+        raise TypeError(f"Can't pack {type(obj).__name__}")
+
+def packb(obj):
+    out = bytearray()
+    pack_value(obj, out)
+    return bytes(out)
+
+# Fixed-size values by type byte: (struct format, size)
+fixed_types = {
+    0xca: ('>f', 4), 0xcb: ('>d', 8),
+    0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+    0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8)
+}
+# Lengths of str, bin, array and map by type byte: (kind, struct format, size)
+sized_types = {
+    0xd9: ('str', '>B', 1), 0xda: ('str', '>H', 2), 0xdb: ('str', '>I', 4),
+    0xc4: ('bin', '>B', 1), 0xc5: ('bin', '>H', 2), 0xc6: ('bin', '>I', 4),
+    0xdc: ('array', '>H', 2), 0xdd: ('array', '>I', 4),
+    0xde: ('map', '>H', 2), 0xdf: ('map', '>I', 4)
+}
+
+#
+# Decode the MessagePack value at buf[pos], return (value, next pos)
+#
+def unpack_value(buf, pos=0):
+    b = buf[pos]
+    pos += 1
+    if b < 0x80: return b, pos
+    if b >= 0xe0: return b - 0x100, pos
+    if b == 0xc0: return None, pos
+    if b == 0xc2: return False, pos
+    if b == 0xc3: return True, pos
+    if b in fixed_types:
+        fmt, size = fixed_types[b]
+        return struct.unpack_from(fmt, buf, pos)[0], pos + size
+    if 0xa0 <= b < 0xc0:
+        kind, n = 'str', b & 0x1f
+    elif 0x90 <= b < 0xa0:
+        kind, n = 'array', b & 0x0f
+    elif 0x80 <= b < 0x90:
+        kind, n = 'map', b & 0x0f
+    elif b in sized_types:
+        kind, fmt, size = sized_types[b]
+        n = struct.unpack_from(fmt, buf, pos)[0]
+        pos += size
+    else:
+        raise ValueError(f"Unsupported MessagePack type 0x{b:02x} at {pos - 1}")
+
+    if kind == 'str': return bytes(buf[pos:pos+n]).decode('utf-8'), pos + n
+    if kind == 'bin': return bytes(buf[pos:pos+n]), pos + n
+    if kind == 'array':
+        items = []
+        for _ in range(n):
+            item, pos = unpack_value(buf, pos)
+            items.append(item)
+        return items, pos
+    mapping = {}
+    for _ in range(n):
+        key, pos = unpack_value(buf, pos)
+        mapping[key], pos = unpack_value(buf, pos)
+    return mapping, pos
+
+def unpackb(data):
+    return unpack_value(data)[0]
+
+#
+# Write a schema to an open binary file, one option at a time
+#
+def write_pack(schema:dict, pfile):
+    sections, names, index = [], bytearray(), []
+    pfile.write(header_struct.pack(PACK_MAGIC, PACK_VERSION, 0, 0, 0, 0, 0))
+    pos = header_struct.size
+    for filekey, fsch in schema.items():
+        for sectkey, sect in fsch.items():
+            snum = len(sections)
+            sections.append([ filekey, sectkey ])
+            for name, info in sect.items():
+                record = packb([ snum, info ])
+                pfile.write(record)
+                bname = name.encode('utf-8')
+                index.append((bname, pos, len(record)))
+                pos += len(record)
+
+    sections_offset = pos
+    pfile.write(packb(sections))
+    names_offset = pfile.tell()
+
+    index.sort(key=lambda e: (e[0], e[1]))
+    table = bytearray()
+    for bname, rpos, rlen in index:
+        table += index_struct.pack(len(names), len(bname), rpos, rlen)
+        names += bname
+    pfile.write(names)
+    index_offset = pfile.tell()
+    pfile.write(table)
+
+    pfile.seek(0)
+    pfile.write(header_struct.pack(PACK_MAGIC, PACK_VERSION, 0, len(index), sections_offset, names_offset, index_offset))
+
+class SchemaPack(object):
+    '''
+    Read-only access to a packed schema, mapped into memory.
+    Only the header and section list are read up front.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as pfile:
+            self.buf = mmap.mmap(pfile.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buf) < header_struct.size:
+            raise ValueError(f"{path}: Not a schema pack")
+        magic, version, _, self.count, self.sections_offset, self.names_offset, self.index_offset = header_struct.unpack_from(self.buf)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError(f"{path}: Not a schema pack, or an unsupported version")
+        self.sections = unpack_value(self.buf, self.sections_offset)[0]
+
+    def close(self):
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, n):
+        return index_struct.unpack_from(self.buf, self.index_offset + n * index_struct.size)
+
+    def entry_name(self, n):
+        noff, nlen, _, _ = self.entry(n)
+        start = self.names_offset + noff
+        return self.buf[start:start+nlen]
+
+    def record(self, n):
+        '''
+        The option at index position n as (filekey, sectkey, info)
+        '''
+        _, _, rpos, _ = self.entry(n)
+        snum, info = unpack_value(self.buf, rpos)[0]
+        filekey, sectkey = self.sections[snum]
+        return filekey, sectkey, info
+
+    # First index position with a name not less than 'bname'
+    def lower_bound(self, bname):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry_name(mid) < bname: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def find(self, name):
+        '''
+        All options with the given name, in schema order, as (filekey, sectkey, info)
+        '''
+        bname = name.encode('utf-8')
+        found = []
+        n = self.lower_bound(bname)
+        while n < self.count and self.entry_name(n) == bname:
+            found.append(self.record(n))
+            n += 1
+        return found
+
+    def get(self, name, default=None):
+        '''
+        The info of the first option with the given name
+        '''
+        found = self.find(name)
+        return found[0][2] if found else default
+
+    def __contains__(self, name):
+        bname = name.encode('utf-8')
+        n = self.lower_bound(bname)
+        return n < self.count and self.entry_name(n) == bname
+
+    def names(self):
+        '''
+        All option names, sorted
+        '''
+        return [ self.entry_name(n).decode('utf-8') for n in range(self.count) ]
+
+    def to_schema(self):
+        '''
+        Read the whole schema back, in its original order
+        '''
+        names = {}
+        for n in range(self.count):
+            noff, nlen, rpos, _ = self.entry(n)
+            names[rpos] = self.buf[self.names_offset+noff:self.names_offset+noff+nlen].decode('utf-8')
+        schema = {}
+        for filekey, sectkey in self.sections:
+            schema.setdefault(filekey, {})[sectkey] = {}
+        pos = header_struct.size
+        while pos < self.sections_offset:
+            name = names[pos]
+            (snum, info), pos = unpack_value(self.buf, pos)
+            filekey, sectkey = self.sections[snum]
+            schema[filekey][sectkey][name] = info
+        return schema
@@ -202,7 +202,7 @@ def compute_build_signature(env):
     # Get the schema class for exports that require it
     if config_dump in (3, 4) or (extended_dump and config_dump in (2, 5)):
         try:
-            conf_schema = schema.extract()
+            conf_schema = schema.extract(build_path / 'schema')
         except Exception as exc:
             print(red + "Error: " + str(exc))
             conf_schema = None
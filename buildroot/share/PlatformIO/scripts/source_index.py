@@ -0,0 +1,198 @@
+#
+# source_index.py
+#
+# Index of the source files under Marlin/src, for build_src_filter resolution
+# without walking the tree for every pattern. The index is kept on disk and
+# rebuilt when the mtime of any indexed directory changes, which happens when
+# files or folders are added, removed or renamed in it.
+#
+import os, re, json, bisect
+
+verbose = 0
+
+def blab(str):
+    if verbose:
+        print(str)
+
+# Files PlatformIO compiles. Directories are only collapsed when all of these are included.
+SOURCE_EXT = re.compile(r'[.](c|cc|cpp|cxx|S|s|sx|spp|SPP|asm|ASM)$')
+
+INDEX_VERSION = 1
+
+# Match paths like the file system (and glob) does
+CASE_INSENSITIVE = os.path.normcase('A') == 'a'
+def path_key(path):
+    return path.lower() if CASE_INSENSITIVE else path
+
+#
+# Translate a glob pattern (as used by glob.glob with recursive=True) to a regex
+# matching '/'-separated relative paths. '**' as a whole component matches any
+# number of folders, '*' and '?' don't match '/'.
+#
+def glob_regex(pattern):
+    parts = pattern.split('/')
+    out = ''
+    for n, part in enumerate(parts):
+        last = n == len(parts) - 1
+        if part == '**':
+            out += '.*' if last else '(?:[^/]+/)*'
+            continue
+        i = 0
+        while i < len(part):
+            c = part[i]
+            i += 1
+            if c == '*':
+                out += '[^/]*'
+            elif c == '?':
+                out += '[^/]'
+            elif c == '[':
+                # A set, as in fnmatch. Without a closing ']' it's a plain '['.
+                j = i
+                if j < len(part) and part[j] == '!': j += 1
+                if j < len(part) and part[j] == ']': j += 1
+                while j < len(part) and part[j] != ']': j += 1
+                if j >= len(part):
+                    out += '\\['
+                    continue
+                stuff = part[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                elif stuff.startswith('^'):
+                    stuff = '\\' + stuff
+                out += '[' + stuff + ']'
+            else:
+                out += re.escape(c)
+        if not last:
+            out += '/'
+    flags = re.IGNORECASE if CASE_INSENSITIVE else 0
+    return re.compile('(?s:' + out + r')\Z', flags)
+
+class SourceIndex(object):
+    '''
+    Source files under 'top' (a folder of 'base') as '/'-separated paths
+    relative to 'base', with the mtime of every folder for invalidation.
+    '''
+    def __init__(self, base, top, dirs, files):
+        self.base = base
+        self.top = top
+        self.dirs = dirs        # relative path -> mtime_ns
+        self.files = files      # relative paths, in walk order
+        self.sorted = sorted(files, key=path_key)
+        self.keys = [ path_key(f) for f in self.sorted ]
+        self.dir_keys = set(path_key(d) for d in dirs)
+        self.file_keys = dict(zip(self.keys, self.sorted))
+
+    @staticmethod
+    def scan(base, top='src'):
+        dirs, files = {}, []
+        for root, dirnames, filenames in os.walk(os.path.join(base, top)):
+            # Like glob, skip hidden entries
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            rel = os.path.relpath(root, base).replace(os.sep, '/')
+            dirs[rel] = os.stat(root).st_mtime_ns
+            files += [ rel + '/' + f for f in sorted(filenames) if not f.startswith('.') and SOURCE_EXT.search(f) ]
+        return SourceIndex(base, top, dirs, files)
+
+    def is_current(self):
+        try:
+            return all(os.stat(os.path.join(self.base, d)).st_mtime_ns == mtime for d, mtime in self.dirs.items())
+        except OSError:
+            return False
+
+    def covers(self, pattern):
+        # Can the pattern be evaluated against the index?
+        parts = pattern.rstrip('/').split('/')
+        return parts[0] == self.top and not any(p in ('', '.', '..') for p in parts)
+
+    def isdir(self, path):
+        return path_key(path.rstrip('/')) in self.dir_keys
+
+    def starting_with(self, prefix):
+        prefix = path_key(prefix)
+        i = bisect.bisect_left(self.keys, prefix)
+        j = bisect.bisect_left(self.keys, prefix + '\U0010ffff')
+        return self.sorted[i:j]
+
+    def under(self, path):
+        return self.starting_with(path.rstrip('/') + '/')
+
+    def match(self, pattern):
+        if pattern.endswith('/'): return []     # Only matches folders
+        # Only the files under the folders named before the first wildcard can match
+        parts = pattern.split('/')
+        literal = 0
+        while literal < len(parts) and not re.search(r'[*?[]', parts[literal]):
+            literal += 1
+        if literal == len(parts):
+            f = self.file_keys.get(path_key(pattern))
+            return [ f ] if f else []
+        r = glob_regex(pattern)
+        return [ f for f in self.starting_with('/'.join(parts[:literal]) + '/') if r.match(f) ]
+
+    def collapse(self, selected):
+        '''
+        The selected files as a short list of files and folders: a folder is
+        listed instead of its contents when all of its source files are selected.
+        Selected files not in the index are listed as they are.
+        '''
+        selected = set(f.replace(os.sep, '/') for f in selected)
+        total, chosen, children, own = {}, {}, {}, {}
+        for d in self.dirs:
+            parent = d.rpartition('/')[0]
+            if d != self.top: children.setdefault(parent, []).append(d)
+        for f in self.files:
+            d = f.rpartition('/')[0]
+            on = f in selected
+            if on: own.setdefault(d, []).append(f)
+            while True:
+                total[d] = total.get(d, 0) + 1
+                chosen[d] = chosen.get(d, 0) + on
+                if d == self.top: break
+                d = d.rpartition('/')[0]
+
+        result = []
+        def emit(d):
+            if not chosen.get(d): return
+            if chosen[d] == total[d]:
+                result.append(d)
+                return
+            result.extend(own.get(d, []))
+            for c in sorted(children.get(d, [])):
+                emit(c)
+        emit(self.top)
+
+        indexed = set(self.files)
+        result += sorted(f for f in selected if f not in indexed)
+        return [ os.path.normpath(p) for p in result ]
+
+    def save(self, path):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({ 'version': INDEX_VERSION, 'base': os.path.abspath(self.base), 'top': self.top,
+                            'dirs': self.dirs, 'files': self.files }, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+#
+# Get the index of base/top from the cache file, rescanning the tree if it changed
+#
+def load_source_index(base, cache_file, top='src'):
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+        if data['version'] == INDEX_VERSION and data['base'] == os.path.abspath(base) and data['top'] == top:
+            index = SourceIndex(base, top, data['dirs'], data['files'])
+            if index.is_current():
+                blab("Source index from cache")
+                return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    blab("Indexing %s" % os.path.join(base, top))
+    index = SourceIndex.scan(base, top)
+    index.save(cache_file)
+    return index
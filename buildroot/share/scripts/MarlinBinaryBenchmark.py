@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+#
+# MarlinBinaryBenchmark.py
+# Micro-benchmarks for the host side of MarlinBinaryProtocol.
+#
+# Usage: MarlinBinaryBenchmark.py checksum [-s SIZE] [-n ROUNDS]
+#   Verify the Fletcher-16 backends against the reference routine and report MB/s.
+#
+# Usage: MarlinBinaryBenchmark.py responses [-n LINES] [-r READ_SIZE]
+#   Split and dispatch client responses (acks, echo and file transfer replies) as the receive
+#   worker does, against a readline-per-response baseline, and report lines/s.
+#
+# Usage: MarlinBinaryBenchmark.py transfer [-s SIZE] [-b 128,256,512] [-c on,off,auto] [-w WINDOW] [--cache DIR]
+#                                 [--baud BAUD] [--latency MS] [--loss P] [--corrupt P] [--json] [--trace FILE]
+#   Transfer through an emulated printer (MarlinBinaryEmulator, run in its own process) for each
+#   block size and compression setting, reporting KiB/s, packets/s, retries and host CPU time.
+#   --cache keeps the compressed file in DIR between runs, --trace appends the per-packet
+#   telemetry of every run to FILE as JSON lines.
+#
+import sys, os, io, time, random, argparse, json, zlib, tempfile, contextlib, multiprocessing
+import MarlinBinaryProtocol, MarlinBinaryEmulator
+
+def reference_checksum(buffer, cs = 0):
+    # Byte-at-a-time routine, as in Protocol.checksum and the firmware
+    for b in buffer:
+        cs_low = ((cs & 0xFF) + b) % 255
+        cs = ((((cs >> 8) + cs_low) % 255) << 8) | cs_low
+    return cs
+
+def checksum_backends():
+    backends = { 'reference': reference_checksum, 'python': MarlinBinaryProtocol.fletcher16_python }
+    if MarlinBinaryProtocol.numpy_exists:
+        backends['numpy'] = MarlinBinaryProtocol.fletcher16_numpy
+    backends['fletcher16'] = MarlinBinaryProtocol.fletcher16
+    return backends
+
+def verify_checksum(backends, cases):
+    '''
+    Property check: every backend matches the reference routine for random
+    buffers of random length, starting from a random running checksum.
+    Edge cases (empty buffers, 0xFF bytes, saturated sums) are always included.
+    '''
+    rng = random.Random(0x5AD)
+    samples = [ (b'', 0), (b'', 0xFEFE), (b'\xFF' * 4096, 0), (b'\x00' * 700, 0xFFFF), (b'\xFF', 0x00FF) ]
+    for _ in range(cases):
+        size = rng.choice((rng.randint(0, 16), rng.randint(0, 600), rng.randint(0, 70000)))
+        samples.append((bytes(rng.getrandbits(8) for _ in range(size)), rng.choice((0, rng.randint(0, 0xFFFF)))))
+
+    for data, cs in samples:
+        expect = reference_checksum(data, cs)
+        for name, fn in backends.items():
+            for buffer in (data, bytearray(data), memoryview(data)):
+                got = fn(buffer, cs)
+                if got != expect:
+                    print("Mismatch: {0} size {1} cs {2:#06x}: {3:#06x} != {4:#06x}".format(name, len(data), cs, got, expect))
+                    return False
+    print("{0} backends bit-identical over {1} buffers".format(len(backends), len(samples)))
+    return True
+
+def bench_checksum(args):
+    backends = checksum_backends()
+    if not verify_checksum(backends, args.cases):
+        return 1
+
+    data = bytes(random.getrandbits(8) for _ in range(args.size))
+    print("{0:12} {1:>10} {2:>10}".format('backend', 'MB/s', 'us/packet'))
+    for name, fn in backends.items():
+        rounds = max(args.rounds // 100, 1) if name == 'reference' else args.rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn(data)
+        elapsed = time.perf_counter() - start
+        print("{0:12} {1:10.2f} {2:10.2f}".format(name, len(data) * rounds / elapsed / 1e6, elapsed / rounds * 1e6))
+    return 0
+
+def response_lines(count, seed = 0x5AD):
+    # A chatty transfer: acks interleaved with echo output and the odd file transfer reply
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.6: lines.append('ok{0}'.format(i % 256))
+        elif kind < 0.9: lines.append('echo:Packet({0}) payload corrupt'.format(i % 256))
+        elif kind < 0.95: lines.append('rs{0}'.format(i % 256))
+        else: lines.append('PFT:success')
+    return ('\n'.join(lines) + '\n').encode('utf8')
+
+def bench_responses(args):
+    data = response_lines(args.lines)
+    counts = {}
+    def counter(name):
+        def callback(response): counts[name] = counts.get(name, 0) + 1
+        return callback
+
+    # The Protocol's dispatch without a serial port behind it
+    protocol = MarlinBinaryProtocol.Protocol.__new__(MarlinBinaryProtocol.Protocol)
+    protocol.applications = []
+    protocol.register(['ok', 'rs', 'ss', 'fe'], counter('protocol'))
+    protocol.register(['PFT:success', 'PFT:version:', 'PFT:fail', 'PFT:busy', 'PFT:ioerror', 'PTF:invalid', 'PFT:checksum:'], counter('filetransfer'))
+    protocol.register(['echo:'], counter('echo'))
+
+    def linear_dispatch(line):
+        for tokens, callback in protocol.applications:
+            for token in tokens:
+                if token == line[:len(token)]:
+                    callback((token, line[len(token):]))
+                    return
+
+    class RawPort(io.RawIOBase):
+        # Like serial.Serial, a raw stream: readline() reads it a byte at a time (minus the syscalls)
+        def __init__(self, data):
+            self.data, self.position = data, 0
+        def readable(self):
+            return True
+        def readinto(self, buffer):
+            count = min(len(buffer), len(self.data) - self.position)
+            buffer[:count] = self.data[self.position:self.position + count]
+            self.position += count
+            return count
+
+    def readline_baseline():
+        # One readline, decode and linear token scan per response
+        source = RawPort(data)
+        for raw in iter(source.readline, b''):
+            linear_dispatch(raw.decode('utf8').rstrip())
+
+    def bulk_reader():
+        reader = MarlinBinaryProtocol.LineReader()
+        for start in range(0, len(data), args.read_size):
+            for line in reader.feed(data[start:start + args.read_size]):
+                protocol.dispatch(line)
+
+    results = {}
+    for name, fn in (('readline', readline_baseline), ('bulk', bulk_reader)):
+        counts.clear()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        results[name] = dict(counts)
+        print("{0:10} {1:12.0f} lines/s {2}".format(name, args.lines / elapsed, dict(sorted(counts.items()))))
+    if results['readline'] != results['bulk']:
+        print("Dispatch mismatch")
+        return 1
+    return 0
+
+def firmware_like(size, seed = 0x5AD):
+    # Random words from a small vocabulary, about as compressible as a firmware image
+    rng = random.Random(seed)
+    words = [ bytes(rng.getrandbits(8) for _ in range(rng.randint(2, 12))) for _ in range(512) ]
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words) if rng.random() < 0.7 else bytes(rng.getrandbits(8) for _ in range(4))
+    return bytes(data[:size])
+
+def run_transfer(filename, checksum, block_size, compression, args, trace = None):
+    '''Transfer 'filename' once, return the measurements (or None if it failed).'''
+    options = { 'buffer_size': 512, 'baud': args.baud, 'latency': args.latency, 'loss': args.loss, 'corruption': args.corrupt, 'seed': args.seed }
+    connection, child = multiprocessing.Pipe()
+    emulator = multiprocessing.Process(target=MarlinBinaryEmulator.serve, args=(child, options), daemon=True)
+    emulator.start()
+    device = connection.recv()
+
+    log = io.StringIO()
+    ok = False
+    with contextlib.redirect_stdout(log):
+        protocol = MarlinBinaryProtocol.Protocol(device, args.baud or 250000, block_size, 0, args.timeout, args.window, args.adaptive)
+        protocol.telemetry = telemetry = MarlinBinaryProtocol.TransferTelemetry(trace, trace is not None)
+        telemetry.event('benchmark', block_size=block_size, compression=compression, window=args.window, adaptive=args.adaptive,
+                        baud=args.baud, latency=args.latency, loss=args.loss, corruption=args.corrupt)
+        try:
+            protocol.connect()
+            filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
+            filetransfer.connect()
+            cpu, start = time.process_time(), time.perf_counter()
+            cache = MarlinBinaryProtocol.CompressedArtifactCache(args.cache) if args.cache else None
+            ok = filetransfer.copy(filename, 'bench.bin', compression, False, cache=cache)
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+            protocol.disconnect()
+        except Exception as ex:
+            print("Exception:", ex)
+        finally:
+            protocol.shutdown()
+
+    connection.send('stop')
+    stats = connection.recv()
+    emulator.join()
+    if not ok or stats['files'].get('bench.bin') != checksum:
+        if args.verbose: sys.stdout.write(log.getvalue())
+        return None
+
+    size = os.path.getsize(filename)
+    return { 'block_size': block_size, 'compression': compression, 'compressed': telemetry.last['compression'], 'seconds': elapsed, 'kibs': size / 1024 / elapsed,
+             'packets': stats['packets'], 'packets_per_second': stats['packets'] / elapsed, 'retries': protocol.errors,
+             'resends': stats['resends'], 'cpu_seconds': cpu, 'cpu_percent': cpu / elapsed * 100,
+             'final_block_size': protocol.block_size, 'efficiency': telemetry.last['efficiency'],
+             'rtt_p50_ms': telemetry.last['rtt_ms'].get('p50'), 'rtt_p95_ms': telemetry.last['rtt_ms'].get('p95') }
+
+def bench_transfer(args):
+    if args.file:
+        filename = args.file
+    else:
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.bin')
+        tmp.write(firmware_like(args.size))
+        tmp.close()
+        filename = tmp.name
+    with open(filename, 'rb') as f:
+        checksum = zlib.adler32(f.read())
+
+    settings = { 'on': True, 'off': False, 'auto': 'auto' }
+    compressions = args.compression.split(',')
+    if not MarlinBinaryProtocol.heatshrink_exists and compressions != [ 'off' ]:
+        print("heatshrink2 not installed, compressed runs skipped")
+        compressions = [ 'off' ]
+
+    results = []
+    trace = open(args.trace, 'a') if args.trace else None
+    try:
+        if not args.json:
+            print("{0:>6} {1:>5} {2:>10} {3:>9} {4:>8} {5:>8} {6:>7}".format('block', 'comp', 'KiB/s', 'packets/s', 'retries', 'CPU s', 'CPU %'))
+        for label in compressions:
+            compression = settings[label]
+            for block_size in [ int(b) for b in args.blocksizes.split(',') ]:
+                for _ in range(args.repeat):
+                    result = run_transfer(filename, checksum, block_size, compression, args, trace)
+                    if result is None:
+                        print("{0:>6} {1:>5} FAILED".format(block_size, label), file=sys.stderr)
+                        continue
+                    results.append(result)
+                    if not args.json:
+                        print("{0:>6} {1:>5} {2:10.2f} {3:9.1f} {4:8} {5:8.2f} {6:7.1f}".format(block_size, label,
+                              result['kibs'], result['packets_per_second'], result['retries'], result['cpu_seconds'], result['cpu_percent']))
+    finally:
+        if trace: trace.close()
+        if not args.file: os.unlink(filename)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return 0 if results else 1
+
+def main():
+    parser = argparse.ArgumentParser(description='MarlinBinaryProtocol host-side benchmarks')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('checksum', help='Fletcher-16 backend check and throughput')
+    p.add_argument('-s', '--size', type=int, default=512, help='Buffer size in bytes (default: 512)')
+    p.add_argument('-n', '--rounds', type=int, default=20000, help='Checksums per backend')
+    p.add_argument('-c', '--cases', type=int, default=200, help='Random buffers for the property check')
+    p.set_defaults(func=bench_checksum)
+
+    p = sub.add_parser('responses', help='Response splitting and dispatch throughput')
+    p.add_argument('-n', '--lines', type=int, default=200000, help='Response lines (default: 200000)')
+    p.add_argument('-r', '--read-size', type=int, default=4096, help='Bytes per read (default: 4096)')
+    p.set_defaults(func=bench_responses)
+
+    p = sub.add_parser('transfer', help='File transfer through an emulated printer')
+    p.add_argument('file', nargs='?', help='File to transfer (default: generated firmware-like data)')
+    p.add_argument('-s', '--size', type=int, default=128 * 1024, help='Size of the generated data (default: 128KiB)')
+    p.add_argument('-b', '--blocksizes', default='64,128,256,512', help='Comma separated block sizes')
+    p.add_argument('-c', '--compression', default='off,on', help='Comma separated compression settings: off, on, auto')
+    p.add_argument('--cache', help='Keep compressed files in this directory between runs')
+    p.add_argument('-w', '--window', type=int, default=1, help='Packets in flight')
+    p.add_argument('-a', '--adaptive', action='store_true', help='Let the link tuner adjust the block size')
+    p.add_argument('-n', '--repeat', type=int, default=1, help='Runs per setting')
+    p.add_argument('-t', '--timeout', type=int, default=1000, help='Response timeout in ms')
+    p.add_argument('--baud', type=int, default=0, help='Emulated line rate (default: unthrottled)')
+    p.add_argument('--latency', type=float, default=0, help='Emulated link latency in ms')
+    p.add_argument('--loss', type=float, default=0, help='Emulated byte loss probability')
+    p.add_argument('--corrupt', type=float, default=0, help='Emulated byte corruption probability')
+    p.add_argument('--seed', type=int, default=None, help='Seed for the emulated impairments')
+    p.add_argument('--json', action='store_true', help='Print the results as JSON')
+    p.add_argument('--trace', help='Append the packet trace of every run to this file (JSON lines)')
+    p.add_argument('-v', '--verbose', action='store_true', help='Show the transfer log of failed runs')
+    p.set_defaults(func=bench_transfer)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+#
+# MarlinBinaryEmulator.py
+# Emulate the firmware side of the binary file transfer protocol on a pseudo-terminal,
+# so MarlinBinaryProtocol can be exercised without a printer.
+#
+# Usage: MarlinBinaryEmulator.py [-w WINDOW] [-b BLOCKSIZE] [-c] [-e ERRORS] [-r] [--fixed] [--no-stream]
+#                                [--baud BAUD] [--latency MS] [--loss P] [--corrupt P] [file]
+#   Run a loopback transfer of 'file' (or random data) and verify the received copy.
+#   With -r failed transfers are retried, resuming from what the emulator has stored.
+#
+import os, sys, time, threading, random, tty, zlib
+from collections import deque
+
+try:
+    import heatshrink2 as heatshrink
+    heatshrink_exists = True
+except ImportError:
+    try:
+        import heatshrink
+        heatshrink_exists = True
+    except ImportError:
+        heatshrink_exists = False
+
+def millis():
+    return time.perf_counter() * 1000
+
+class LinkModel(object):
+    '''
+    One direction of the emulated serial link, with optional impairments:
+      baud       - throttle to the line rate, 10 bits per byte (0: unthrottled)
+      latency    - milliseconds added to the delivery of every chunk
+      loss       - probability of each byte being dropped
+      corruption - probability of each byte being flipped
+    Chunks are submitted as they are written and become due once delivered.
+    '''
+    def __init__(self, baud = 0, latency = 0, loss = 0, corruption = 0, seed = None):
+        self.baud = baud
+        self.latency = latency
+        self.loss = loss
+        self.corruption = corruption
+        self.random = random.Random(seed)
+        self.queue = deque()        # (delivery time, data)
+        self.busy_until = 0
+        self.dropped = self.corrupted = 0
+
+    def events(self, size, probability):
+        # Positions hit with the given per-byte probability, by geometric gaps rather than a draw per byte
+        if probability <= 0: return []
+        positions, position = [], -1
+        while True:
+            position += 1 + int(self.random.expovariate(probability) if probability < 1 else 0)
+            if position >= size: return positions
+            positions.append(position)
+
+    def submit(self, data, now):
+        if self.corruption:
+            hits = self.events(len(data), self.corruption)
+            if hits:
+                data = bytearray(data)
+                for i in hits: data[i] ^= 1 << self.random.randrange(8)
+                self.corrupted += len(hits)
+        if self.loss:
+            drops = set(self.events(len(data), self.loss))
+            if drops:
+                data = bytes(b for i, b in enumerate(data) if i not in drops)
+                self.dropped += len(drops)
+        start = max(now, self.busy_until)
+        self.busy_until = start + (len(data) * 10000 / self.baud if self.baud else 0)
+        self.queue.append((self.busy_until + self.latency, bytes(data)))
+
+    def due(self, now):
+        data = b''
+        while len(self.queue) and self.queue[0][0] <= now:
+            data += self.queue.popleft()[1]
+        return data
+
+    def next_due(self):
+        return self.queue[0][0] if len(self.queue) else None
+
+class FileTransferEmulator(object):
+    '''
+    Mirror of SDFileTransferProtocol (Marlin/src/feature/binary_stream.h).
+    Files are stored in the 'files' dict, keyed by target filename.
+    '''
+    QUERY, OPEN, CLOSE, WRITE, ABORT, CHECKSUM, RENAME = range(7)
+
+    VERSION = '0.4.0'
+    WINDOW_BITS, LOOKAHEAD_BITS = 8, 4   # HEATSHRINK_STATIC_WINDOW_BITS, HEATSHRINK_STATIC_LOOKAHEAD_BITS
+
+    def __init__(self, compression = True):
+        self.compression_support = compression and heatshrink_exists
+        self.files = {}
+        self.transfer_active = False
+        self.filename = None
+        self.dummy = self.compression = self.resumable = False
+        self.buffer = bytearray()
+        self.stored = b''
+
+    def process(self, packet_type, payload, echo):
+        if packet_type == FileTransferEmulator.QUERY:
+            if self.compression_support:
+                echo("PFT:version:{0}:compression:heatshrink,{1},{2}".format(FileTransferEmulator.VERSION, FileTransferEmulator.WINDOW_BITS, FileTransferEmulator.LOOKAHEAD_BITS))
+            else:
+                echo("PFT:version:{0}:compression:none".format(FileTransferEmulator.VERSION))
+        elif packet_type == FileTransferEmulator.OPEN:
+            if self.transfer_active:
+                echo("PFT:busy")
+            elif len(payload) > 2 and payload[-1] == 0:
+                self.dummy, self.compression = bool(payload[0] & 1), bool(payload[1] & 1)
+                self.resumable = bool(payload[0] & 2) and not self.dummy
+                self.filename = payload[2:-1].decode('utf8')
+                self.buffer = bytearray()
+                self.stored = self.files.get(self.filename, b'') if self.resumable and payload[0] & 4 else b''
+                self.transfer_active = True
+                echo("PFT:success:{0}".format(len(self.stored)) if self.resumable else "PFT:success")
+            else:
+                echo("PFT:fail")
+        elif packet_type == FileTransferEmulator.CLOSE:
+            if self.transfer_active:
+                self.transfer_active = False
+                if not self.dummy:
+                    data = bytes(self.buffer)
+                    if self.compression:
+                        data = heatshrink.decode(data, window_sz2=FileTransferEmulator.WINDOW_BITS, lookahead_sz2=FileTransferEmulator.LOOKAHEAD_BITS)
+                    self.files[self.filename] = self.stored + data
+                echo("PFT:success")
+            else:
+                echo("PFT:invalid")
+        elif packet_type == FileTransferEmulator.WRITE:
+            if not self.transfer_active:
+                echo("PFT:invalid")
+            else:
+                self.buffer += payload
+        elif packet_type == FileTransferEmulator.ABORT:
+            self.transfer_active = False
+            self.buffer = bytearray()
+            echo("PFT:success")
+        elif packet_type == FileTransferEmulator.CHECKSUM:
+            filename = payload[:-1].decode('utf8') if len(payload) and payload[-1] == 0 else None
+            match = [ name for name in self.files if filename and filename.upper() in (name.upper(), BinaryStreamEmulator.dos_name(name)) ]
+            if self.transfer_active:
+                echo("PFT:busy")
+            elif match:
+                data = self.files[match[0]]
+                echo("PFT:checksum:{0}:{1}".format(len(data), zlib.adler32(data)))
+            else:
+                echo("PFT:fail")
+        elif packet_type == FileTransferEmulator.RENAME:
+            names = payload[:-1].decode('utf8').split('\0') if len(payload) and payload[-1] == 0 else []
+            match = [ name for name in self.files if len(names) == 2 and names[0].upper() in (name.upper(), BinaryStreamEmulator.dos_name(name)) ]
+            if self.transfer_active:
+                echo("PFT:busy")
+            elif match:
+                for name in [ name for name in self.files if name.upper() == names[1].upper() ]:
+                    del self.files[name]
+                self.files[names[1]] = self.files.pop(match[0])
+                echo("PFT:success")
+            else:
+                echo("PFT:fail")
+        else:
+            echo("PTF:invalid")
+
+class BinaryStreamEmulator(object):
+    '''
+    Mirror of the BinaryStream receiver (Marlin/src/feature/binary_stream.h) running
+    on the master side of a pty. Connect a Protocol to 'device' to talk to it.
+    G-code lines are answered with 'ok' until 'M28B1' switches to binary mode.
+    The link in each direction can be throttled and impaired, see LinkModel.
+    '''
+    PACKET_TOKEN = b'\xAD\xB5'
+    HEADER_SIZE = 8
+    PACKET_MAX_WAIT = 500
+    VERSION = '0.1.0'
+
+    def __init__(self, buffer_size = 512, compression = True, baud = 0, latency = 0, loss = 0, corruption = 0, seed = None):
+        self.buffer_size = buffer_size
+        self.rx_link = LinkModel(baud, latency, loss, corruption, seed)
+        self.tx_link = LinkModel(baud, latency, loss, corruption, None if seed is None else seed + 1)
+        self.filetransfer = FileTransferEmulator(compression)
+        self.binary_mode = False
+        self.sync = 0
+        self.packet_retries = 0
+        self.packets = 0
+        self.resends = 0
+        self.rx = bytearray()
+        self.running = True
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+
+        self.worker_thread = threading.Thread(target=BinaryStreamEmulator.worker, args=(self,), daemon=True)
+        self.worker_thread.start()
+
+    def shutdown(self):
+        self.running = False
+        self.worker_thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # fletchers 16 checksum
+    @staticmethod
+    def build_checksum(buffer):
+        cs = 0
+        for b in buffer:
+            cs_low = ((cs & 0xFF) + b) % 255
+            cs = ((((cs >> 8) + cs_low) % 255) << 8) | cs_low
+        return cs
+
+    def echo(self, line):
+        self.tx_link.submit(bytearray(line, 'utf8') + b'\n', millis())
+
+    def worker(self):
+        import select
+        packet_start = None
+        while self.running:
+            # Wake up for incoming data, or when delayed data becomes due
+            wait = 0.01
+            for due in (self.rx_link.next_due(), self.tx_link.next_due()):
+                if due is not None: wait = max(min(wait, (due - millis()) / 1000), 0)
+            ready, _, _ = select.select([self.master], [], [], wait)
+            if ready:
+                try:
+                    self.rx_link.submit(os.read(self.master, 4096), millis())
+                except OSError:
+                    continue
+            self.rx += self.rx_link.due(millis())
+            if self.binary_mode:
+                # Like the firmware, only a started packet (a token) can time out, not stray bytes
+                token = BinaryStreamEmulator.PACKET_TOKEN
+                if packet_start is None and self.rx.startswith(token):
+                    packet_start = millis()
+                while self.binary_mode and self.process_packet():
+                    packet_start = millis() if self.rx.startswith(token) else None
+                # Datastream timeout on a partial packet
+                if packet_start is not None and millis() - packet_start > BinaryStreamEmulator.PACKET_MAX_WAIT:
+                    self.echo("echo:Datastream timeout")
+                    self.rx = bytearray()
+                    packet_start = None
+                    self.resend()
+            else:
+                self.process_ascii()
+            data = self.tx_link.due(millis())
+            if len(data):
+                try:
+                    os.write(self.master, data)
+                except OSError:
+                    pass
+
+    def process_ascii(self):
+        while b'\n' in self.rx:
+            line, _, self.rx = self.rx.partition(b'\n')
+            line = line.decode('utf8', 'replace').strip()
+            if not line:
+                continue                            # Marlin doesn't answer empty lines
+            if line.startswith('M28B1'):
+                self.echo("echo:Switching to Binary Protocol")
+                self.binary_mode = True
+                self.echo("ok")
+                return
+            if line.startswith('M21'):
+                self.echo("echo:SD card ok")
+            elif line.startswith('M20'):
+                self.list_files('L' in line[3:])
+            elif line.startswith('M30'):
+                self.delete_file(line[3:].strip().lstrip('/'))
+            self.echo("ok")
+
+    @staticmethod
+    def dos_name(filename):
+        name, _, ext = filename.upper().rpartition('.') if '.' in filename else (filename.upper(), '', '')
+        return name + ('.' + ext if ext else '') if len(name) <= 8 and len(ext) <= 3 else name[:6] + '~1' + ('.' + ext[:3] if ext else '')
+
+    def list_files(self, long_names):
+        # M20 [L]: '<DOS name> <size> [<long name>]' for each file
+        self.echo("Begin file list")
+        for filename, data in self.filetransfer.files.items():
+            self.echo("{0} {1}{2}".format(self.dos_name(filename), len(data), ' ' + filename if long_names else ''))
+        self.echo("End file list")
+
+    def delete_file(self, filename):
+        for name in list(self.filetransfer.files):
+            if filename.upper() in (name.upper(), self.dos_name(name)):
+                del self.filetransfer.files[name]
+                self.echo("File deleted:{0}".format(filename))
+                return
+        self.echo("Deletion failed, File: {0}.".format(filename))
+
+    def resend(self):
+        self.packet_retries += 1
+        self.resends += 1
+        self.echo("echo:Resend request {0}".format(self.packet_retries))
+        self.echo("rs{0}".format(self.sync))
+
+    def process_packet(self):
+        '''Consume one packet from the receive buffer. Return False if more data is needed.'''
+        start = self.rx.find(BinaryStreamEmulator.PACKET_TOKEN)
+        if start < 0:
+            del self.rx[:max(len(self.rx) - 1, 0)]      # stream corruption, drop data
+            return False
+        del self.rx[:start]
+        if len(self.rx) < BinaryStreamEmulator.HEADER_SIZE:
+            return False
+
+        header = self.rx[2:BinaryStreamEmulator.HEADER_SIZE]
+        sync, meta, size = header[0], header[1], int.from_bytes(header[2:4], 'little')
+        if int.from_bytes(header[4:6], 'little') != self.build_checksum(header[:4]):
+            self.echo("echo:Packet header({0}?) corrupt".format(sync))
+            del self.rx[:2]
+            self.resend()
+            return True
+
+        protocol, packet_type = (meta >> 4) & 0xF, meta & 0xF
+
+        # The SYNC control packet doesn't require the stream sync to be correct
+        if protocol == 0 and packet_type == 1:
+            del self.rx[:BinaryStreamEmulator.HEADER_SIZE]
+            self.echo("ss{0},{1},{2}".format(self.sync, self.buffer_size, BinaryStreamEmulator.VERSION))
+            return True
+
+        if sync == self.sync:
+            packet_size = BinaryStreamEmulator.HEADER_SIZE + (size + 2 if size else 0)
+            if size > self.buffer_size:
+                del self.rx[:BinaryStreamEmulator.HEADER_SIZE]
+                self.echo("echo:Datastream packet data buffer overrun")
+                self.echo("fe{0}".format(sync))
+                self.sync = self.packet_retries = 0
+                return True
+            if len(self.rx) < packet_size:
+                return False
+            payload = bytes(self.rx[BinaryStreamEmulator.HEADER_SIZE:BinaryStreamEmulator.HEADER_SIZE + size])
+            if size and int.from_bytes(self.rx[packet_size - 2:packet_size], 'little') != self.build_checksum(header + payload):
+                self.echo("echo:Packet({0}) payload corrupt".format(sync))
+                del self.rx[:2]
+                self.resend()
+                return True
+            del self.rx[:packet_size]
+            self.sync = (self.sync + 1) % 256
+            self.packet_retries = 0
+            self.packets += 1
+            self.echo("ok{0}".format(sync))
+            self.dispatch(protocol, packet_type, payload)
+        else:
+            del self.rx[:BinaryStreamEmulator.HEADER_SIZE]
+            if sync == (self.sync - 1) % 256:       # ok response must have been lost
+                self.echo("ok{0}".format(sync))
+            elif not self.packet_retries:           # drop packets already buffered after a resend request
+                self.echo("echo:Datastream packet out of order")
+                self.resend()
+        return True
+
+    def dispatch(self, protocol, packet_type, payload):
+        if protocol == 0:
+            if packet_type == 2:                    # revert back to ASCII mode
+                self.binary_mode = False
+            else:
+                self.echo("echo:Unknown BinaryProtocolControl Packet")
+        elif protocol == 1:
+            self.filetransfer.process(packet_type, payload, self.echo)
+        else:
+            self.echo("echo:Unsupported Binary Protocol")
+
+def serve(connection, options):
+    '''
+    Run an emulator in a child process, for benchmarks that must not count its CPU time.
+    Sends the device name over 'connection', then the statistics once told to 'stop'.
+    '''
+    emulator = BinaryStreamEmulator(**options)
+    connection.send(emulator.device)
+    connection.recv()
+    emulator.shutdown()
+    files = { name: zlib.adler32(data) for name, data in emulator.filetransfer.files.items() }
+    connection.send({ 'packets': emulator.packets, 'resends': emulator.resends, 'files': files,
+                      'dropped': emulator.rx_link.dropped + emulator.tx_link.dropped,
+                      'corrupted': emulator.rx_link.corrupted + emulator.tx_link.corrupted })
+
+def main():
+    import argparse, hashlib, tempfile, shutil
+    import MarlinBinaryProtocol
+
+    parser = argparse.ArgumentParser(description='Loopback transfer through an emulated Marlin binary protocol endpoint')
+    parser.add_argument('files', nargs='*', help='Files to transfer, several go in one session (default: 256KiB of random data)')
+    parser.add_argument('-w', '--window', type=int, default=1, help='Packets in flight')
+    parser.add_argument('-b', '--blocksize', type=int, default=512, help='Transfer block size')
+    parser.add_argument('-c', '--compression', nargs='?', const=True, default=False, help="Compress the transfer with heatshrink, or 'auto'")
+    parser.add_argument('-e', '--errors', type=float, default=0, help='Simulated corruption ratio')
+    parser.add_argument('--fixed', action='store_true', help='Fixed block size and timeout, abort on the first error')
+    parser.add_argument('-r', '--resume', action='store_true', help='Retry failed transfers, resuming where they stopped')
+    parser.add_argument('--no-stream', action='store_true', help='Load and compress the whole file before sending')
+    parser.add_argument('--baud', type=int, default=0, help='Emulated line rate (default: unthrottled)')
+    parser.add_argument('--latency', type=float, default=0, help='Emulated link latency in ms')
+    parser.add_argument('--loss', type=float, default=0, help='Emulated byte loss probability')
+    parser.add_argument('--corrupt', type=float, default=0, help='Emulated byte corruption probability')
+    args = parser.parse_args()
+
+    if args.files:
+        filenames = args.files
+    else:
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        tmp.write(bytes(random.getrandbits(8) for _ in range(256 * 1024)))
+        tmp.close()
+        filenames = [ tmp.name ]
+    # Destination name of each file, unique even for files of the same name
+    targets = { 'loopback.bin' if len(filenames) == 1 else 'loopback{0}.bin'.format(i): filename for i, filename in enumerate(filenames) }
+
+    emulator = BinaryStreamEmulator(args.blocksize, True, args.baud, args.latency, args.loss, args.corrupt)
+    checkpoint_dir = tempfile.mkdtemp() if args.resume else None
+    attempts = 0
+    try:
+        ok = False
+        while not ok and attempts < (100 if args.resume else 1):
+            attempts += 1
+            protocol = MarlinBinaryProtocol.Protocol(emulator.device, 250000, args.blocksize, args.errors, 1000, args.window, not args.fixed)
+            try:
+                protocol.connect()
+                filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
+                if len(targets) == 1:
+                    ok = filetransfer.copy(filenames[0], 'loopback.bin', args.compression, False, not args.no_stream, checkpoint_dir)
+                else:
+                    session = MarlinBinaryProtocol.TransferSession(filetransfer, args.compression, checkpoint_dir = checkpoint_dir)
+                    for target, filename in targets.items():
+                        session.add(filename, target)
+                    ok = session.run()
+                protocol.disconnect()
+            except (MarlinBinaryProtocol.ReadTimeout, MarlinBinaryProtocol.ConnectionLost, MarlinBinaryProtocol.SycronisationError,
+                    MarlinBinaryProtocol.FatalError, MarlinBinaryProtocol.PayloadOverflow) as e:
+                # A failed attempt like any other, the next one resumes from the checkpoint
+                print("Attempt {0} failed: {1}".format(attempts, type(e).__name__))
+            finally:
+                protocol.shutdown()
+    finally:
+        emulator.shutdown()
+        if checkpoint_dir: shutil.rmtree(checkpoint_dir)
+
+    try:
+        for target, filename in targets.items():
+            data = open(filename, 'rb').read()
+            received = emulator.filetransfer.files.get(target)
+            if not ok or received != data:
+                print("Loopback FAILED: " + filename)
+                return 1
+            print("Loopback OK: {0}, {1} bytes, sha256 {2}".format(filename, len(data), hashlib.sha256(received).hexdigest()[:16]))
+    finally:
+        if not args.files: os.unlink(filenames[0])
+    print("{0} packets, {1} resends, {2} attempts".format(emulator.packets, emulator.resends, attempts))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,8 @@
 # MarlinBinaryProtocol.py
 # Supporting Firmware upload via USB/Serial, saving to the attached media.
 #
-import serial, math, time, threading, sys, datetime, random
+import serial, math, time, threading, sys, os, io, datetime, random, struct, hashlib, json, glob, zlib, tempfile, shutil
+import concurrent.futures
 from collections import deque
 
 try:
@@ -15,6 +16,14 @@ except ImportError:
     except ImportError:
         heatshrink_exists = False
 
+try:
+    import numpy
+    numpy_exists = True
+except ImportError:
+    numpy_exists = False
+
+from itertools import accumulate
+
 def millis():
     return time.perf_counter() * 1000
 
@@ -29,6 +38,229 @@ class TimeOut(object):
     def timedout(self):
         return millis() > self.endtime
 
+    def remaining(self):
+        return max(self.endtime - millis(), 0)
+
+#
+# Fletcher-16 checksum over a whole buffer, continuing from 'cs'.
+# Equivalent to folding Protocol.checksum over every byte, but the modulo
+# reduction is deferred to the end: the low sum is the running byte total and
+# the high sum is the total of the running low sums.
+#
+def fletcher16_python(buffer, cs = 0):
+    if not len(buffer): return cs
+    low = cs & 0xFF
+    sums = sum(accumulate(buffer, initial=low)) - low
+    low = (low + sum(buffer)) % 255
+    return (((cs >> 8) + sums) % 255) << 8 | low
+
+if numpy_exists:
+    fletcher16_weights = numpy.arange(0x10000, 0, -1, dtype=numpy.uint64)
+
+    def fletcher16_numpy(buffer, cs = 0):
+        n = len(buffer)
+        if not n: return cs
+        if n > len(fletcher16_weights):
+            return fletcher16_python(buffer, cs)
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        low = cs & 0xFF
+        # byte i is included in the low sum of n - i steps
+        sums = int(numpy.dot(fletcher16_weights[-n:], data)) + n * low
+        low = (low + int(data.sum(dtype=numpy.uint64))) % 255
+        return (((cs >> 8) + sums) % 255) << 8 | low
+
+    # NumPy call overhead only pays off on payload-sized buffers
+    def fletcher16(buffer, cs = 0):
+        return fletcher16_numpy(buffer, cs) if len(buffer) >= 64 else fletcher16_python(buffer, cs)
+else:
+    fletcher16 = fletcher16_python
+
+#
+# Yield heatshrink-compressed data for a file object, reading one chunk at a time.
+#
+def heatshrink_stream(source, window, lookahead, chunk_size = 4096):
+    if hasattr(heatshrink, 'core'):
+        encoder = heatshrink.core.Encoder(heatshrink.core.Writer(window_sz2=window, lookahead_sz2=lookahead))
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk: break
+            yield encoder.fill(chunk)
+        yield encoder.finish()
+    else:
+        # The original heatshrink module has no incremental encoder
+        yield heatshrink.encode(source.read(), window_sz2=window, lookahead_sz2=lookahead)
+
+class ResponseQueue(object):
+    '''
+    Responses queued by the receive worker thread. Waiters block on a
+    condition variable instead of polling, so they wake as soon as a
+    response arrives and don't spin while the link is quiet.
+    '''
+    def __init__(self):
+        self.queue = deque()
+        self.ready = threading.Condition()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def append(self, data):
+        with self.ready:
+            self.queue.append(data)
+            self.ready.notify_all()
+
+    def popleft(self):
+        return self.queue.popleft()
+
+    def wait(self, milliseconds):
+        # Return True if a response is available within the given time
+        with self.ready:
+            return self.ready.wait_for(lambda: len(self.queue), milliseconds / 1000)
+
+class LineReader(object):
+    '''
+    Splits the bytes received from the client into response lines. Reads of any
+    size are appended to one reusable buffer, complete lines are decoded and
+    returned, a partial line is kept for the next read.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        buffer = self.buffer
+        start = len(buffer)
+        buffer += data
+        if buffer.find(b'\n', start) < 0:
+            return []
+        lines = []
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end < 0: break
+            try:
+                line = buffer[start:end].decode('utf8').rstrip()
+                if len(line): lines.append(line)
+            except UnicodeDecodeError:
+                pass    # dodgy client output or datastream corruption
+            start = end + 1
+        del buffer[:start]
+        return lines
+
+    def clear(self):
+        del self.buffer[:]
+
+class SendWindow(object):
+    '''
+    Go-back-N bookkeeping for Protocol.send_stream, kept apart from the I/O so
+    the threaded and asyncio protocols share the same sync/resend semantics.
+
+    The firmware only accepts the packet matching its sync id and answers
+    'rs<sync>' for the first packet out of order, silently dropping the rest
+    until the expected packet arrives. So a resend request (or a timeout on
+    the oldest packet) rewinds to that sync id and retransmits the window
+    from there. Packets in flight are held by the serial link, so a window
+    larger than 1 needs a flow-controlled (USB CDC) connection.
+
+    The driver transmits the packets returned by fill(), response() and
+    expired(), and is done when idle() returns True.
+    '''
+    def __init__(self, protocol, packet_protocol, packet_type, payloads, progress = None):
+        self.protocol = protocol
+        self.packet_protocol = packet_protocol
+        self.packet_type = packet_type
+        self.payloads = iter(payloads)
+        self.progress = progress
+        self.size = protocol.window_size
+        self.inflight = deque()     # [sync, packet, send time] sent but not acknowledged
+        self.buffers = [ protocol.packet_buffer_for(None) for _ in range(self.size) ]
+        self.sent = 0
+        self.acked = 0
+        self.exhausted = False
+        self.rewound = None         # sync id of the last rewind, to skip duplicate 'rs'
+        self.timeout = TimeOut(protocol.packet_timeout())
+        self.stalled = TimeOut(protocol.response_timeout * 20)
+
+    def idle(self):
+        return self.exhausted and not len(self.inflight)
+
+    def fill(self):
+        # Build packets until the window is full
+        packets = []
+        while not self.exhausted and len(self.inflight) < self.size:
+            try:
+                data = next(self.payloads)
+            except StopIteration:
+                self.exhausted = True
+                break
+            # A packet keeps its buffer until acknowledged, there are never more than 'size' in flight
+            packet = self.protocol.build_packet(self.packet_protocol, self.packet_type, data, self.buffers[self.sent % self.size])
+            self.sent += 1
+            if not len(self.inflight): self.reset_timeout()
+            self.inflight.append([self.protocol.sync, packet, millis()])
+            self.protocol.sync = (self.protocol.sync + 1) % 256
+            packets.append(packet)
+        return packets
+
+    def reset_timeout(self):
+        self.timeout.duration = self.protocol.packet_timeout()
+        self.timeout.reset()
+
+    def acknowledge(self, packet_id, inclusive):
+        if not any(packet_id == sync for sync, _, _ in self.inflight):
+            return False
+        while len(self.inflight):
+            if self.inflight[0][0] == packet_id:
+                if inclusive:
+                    _, packet, sent = self.inflight.popleft()
+                    self.acked += 1
+                    self.protocol.packet_acknowledged(packet_id)
+                    if sent is not None:
+                        self.protocol.link_acknowledged(millis() - sent, len(packet) - Protocol.PACKET_OVERHEAD)
+                break
+            self.protocol.packet_acknowledged(self.inflight.popleft()[0])
+            self.acked += 1
+        self.reset_timeout()
+        self.stalled.reset()
+        return True
+
+    def retransmit(self):
+        # Retransmitted packets aren't timed, their acknowledgement is ambiguous
+        self.reset_timeout()
+        for entry in self.inflight: entry[2] = None
+        return [ packet for _, packet, _ in self.inflight ]
+
+    def expired(self):
+        # The oldest packet timed out, resend the whole window
+        self.protocol.link_error(True)
+        self.rewound = self.inflight[0][0]
+        return self.retransmit()
+
+    def response(self, token, data):
+        if token == 'ok':
+            try:
+                packet_id = int(data)
+            except ValueError:
+                return []
+            done = self.acked
+            if self.acknowledge(packet_id, True) and self.progress and self.acked != done:
+                if self.progress(self.acked) is False:
+                    self.exhausted = True
+        elif token == 'rs':
+            self.protocol.link_error()
+            try:
+                packet_id = int(data)
+            except ValueError:
+                return []   # garbled, the window timeout recovers
+            if packet_id == self.rewound and not self.timeout.timedout():
+                return []
+            if self.acknowledge(packet_id, False):
+                self.rewound = packet_id
+                return self.retransmit()
+        elif token == 'ss':
+            self.protocol.response_stream_sync(data)
+        elif token == 'fe':
+            self.protocol.response_fatal_error(data)
+        return []
+
 class ReadTimeout(Exception):
     pass
 class FatalError(Exception):
@@ -40,6 +272,239 @@ class PayloadOverflow(Exception):
 class ConnectionLost(Exception):
     pass
 
+class LinkTuner(object):
+    '''
+    Adaptive payload size and response timeout for a Protocol, from the link
+    quality measured on acknowledged packets.
+
+    The response timeout is a multiple of a high percentile of the round trip
+    times, bounded by the configured timeout, so a lost packet is resent as
+    soon as it is clearly overdue. Only packets acknowledged on their first
+    transmission are timed, and a timeout doubles the wait until new samples
+    come in, so an underestimate can't lock the link into retransmissions.
+
+    The payload size maximises the expected goodput. A packet of n payload
+    bytes takes latency + (n + overhead) * byte_time and arrives intact with
+    probability (1 - q) ** (n + overhead), q being the per-byte error rate
+    derived from the recent packet error ratio. A clean link gets the largest
+    block the client accepts, a noisy one smaller blocks that are less likely
+    to be hit. Latency only counts when packets aren't pipelined.
+    '''
+    MIN_BLOCK_SIZE = 64
+    MIN_TIMEOUT = 100           # ms, allow for OS scheduling and USB polling jitter
+    TIMEOUT_FACTOR = 3          # timeout = factor * RTT percentile
+    PERCENTILE = 0.95
+    SAMPLES = 64                # RTT samples kept
+    ADJUST_EVERY = 16           # packets between block size updates
+    ERROR_DECAY = 1 / 64        # weight of the latest packet in the error ratio
+    MAX_ERROR_RATIO = 0.5       # beyond this (at the smallest block) the link is unusable
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.requested_block_size = protocol.block_size
+        self.max_block_size = protocol.block_size
+        self.rtt = deque(maxlen=LinkTuner.SAMPLES)  # (milliseconds, packet size on the wire)
+        self.error_ratio = 0.0
+        self.packets = 0
+        self.timeout = protocol.response_timeout
+
+    def synced(self):
+        # The client reported its buffer size, never exceed it (or the size asked for)
+        self.max_block_size = min(self.requested_block_size, self.protocol.max_block_size)
+        self.protocol.block_size = min(self.protocol.block_size, self.max_block_size)
+
+    def acknowledged(self, milliseconds, size):
+        self.rtt.append((milliseconds, size + Protocol.PACKET_OVERHEAD))
+        if len(self.rtt) >= 8:
+            self.timeout = self.packet_timeout()
+        self.update(False)
+
+    def error(self):
+        self.update(True)
+
+    def expired(self):
+        self.timeout = min(self.timeout * 2, self.protocol.response_timeout)
+        self.update(True)
+
+    def update(self, failed):
+        self.error_ratio += (float(failed) - self.error_ratio) * LinkTuner.ERROR_DECAY
+        self.packets += 1
+        if self.packets % LinkTuner.ADJUST_EVERY == 0:
+            self.protocol.block_size = self.best_block_size()
+
+    def failing(self):
+        return self.packets >= LinkTuner.SAMPLES and self.error_ratio > LinkTuner.MAX_ERROR_RATIO \
+               and self.protocol.block_size <= LinkTuner.MIN_BLOCK_SIZE
+
+    def byte_time(self):
+        # Milliseconds per byte at the nominal baud rate (8N1), USB links are faster
+        return 10000 / self.protocol.baud if self.protocol.baud else 0
+
+    def packet_timeout(self):
+        # Samples are scaled up to the current packet size, growing blocks take longer
+        wire = self.protocol.block_size + Protocol.PACKET_OVERHEAD
+        rtt = sorted(ms * max(wire / size, 1) for ms, size in self.rtt)
+        percentile = rtt[min(int(len(rtt) * LinkTuner.PERCENTILE), len(rtt) - 1)]
+        return max(min(percentile * LinkTuner.TIMEOUT_FACTOR, self.protocol.response_timeout), LinkTuner.MIN_TIMEOUT)
+
+    def best_block_size(self):
+        if self.max_block_size <= LinkTuner.MIN_BLOCK_SIZE:
+            return self.max_block_size
+
+        byte_time = self.byte_time()
+        latency = 0
+        if self.protocol.window_size == 1 and len(self.rtt):
+            latency = max(sorted(ms - size * byte_time for ms, size in self.rtt)[len(self.rtt) // 2], 0)
+
+        wire = self.protocol.block_size + Protocol.PACKET_OVERHEAD
+        q = 1 - (1 - min(self.error_ratio, 0.99)) ** (1 / wire)
+
+        def goodput(n):
+            wire = n + Protocol.PACKET_OVERHEAD
+            return n * (1 - q) ** wire / (latency + wire * byte_time + 1e-6)
+
+        sizes, n = [ self.max_block_size ], LinkTuner.MIN_BLOCK_SIZE
+        while n < self.max_block_size:
+            sizes.append(n)
+            n *= 2
+        return max(sizes, key=goodput)
+
+class Histogram(object):
+    '''
+    Distribution of non-negative values in logarithmic buckets, STEPS per
+    doubling, keyed by their upper bound: bucket b counts the values in
+    (b / 2 ** (1 / STEPS), b] and bucket 0 the zeros. Cheap enough to feed on
+    every packet, percentiles are the upper bound of the matching bucket
+    (within 19% with 4 steps), clamped to the range seen.
+    '''
+    STEPS = 4
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        bound = 2 ** (math.ceil(math.log2(value) * Histogram.STEPS) / Histogram.STEPS) if value > 0 else 0
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, fraction):
+        if not self.count: return None
+        rank = fraction * self.count
+        for bound in sorted(self.buckets):
+            rank -= self.buckets[bound]
+            if rank <= 0: break
+        return max(min(bound, self.max), self.min)
+
+    def summary(self):
+        if not self.count: return { 'count': 0 }
+        return { 'count': self.count, 'mean': self.total / self.count, 'min': self.min, 'max': self.max,
+                 'p50': self.percentile(0.5), 'p95': self.percentile(0.95), 'p99': self.percentile(0.99),
+                 'buckets': { '{0:.4g}'.format(bound): self.buckets[bound] for bound in sorted(self.buckets) } }
+
+class TransferTelemetry(object):
+    '''
+    Transfer metrics and packet trace of a Protocol, enabled by setting
+    protocol.telemetry. The protocol reports every packet it transmits and
+    every acknowledgement and link error, a FileTransferProtocol the start
+    and end of each file transfer.
+
+    Events go to 'output' (a text file, or None to only aggregate) as JSON
+    lines, timed in ms from the creation of the telemetry:
+      packet   - an acknowledged packet: sync id, protocol and packet type,
+                 payload bytes and wire bytes over all its transmissions, first
+                 send and acknowledgement times, round trip time of the last
+                 transmission and retries. Only written with 'packets'.
+      error    - a resend request or a response timeout
+      sync     - the client (re)synchronised the link
+      open     - a file transfer started
+      transfer - a file transfer ended, with its totals and the histograms of
+                 round trip time, retries and payload size over its packets
+    '''
+    def __init__(self, output = None, packets = True):
+        self.output = output
+        self.packets = packets
+        self.start = millis()
+        self.pending = {}   # sync id -> [meta, payload bytes, first send, last send, transmissions, wire bytes]
+        self.last = None    # summary of the last transfer
+        self.begin()
+
+    def begin(self):
+        # Start aggregating a new transfer
+        self.rtt = Histogram()
+        self.retries = Histogram()
+        self.payload = Histogram()
+        self.payload_bytes = 0
+        self.wire_bytes = 0
+        self.timeouts = 0
+        self.resends = 0
+        self.transfer_start = millis()
+
+    def event(self, kind, **fields):
+        if self.output is None: return
+        record = { 't': round(millis() - self.start, 3), 'event': kind }
+        record.update(fields)
+        self.output.write(json.dumps(record) + '\n')
+
+    def sent(self, packet):
+        now = millis()
+        sync, meta = packet[2], packet[3]
+        size = len(packet) - Protocol.PACKET_OVERHEAD if len(packet) > 8 else 0
+        self.wire_bytes += len(packet)
+        entry = self.pending.get(sync)
+        if entry is not None and entry[0] == meta and entry[1] == size:
+            entry[3] = now      # retransmission
+            entry[4] += 1
+            entry[5] += len(packet)
+        else:
+            self.pending[sync] = [meta, size, now, now, 1, len(packet)]
+
+    def acknowledged(self, sync):
+        entry = self.pending.pop(sync, None)
+        if entry is None: return
+        now = millis()
+        meta, size, first, last, transmissions, wire = entry
+        self.rtt.add(now - last)
+        self.retries.add(transmissions - 1)
+        self.payload.add(size)
+        self.payload_bytes += size
+        if self.packets:
+            self.event('packet', sync=sync, protocol=meta >> 4, type=meta & 0xF, payload=size, wire=wire,
+                       sent=round(first - self.start, 3), acked=round(now - self.start, 3),
+                       rtt=round(now - last, 3), retries=transmissions - 1)
+
+    def error(self, timeout):
+        if timeout: self.timeouts += 1
+        else: self.resends += 1
+        self.event('error', cause='timeout' if timeout else 'resend')
+
+    def synced(self, sync):
+        # Packets still pending won't be acknowledged
+        self.pending.clear()
+        self.event('sync', sync=sync)
+
+    def summary(self):
+        return { 'seconds': (millis() - self.transfer_start) / 1000, 'payload_bytes': self.payload_bytes,
+                 'wire_bytes': self.wire_bytes, 'efficiency': self.payload_bytes / self.wire_bytes if self.wire_bytes else None,
+                 'packets': self.payload.count, 'timeouts': self.timeouts, 'resends': self.resends,
+                 'rtt_ms': self.rtt.summary(), 'retries': self.retries.summary(), 'payload': self.payload.summary() }
+
+    def finished(self, **fields):
+        # Write the transfer summary and start aggregating the next one
+        record = self.summary()
+        record.update(fields)
+        self.event('transfer', **record)
+        if self.output is not None: self.output.flush()
+        self.last = record
+        self.begin()
+        return record
+
 class Protocol(object):
     device = None
     baud = None
@@ -52,6 +517,8 @@ class Protocol(object):
     packet_ping = None
 
     errors = 0
+    unexpected_id = None        # Last out of sequence id in an ok/rs, and how many times in a row
+    unexpected_repeats = 0
     packet_buffer = None
     simulate_errors = 0
     sync = 0
@@ -61,11 +528,24 @@ class Protocol(object):
 
     response_timeout = 1000
 
-    applications = []
-    responses = deque()
+    # A garbled ok/rs can carry any id, so only an id the client keeps repeating means it's out of sync
+    SYNC_ERROR_REPEATS = 3
 
-    def __init__(self, device, baud, bsize, simerr, timeout):
+    # Number of packets allowed in flight by send_stream. The sync id is 8 bits
+    # wide so the window must stay below half the sequence space.
+    window_size = 1
+    MAX_WINDOW = 127
+
+    applications = None
+    token_index = None
+    responses = None
+    tuner = None
+    telemetry = None            # TransferTelemetry, if set
+
+    def __init__(self, device, baud, bsize, simerr, timeout, window = 1, adaptive = True):
         print("pySerial Version:", serial.VERSION)
+        self.applications = []
+        self.responses = ResponseQueue()
         self.port = serial.Serial(device, baudrate = baud, write_timeout = 0, timeout = 1)
         self.device = device
         self.baud = baud
@@ -73,23 +553,19 @@ class Protocol(object):
         self.simulate_errors = max(min(simerr, 1.0), 0.0)
         self.connected = True
         self.response_timeout = timeout
+        self.window_size = max(min(int(window), Protocol.MAX_WINDOW), 1)
+        self.tuner = LinkTuner(self) if adaptive else None
 
         self.register(['ok', 'rs', 'ss', 'fe'], self.process_input)
 
-        self.worker_thread = threading.Thread(target=Protocol.receive_worker, args=(self,))
-        self.worker_thread.start()
-
-    def receive_worker(self):
+        # Flush stale input before the worker starts, so it can't discard the reply to connect()
         while self.port.in_waiting:
             self.port.reset_input_buffer()
 
-        def dispatch(data):
-            for tokens, callback in self.applications:
-                for token in tokens:
-                    if token == data[:len(token)]:
-                        callback((token, data[len(token):]))
-                        return
+        self.worker_thread = threading.Thread(target=Protocol.receive_worker, args=(self,))
+        self.worker_thread.start()
 
+    def receive_worker(self):
         def reconnect():
             print("Reconnecting..")
             self.port.close()
@@ -105,17 +581,28 @@ class Protocol(object):
                     time.sleep(1)
             raise ConnectionLost()
 
+        # Wait (up to the port timeout) for the first byte, then take everything that's buffered
+        reader = LineReader()
         while self.connected:
             try:
-                data = self.port.readline().decode('utf8').rstrip()
-                if len(data):
+                for data in reader.feed(self.port.read(self.port.in_waiting or 1)):
                     #print(data)
-                    dispatch(data)
+                    self.dispatch(data)
             except OSError:
                 reconnect()
-            except UnicodeDecodeError:
-                # dodgy client output or datastream corruption
-                self.port.reset_input_buffer()
+                reader.clear()
+
+    def dispatch(self, data):
+        # Only the tokens sharing the first two characters of the line can match it
+        candidates = self.token_index.get(data[:2], ()) if self.token_index is not None else \
+                     [ (token, callback) for tokens, callback in self.applications for token in tokens ]
+        for token, callback in candidates:
+            if data.startswith(token):
+                callback((token, data[len(token):]))
+                return
+
+    def write(self, data):
+        self.port.write(data)
 
     def shutdown(self):
         self.connected = False
@@ -128,6 +615,15 @@ class Protocol(object):
 
     def register(self, tokens, callback):
         self.applications.append((tokens, callback))
+        # Index the tokens by their first two characters, keeping the registration order.
+        # A shorter token could match lines of any index entry, then dispatch scans them all.
+        if all(len(token) >= 2 for tokens, _ in self.applications for token in tokens):
+            self.token_index = {}
+            for tokens, callback in self.applications:
+                for token in tokens:
+                    self.token_index.setdefault(token[:2], []).append((token, callback))
+        else:
+            self.token_index = None
 
     def send(self, protocol, packet_type, data = bytearray()):
         self.packet_transit = self.build_packet(protocol, packet_type, data)
@@ -139,24 +635,59 @@ class Protocol(object):
             try:
                 if timeout.timedout():
                     raise ConnectionLost()
+                start = millis()
                 self.transmit_packet(self.packet_transit)
                 self.await_response()
+                if self.packet_status and self.transmit_attempt == 1:
+                    self.link_acknowledged(millis() - start, len(data))
             except ReadTimeout:
-                self.errors += 1
+                self.link_error(True)
                 #print("Packetloss detected..")
         self.packet_transit = None
 
+    def send_stream(self, protocol, packet_type, payloads, progress = None):
+        '''
+        Send a sequence of packets keeping up to window_size of them in flight.
+        See SendWindow for the resend handling.
+
+        progress - Called with the number of packets acknowledged so far.
+                   Returning False stops sending new packets. Packets already
+                   in flight are still completed so the sync stays valid.
+
+        Returns the number of packets acknowledged.
+        '''
+        window = SendWindow(self, protocol, packet_type, payloads, progress)
+        while True:
+            for packet in window.fill():
+                self.transmit_packet(packet)
+
+            if window.idle():
+                return window.acked
+
+            if window.stalled.timedout():
+                raise ConnectionLost()
+
+            if not self.responses.wait(window.timeout.remaining()):
+                resend = window.expired()
+            else:
+                resend = window.response(*self.responses.popleft())
+            for packet in resend:
+                self.transmit_packet(packet)
+
     def await_response(self):
-        timeout = TimeOut(self.response_timeout)
-        while not len(self.responses):
-            time.sleep(0.00001)
-            if timeout.timedout():
+        timeout = TimeOut(self.packet_timeout())
+        handled = False
+        while not handled:
+            if not self.responses.wait(timeout.remaining()):
                 raise ReadTimeout()
 
-        while len(self.responses):
-            token, data = self.responses.popleft()
-            switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error}
-            switch[token](data)
+            while len(self.responses):
+                token, data = self.responses.popleft()
+                if self.ascii_reply(token, data):
+                    continue    # late reply to M28B1, not to this packet
+                switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error}
+                switch[token](data)
+                handled = True
 
     def send_ascii(self, data, send_and_forget = False):
         self.packet_transit = bytearray(data, "utf8") + b'\n'
@@ -168,7 +699,7 @@ class Protocol(object):
             try:
                 if timeout.timedout():
                     return
-                self.port.write(self.packet_transit)
+                self.write(self.packet_transit)
                 if send_and_forget:
                     self.packet_status = 1
                 else:
@@ -181,11 +712,8 @@ class Protocol(object):
         self.packet_transit = None
 
     def await_response_ascii(self):
-        timeout = TimeOut(self.response_timeout)
-        while not len(self.responses):
-            time.sleep(0.00001)
-            if timeout.timedout():
-                raise ReadTimeout()
+        if not self.responses.wait(self.response_timeout):
+            raise ReadTimeout()
         token, data = self.responses.popleft()
         self.packet_status = 1
 
@@ -195,8 +723,9 @@ class Protocol(object):
         return data
 
     def transmit_packet(self, packet):
-        packet = bytearray(packet)
+        if self.telemetry: self.telemetry.sent(packet)
         if (self.simulate_errors > 0 and random.random() > (1.0 - self.simulate_errors)):
+            packet = bytearray(packet)  # don't corrupt the original, it may be resent
             if random.random() > 0.9:
                 #random data drop
                 start = random.randint(0, len(packet))
@@ -207,28 +736,44 @@ class Protocol(object):
                 #random corruption
                 packet = self.corrupt_array(packet)
                 #print("Single byte corruption")
-        self.port.write(packet)
+        self.write(packet)
         self.transmit_attempt += 1
 
-    def build_packet(self, protocol, packet_type, data = bytearray()):
-        PACKET_TOKEN = 0xB5AD
-
-        if len(data) > self.max_block_size:
+    PACKET_TOKEN = 0xB5AD
+    PACKET_OVERHEAD = 10        # 2 byte token, 6 byte header, 2 byte footer
+
+    def packet_buffer_for(self, buffer):
+        # Return the given buffer if it's big enough for a full payload, otherwise a new one
+        size = self.max_block_size + Protocol.PACKET_OVERHEAD
+        return buffer if buffer is not None and len(buffer) >= size else bytearray(size)
+
+    def build_packet(self, protocol, packet_type, data = bytearray(), buffer = None):
+        '''
+        Assemble a packet in place and return a memoryview of it.
+        The packet is written into 'buffer' (default: the reusable packet_buffer),
+        so it stays valid only until the next packet is built in the same buffer.
+        '''
+        size = len(data)
+        if size > self.max_block_size:
             raise PayloadOverflow()
 
-        packet_buffer = bytearray()
+        if buffer is None:
+            buffer = self.packet_buffer = self.packet_buffer_for(self.packet_buffer)
+        packet = memoryview(buffer)
 
-        packet_buffer += self.pack_int8(self.sync)                           # 8bit sync id
-        packet_buffer += self.pack_int4_2(protocol, packet_type)             # 4 bit protocol id, 4 bit packet type
-        packet_buffer += self.pack_int16(len(data))                          # 16bit packet length
-        packet_buffer += self.pack_int16(self.build_checksum(packet_buffer)) # 16bit header checksum
+        struct.pack_into('<HBBH', buffer, 0,
+            Protocol.PACKET_TOKEN,                                  # 16bit start token, not included in checksum
+            self.sync,                                              # 8bit sync id
+            ((protocol & 0xF) << 4) | (packet_type & 0xF),          # 4 bit protocol id, 4 bit packet type
+            size)                                                   # 16bit packet length
+        struct.pack_into('<H', buffer, 6, fletcher16(packet[2:6]))  # 16bit header checksum
 
-        if len(data):
-            packet_buffer += data
-            packet_buffer += self.pack_int16(self.build_checksum(packet_buffer))
+        if not size:
+            return packet[:8]
 
-        packet_buffer =  self.pack_int16(PACKET_TOKEN) + packet_buffer       # 16bit start token, not included in checksum
-        return packet_buffer
+        packet[8:8 + size] = data
+        struct.pack_into('<H', buffer, 8 + size, fletcher16(packet[2:8 + size]))
+        return packet[:size + Protocol.PACKET_OVERHEAD]
 
     # checksum 16 fletchers
     def checksum(self, cs, value):
@@ -236,10 +781,7 @@ class Protocol(object):
         return ((((cs >> 8) + cs_low) % 255) << 8) | cs_low
 
     def build_checksum(self, buffer):
-        cs = 0
-        for b in buffer:
-            cs = self.checksum(cs, b)
-        return cs
+        return fletcher16(buffer)
 
     def pack_int32(self, value):
         return value.to_bytes(4, byteorder='little')
@@ -256,37 +798,66 @@ class Protocol(object):
 
     def connect(self):
         print("Connecting: Switching Marlin to Binary Protocol...")
-        self.send_ascii("M28B1")
+        # Start a new line, packets of an interrupted session may be left in the client's line buffer
+        self.send_ascii("\nM28B1")
         self.send(0, 1)
 
     def disconnect(self):
         self.send(0, 2)
         self.syncronised = False
 
+    def ascii_reply(self, token, data):
+        # An 'ok' without a packet id answers a G-code line, it's only expected before the sync
+        return token == 'ok' and not data.strip() and not self.syncronised
+
     def response_ok(self, data):
         try:
             packet_id = int(data)
         except ValueError:
             return
+        if packet_id == (self.sync - 1) % 256:
+            return  # late or repeated ok for a packet sent again after a timeout
         if packet_id != self.sync:
-            raise SycronisationError()
+            self.out_of_sequence(packet_id)
+            return  # not acknowledged, the packet is sent again
+        self.unexpected_id, self.unexpected_repeats = None, 0
+        self.packet_acknowledged(packet_id)
         self.sync = (self.sync + 1) % 256
         self.packet_status = 1
 
     def response_resend(self, data):
-        packet_id = int(data)
-        self.errors += 1
+        self.link_error()
+        try:
+            packet_id = int(data)
+        except ValueError:
+            return  # garbled on the line, the packet is sent again either way
         if not self.syncronised:
             print("Retrying syncronisation")
         elif packet_id != self.sync:
+            self.out_of_sequence(packet_id, False)
+
+    def out_of_sequence(self, packet_id, counted = True):
+        # An ok/rs for a packet other than the one in transit. Count it as a link error and let
+        # the resend recover, unless the client keeps answering with the same id.
+        if counted: self.link_error()
+        self.unexpected_repeats = self.unexpected_repeats + 1 if packet_id == self.unexpected_id else 1
+        self.unexpected_id = packet_id
+        if self.unexpected_repeats >= Protocol.SYNC_ERROR_REPEATS:
             raise SycronisationError()
 
     def response_stream_sync(self, data):
-        sync, max_block_size, protocol_version = data.split(',')
-        self.sync = int(sync)
-        self.max_block_size = int(max_block_size)
+        try:
+            sync, max_block_size, protocol_version = data.split(',')
+            sync, max_block_size = int(sync), int(max_block_size)
+        except ValueError:
+            return  # garbled, the SYNC packet is sent again
+        self.sync = sync
+        self.max_block_size = max_block_size
         self.block_size = self.max_block_size if self.max_block_size < self.block_size else self.block_size
+        if self.tuner: self.tuner.synced()
+        if self.telemetry: self.telemetry.synced(self.sync)
         self.protocol_version = protocol_version
+        self.unexpected_id, self.unexpected_repeats = None, 0
         self.packet_status = 1
         self.syncronised = True
         print("Connection synced [{0}], binary protocol version {1}, {2} byte payload buffer".format(self.sync, self.protocol_version, self.max_block_size))
@@ -294,6 +865,146 @@ class Protocol(object):
     def response_fatal_error(self, data):
         raise FatalError()
 
+    #
+    # Link quality, feeds the LinkTuner when adaptive and the telemetry when set
+    #
+    def packet_timeout(self):
+        return self.tuner.timeout if self.tuner else self.response_timeout
+
+    def link_acknowledged(self, milliseconds, size):
+        if self.tuner: self.tuner.acknowledged(milliseconds, size)
+
+    def link_error(self, timeout = False):
+        self.errors += 1
+        if self.tuner:
+            if timeout: self.tuner.expired()
+            else: self.tuner.error()
+        if self.telemetry: self.telemetry.error(timeout)
+
+    def packet_acknowledged(self, sync):
+        if self.telemetry: self.telemetry.acknowledged(sync)
+
+    def link_failing(self):
+        # Without a tuner any error aborts the transfer, with one only a persistently failing link does
+        return self.tuner.failing() if self.tuner else self.errors > 0
+
+
+def file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def file_adler32(filename):
+    # Adler-32, as computed by the client for the CHECKSUM packet
+    checksum = 1
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            checksum = zlib.adler32(chunk, checksum)
+    return checksum
+
+class TransferCheckpoint(object):
+    '''
+    Progress record of a resumable transfer, stored as JSON in 'directory' and keyed by the
+    SHA-256 of the source file and the destination filename. It's saved as blocks are
+    acknowledged and removed once the transfer completes, so a leftover checkpoint means
+    the client holds a partial copy of this exact file that can be appended to.
+    '''
+    def __init__(self, directory, filename, dest_filename, digest = None):
+        self.directory = directory
+        self.digest = digest or file_sha256(filename)
+        self.dest_filename = dest_filename
+        key = hashlib.sha256(bytearray(self.digest + ':' + dest_filename, 'utf8')).hexdigest()[:16]
+        self.path = os.path.join(directory, key + '.json')
+        self.offset = 0     # source offset the last (re)start began from
+        self.blocks = 0     # blocks acknowledged since then
+        self.acked = 0      # payload bytes in those blocks
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state['sha256'] != self.digest or state['dest'] != self.dest_filename:
+                return False
+            self.offset, self.blocks, self.acked = state['offset'], state['blocks'], state['acked']
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def save(self, offset, blocks, acked):
+        self.offset, self.blocks, self.acked = offset, blocks, acked
+        os.makedirs(self.directory, exist_ok=True)
+        state = { 'sha256': self.digest, 'dest': self.dest_filename, 'offset': offset, 'blocks': blocks, 'acked': acked }
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+    @staticmethod
+    def pending(directory, filename, digest = None):
+        '''Return the destination filename of an unfinished transfer of 'filename', or None.'''
+        digest = digest or file_sha256(filename)
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+                if state.get('sha256') == digest:
+                    return state.get('dest')
+            except (OSError, ValueError):
+                pass
+        return None
+
+class CompressedArtifactCache(object):
+    '''
+    Heatshrink-compressed copies of source files, stored in 'directory' and keyed by
+    the SHA-256 of the source and the (window, lookahead) parameters, so a file sent
+    to many clients, or sent again, is only compressed once. The oldest artifacts are
+    removed beyond MAX_ARTIFACTS.
+    '''
+    MAX_ARTIFACTS = 16
+    lock = threading.Lock()     # shared, concurrent uploads of a file compress it once
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest, window, lookahead):
+        return os.path.join(self.directory, '{0}-w{1}l{2}.hs'.format(digest[:32], window, lookahead))
+
+    def get(self, digest, window, lookahead):
+        path = self.path(digest, window, lookahead)
+        return path if os.path.isfile(path) else None
+
+    def artifact(self, filename, window, lookahead, digest = None):
+        '''Return the path of the compressed copy of 'filename', compressing it if it isn't cached.'''
+        digest = digest or file_sha256(filename)
+        with CompressedArtifactCache.lock:
+            path = self.get(digest, window, lookahead)
+            if path:
+                os.utime(path)  # recently used, keep it
+                return path
+            path = self.path(digest, window, lookahead)
+            os.makedirs(self.directory, exist_ok=True)
+            with open(filename, 'rb') as source, open(path + '.tmp', 'wb') as f:
+                for data in heatshrink_stream(source, window, lookahead):
+                    f.write(data)
+            os.replace(path + '.tmp', path)
+            self.prune()
+            return path
+
+    def prune(self):
+        artifacts = sorted(glob.glob(os.path.join(self.directory, '*.hs')), key=os.path.getmtime, reverse=True)
+        for path in artifacts[CompressedArtifactCache.MAX_ARTIFACTS:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 class FileTransferProtocol(object):
     protocol_id = 1
@@ -304,10 +1015,20 @@ class FileTransferProtocol(object):
         CLOSE = 2
         WRITE = 3
         ABORT = 4
+        CHECKSUM = 5
+        RENAME = 6
+
+    responses = None
+    resumable = False
+    checksums = False
+    renames = False
+    measured_byte_time = None   # ms per wire byte over the last transfer
+
+    COMPRESSION_SAMPLE = 65536  # bytes encoded to estimate the compression ratio and cost
 
-    responses = deque()
     def __init__(self, protocol, timeout = None):
-        protocol.register(['PFT:success', 'PFT:version:', 'PFT:fail', 'PFT:busy', 'PFT:ioerror', 'PTF:invalid'], self.process_input)
+        self.responses = ResponseQueue()
+        protocol.register(['PFT:success', 'PFT:version:', 'PFT:fail', 'PFT:busy', 'PFT:ioerror', 'PTF:invalid', 'PFT:checksum:'], self.process_input)
         self.protocol = protocol
         self.response_timeout = timeout or protocol.response_timeout
 
@@ -316,34 +1037,63 @@ class FileTransferProtocol(object):
         self.responses.append(data)
 
     def await_response(self, timeout = None):
-        timeout = TimeOut(timeout or self.response_timeout)
-        while not len(self.responses):
-            time.sleep(0.0001)
-            if timeout.timedout():
-                raise ReadTimeout()
+        if not self.responses.wait(timeout or self.response_timeout):
+            raise ReadTimeout()
 
         return self.responses.popleft()
 
     def connect(self):
-        self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.QUERY)
+        # The reply is plain text without a checksum, ask again if it's lost or garbled
+        for attempt in range(3):
+            self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.QUERY)
+            try:
+                token, data = self.await_response()
+            except ReadTimeout:
+                continue
+            if token == 'PFT:version:' and self.process_version(data):
+                return True
+        raise ReadTimeout()
 
-        token, data = self.await_response()
-        if token != 'PFT:version:':
+    def process_version(self, data):
+        try:
+            self.parse_version(data)
+        except ValueError:
+            print("Invalid version reply: {0}".format(data))
             return False
+        print("File Transfer version: {0}, compression: {1}".format(self.version, self.compression['algorithm']))
+        return True
 
+    def parse_version(self, data):
         self.version, _, compression = data.split(':')
+        # 0.2.0 added resumable transfers (OPEN flags 0x2/0x4, 'PFT:success:<size>' reply)
+        # 0.3.0 added the CHECKSUM packet
+        # 0.4.0 added the RENAME packet
+        version = tuple(int(v) for v in self.version.split('.')[:2])
+        self.resumable = version >= (0, 2)
+        self.checksums = version >= (0, 3)
+        self.renames = version >= (0, 4)
         if compression != 'none':
             algorithm, window, lookahead = compression.split(',')
             self.compression = {'algorithm': algorithm, 'window': int(window), 'lookahead': int(lookahead)}
         else:
             self.compression = {'algorithm': 'none'}
 
-        print("File Transfer version: {0}, compression: {1}".format(self.version, self.compression['algorithm']))
-
-    def open(self, filename, compression, dummy):
-        payload =  b'\1' if dummy else b'\0'          # dummy transfer
+    @staticmethod
+    def open_payload(filename, compression, dummy, resumable = False, append = False):
+        flags = 0x1 if dummy else 0                   # dummy transfer
+        if resumable: flags |= 0x2                    # keep the partial file if interrupted
+        if append: flags |= 0x4                       # append to the existing file
+        payload =  bytes([flags])
         payload += b'\1' if compression else b'\0'    # payload compression
         payload += bytearray(filename, 'utf8') + b'\0'# target filename + null terminator
+        return payload
+
+    def open(self, filename, compression, dummy, resumable = False, append = False):
+        '''
+        Open the target file, returning the number of bytes it already holds:
+        non-zero only when appending to a partial file left by a resumable transfer.
+        '''
+        payload = self.open_payload(filename, compression, dummy, resumable, append)
 
         timeout = TimeOut(5000)
         token = None
@@ -353,10 +1103,18 @@ class FileTransferProtocol(object):
                 token, data = self.await_response(1000)
                 if token == 'PFT:success':
                     print(filename,"opened")
-                    return
+                    stored = int(data[1:]) if data.startswith(':') else 0
+                    if self.protocol.telemetry:
+                        self.protocol.telemetry.event('open', file=filename, compression=bool(compression), dummy=bool(dummy), append=append, stored=stored)
+                    return stored
                 elif token == 'PFT:busy':
-                    print("Broken transfer detected, purging")
-                    self.abort()
+                    if resumable:
+                        # Close rather than abort, the partial file may be the one we're resuming
+                        print("Broken transfer detected, closing")
+                        self.close()
+                    else:
+                        print("Broken transfer detected, purging")
+                        self.abort()
                     time.sleep(0.1)
                     self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
                     timeout.reset()
@@ -388,47 +1146,307 @@ class FileTransferProtocol(object):
         if token == 'PFT:success':
             print("Transfer Aborted")
 
-    def copy(self, filename, dest_filename, compression, dummy):
-        self.connect()
+    def checksum(self, filename, timeout = 10000):
+        '''
+        Return (size, Adler-32) of a file on the client, or None if it can't be read.
+        The client reads the whole file, allow for slow media.
+        '''
+        self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.CHECKSUM, bytearray(filename, 'utf8') + b'\0')
+        token, data = self.await_response(timeout)
+        if token != 'PFT:checksum:':
+            return None
+        size, checksum = data.split(':')
+        return int(size), int(checksum)
+
+    def rename(self, filename, new_filename):
+        '''
+        Rename a file on the client, replacing any file with the new name. True on success.
+        '''
+        self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.RENAME, bytearray(filename, 'utf8') + b'\0' + bytearray(new_filename, 'utf8') + b'\0')
+        token, data = self.await_response()
+        if token == 'PFT:success':
+            print("Renamed {0} to {1}".format(filename, new_filename))
+            return True
+        print("Can not rename {0} to {1}".format(filename, new_filename))
+        return False
+
+    def publish(self, filename, dest_filename, final_filename):
+        '''
+        Give 'dest_filename', the uploaded copy of the local 'filename', its final name,
+        only if its size and checksum on the client match. True on success.
+        '''
+        if not self.identical(filename, dest_filename):
+            print("{0} doesn't match {1}, not renamed".format(dest_filename, os.path.basename(filename)))
+            return False
+        return self.rename(dest_filename, final_filename)
+
+    def identical(self, filename, dest_filename):
+        # True if the client already holds a copy of the local file 'filename' as 'dest_filename'
+        remote = self.checksum(dest_filename)
+        return remote is not None and remote == (os.path.getsize(filename), file_adler32(filename))
+
+    def compression_candidates(self):
+        # The (window, lookahead) pairs the client can decode. Its decoder is built with static
+        # parameters, so that's the pair it reports, but the choice below handles any number.
+        if not heatshrink_exists or self.compression['algorithm'] != 'heatshrink':
+            return []
+        return [ (self.compression['window'], self.compression['lookahead']) ]
+
+    def link_byte_time(self):
+        # Milliseconds per byte on the wire, as measured by the last transfer or from the nominal baud rate (8N1)
+        if self.measured_byte_time:
+            return self.measured_byte_time
+        return 10000 / self.protocol.baud if self.protocol.baud else 0
+
+    @staticmethod
+    def estimate_compression(filename, window, lookahead):
+        '''
+        Return the (compressed size, encoding time in ms) expected for the whole file,
+        extrapolated from compressing a sample from its start.
+        '''
+        size = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            sample = f.read(FileTransferProtocol.COMPRESSION_SAMPLE)
+        if not sample:
+            return 0, 0
+        start = millis()
+        compressed = sum(len(data) for data in heatshrink_stream(io.BytesIO(sample), window, lookahead))
+        scale = size / len(sample)
+        return compressed * scale, (millis() - start) * scale
+
+    def choose_compression(self, filename, cache = None, digest = None):
+        '''
+        Pick the compression parameters that get 'filename' across fastest: the bytes
+        saved on the wire must outweigh the host encoding time, none if it's cached.
+        Returns (window, lookahead), or None if it's best sent uncompressed.
+        '''
+        size = os.path.getsize(filename)
+        byte_time = self.link_byte_time()
+        best, best_time = None, size * byte_time
+        for window, lookahead in self.compression_candidates():
+            cached = cache.get(digest or file_sha256(filename), window, lookahead) if cache else None
+            if cached:
+                compressed, encoding = os.path.getsize(cached), 0
+            else:
+                compressed, encoding = self.estimate_compression(filename, window, lookahead)
+            duration = encoding + compressed * byte_time
+            if duration < best_time:
+                best, best_time = (window, lookahead), duration
+        return best
+
+    def stream_blocks(self, source, block_size = None, compression = False):
+        '''
+        Yield payload blocks read from the 'source' file object, compressing on the fly,
+        so memory use stays bounded by the block size whatever the file size.
+        Without a 'block_size' each block follows the protocol's current (adaptive) block size.
+        Uncompressed blocks are views of a reused buffer, valid until the next block is requested.
+        '''
+        def size(): return block_size or self.protocol.block_size
+
+        if not compression:
+            buffer = bytearray(max(size(), self.protocol.max_block_size))
+            view = memoryview(buffer)
+            while True:
+                count = source.readinto(view[:size()])
+                if not count: return
+                yield view[:count]
+
+        pending = bytearray()
+        for data in heatshrink_stream(source, self.compression['window'], self.compression['lookahead']):
+            pending += data
+            while len(pending) >= size():
+                n = size()
+                yield bytes(pending[:n])
+                del pending[:n]
+        if len(pending):
+            yield bytes(pending)
+
+    def slice_blocks(self, data):
+        # Yield views of 'data' sized to the protocol's current block size, without copying
+        view = memoryview(data)
+        start = 0
+        while start < len(data):
+            end = start + self.protocol.block_size
+            yield view[start : end]
+            start = end
+
+    def copy(self, filename, dest_filename, compression, dummy, stream = True, checkpoint_dir = None, cache = None, query = True):
+        '''
+        Copy a file to the client. With 'stream' the file is read, compressed and sent
+        block by block, otherwise it's loaded (and compressed) whole before sending.
+        With 'checkpoint_dir' (and a client supporting it) the transfer is resumable: progress
+        is checkpointed there and a later copy of the same file to the same destination
+        only sends what the client doesn't already have.
+        'compression' is True, False or 'auto' to compress only if it makes the transfer faster.
+        With a CompressedArtifactCache 'cache' the compressed file is stored and reused.
+        'query' asks the client for its version first, a TransferSession only does that once.
+        '''
+        if query: self.connect()
 
         has_heatshrink = heatshrink_exists and self.compression['algorithm'] == 'heatshrink'
+        digest = file_sha256(filename) if cache or checkpoint_dir else None
+        if compression == 'auto':
+            compression = has_heatshrink and self.choose_compression(filename, cache, digest) is not None
+            if has_heatshrink: print("Compression {0}".format("on" if compression else "off, it doesn't pay on this link"))
         if compression and not has_heatshrink:
             hs = '2' if sys.version_info[0] > 2 else ''
             print("Compression not supported by client. Use 'pip install heatshrink%s' to fix." % hs)
             compression = False
 
-        data = open(filename, "rb").read()
-        filesize = len(data)
-
-        self.open(dest_filename, compression, dummy)
-
-        block_size = self.protocol.block_size
-        if compression:
-            data = heatshrink.encode(data, window_sz2=self.compression['window'], lookahead_sz2=self.compression['lookahead'])
-
-        cratio = filesize / len(data)
+        checkpoint = None
+        if checkpoint_dir and not dummy:
+            if self.resumable:
+                checkpoint = TransferCheckpoint(checkpoint_dir, filename, dest_filename, digest)
+            else:
+                print("Resumable transfers not supported by client (version {0})".format(self.version))
+
+        with open(filename, "rb") as source:
+            filesize = os.fstat(source.fileno()).st_size
+
+            offset = 0
+            if checkpoint and checkpoint.load():
+                offset = self.open(dest_filename, compression, dummy, True, True)
+                if offset > filesize:
+                    # Not a prefix of this file after all, start over
+                    print("Stored {0} bytes exceed the source size, restarting".format(offset))
+                    self.close()
+                    offset = self.open(dest_filename, compression, dummy, True, False)
+                elif offset:
+                    print("Resuming at {0} of {1} bytes".format(offset, filesize))
+            else:
+                self.open(dest_filename, compression, dummy, checkpoint is not None)
+
+            # A resumed compressed transfer starts a new stream, the client resets its decoder on open,
+            # so only a transfer from the start can use the cached compressed file
+            artifact = None
+            if compression and cache and not offset:
+                artifact = cache.artifact(filename, self.compression['window'], self.compression['lookahead'], digest)
+
+            source.seek(offset)
+            packed = None
+            if stream and artifact:
+                packed = open(artifact, 'rb')
+                packed_size = os.fstat(packed.fileno()).st_size
+                blocks = self.stream_blocks(packed, None, False)
+                def done(sent): return packed.tell() / packed_size if packed_size else 1
+            elif stream:
+                blocks = self.stream_blocks(source, None, compression)
+                def done(sent): return source.tell() / filesize if filesize else 1
+            else:
+                if artifact:
+                    with open(artifact, 'rb') as f:
+                        data = f.read()
+                else:
+                    data = source.read()
+                    if compression:
+                        data = heatshrink.encode(data, window_sz2=self.compression['window'], lookahead_sz2=self.compression['lookahead'])
+                blocks = self.slice_blocks(data)
+                def done(sent): return (offset + (filesize - offset) * sent / len(data)) / filesize if len(data) else 1
+
+            if checkpoint:
+                checkpoint.save(offset, 0, 0)
+                def acknowledged(count, acked): checkpoint.save(offset, count, acked)
+            else:
+                acknowledged = None
 
-        blocks = math.floor((len(data) + block_size - 1) / block_size)
+            try:
+                result = self.transfer(blocks, done, filesize, compression, offset, acknowledged)
+            except Exception:
+                if checkpoint: print("Transfer interrupted, run it again to resume")
+                raise
+            finally:
+                if packed: packed.close()
+            if checkpoint:
+                if result: checkpoint.remove()
+                else: print("Run the transfer again to resume")
+            return result
+
+    def transfer(self, blocks, done, filesize, compression, offset = 0, acknowledged = None):
+        # Send the payload blocks. done(sent) returns the fraction of the source file sent so far.
+        # 'offset' is where in the source a resumed transfer starts, acknowledged(count, bytes) is
+        # called with the blocks (and payload bytes) the client has confirmed at each progress step.
+        sent = 0
+        ends = []   # payload offset at the end of each block sent, block sizes can vary
         kibs = 0
-        dump_pctg = 0
+        dump_pctg = offset / filesize if filesize else 0
         start_time = millis()
-        for i in range(blocks):
-            start = block_size * i
-            end = start + block_size
-            self.write(data[start:end])
-            kibs = (( (i+1) * block_size) / 1024) / (millis() + 1 - start_time) * 1000
-            if (i / blocks) >= dump_pctg:
-                print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format((i / blocks) * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors), end='')
+        telemetry = self.protocol.telemetry
+        if telemetry: telemetry.begin()
+
+        def acked_bytes(count):
+            return ends[count - 1] if count else 0
+
+        def rate(count):
+            # Payload KiB/s over the blocks acknowledged so far, the last one usually being short
+            return (acked_bytes(count) / 1024) / (millis() + 1 - start_time) * 1000
+
+        def status(end = '', suffix = ''):
+            fraction = done(sent)
+            cratio = (filesize * fraction - offset) / sent if sent else 1
+            print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}{4}".format(fraction * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors, suffix), end=end)
+
+        def update(count):
+            nonlocal kibs, dump_pctg
+            fraction = done(sent)
+            if dump_pctg <= fraction < 1:
+                kibs = rate(count)
+                status()
                 dump_pctg += 0.1
-            if self.protocol.errors > 0:
-                # Dump last status (errors may not be visible)
-                print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3} - Aborting...".format((i / blocks) * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors), end='')
-                print("")   # New line to break the transfer speed line
-                self.close()
-                print("Transfer aborted due to protocol errors")
-                #raise Exception("Transfer aborted due to protocol errors")
-                return False
-        print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format(100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors)) # no one likes transfers finishing at 99.8%
+                if acknowledged: acknowledged(count, acked_bytes(count))
+
+        def finished(count, result):
+            if telemetry:
+                telemetry.finished(result=result, source_bytes=filesize - offset, offset=offset, compression=bool(compression),
+                                   blocks=count, kibs=rate(count), errors=self.protocol.errors)
+
+        def payloads():
+            nonlocal sent
+            for block in blocks:
+                sent += len(block)
+                ends.append(sent)
+                yield block
+
+        def aborted(count):
+            nonlocal kibs
+            # Dump last status (errors may not be visible)
+            kibs = rate(count)
+            status(suffix=" - Aborting...")
+            print("")   # New line to break the transfer speed line
+            if acknowledged: acknowledged(count, acked_bytes(count))
+            finished(count, False)
+            self.close()
+            print("Transfer aborted due to protocol errors")
+            #raise Exception("Transfer aborted due to protocol errors")
+            return False
+
+        if self.protocol.window_size > 1:
+            # Pipelined transfer, progress is reported as blocks are acknowledged
+            acked = 0
+            def progress(i):
+                nonlocal acked
+                acked = i
+                update(i)
+                return not self.protocol.link_failing()
+
+            count = self.protocol.send_stream(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.WRITE, payloads(), progress)
+            if self.protocol.link_failing():
+                return aborted(acked)
+        else:
+            count = 0
+            for block in payloads():
+                self.write(block)
+                if self.protocol.link_failing():
+                    return aborted(count)
+                count += 1
+                update(count)
+        kibs = rate(count)
+        if count:
+            self.measured_byte_time = (millis() - start_time) / (acked_bytes(count) + count * Protocol.PACKET_OVERHEAD)
+        status(end='\n') # no one likes transfers finishing at 99.8%
+        finished(count, True)
+        if self.protocol.tuner:
+            tuner = self.protocol.tuner
+            print("Link: {0} byte blocks, {1:.0f}ms timeout, {2:.1f}% packet errors".format(self.protocol.block_size, tuner.timeout, tuner.error_ratio * 100))
 
         if not self.close():
             print("Transfer failed")
@@ -437,6 +1455,87 @@ class FileTransferProtocol(object):
         return True
 
 
+class TransferSession(object):
+    '''
+    Several files copied to the client over one binary protocol connection.
+    The client is queried once, and while one file is on the wire the next one
+    is prepared (read and, when compressed, encoded into the compressed
+    artifact cache) on a worker thread, so the link doesn't idle between files.
+
+    session = TransferSession(filetransfer, compression='auto')
+    session.add('job.gcode')
+    session.add('logo.bin', 'assets/logo.bin')
+    ok = session.run()
+    '''
+    def __init__(self, filetransfer, compression = False, dummy = False, cache = None, checkpoint_dir = None):
+        self.filetransfer = filetransfer
+        self.compression = compression
+        self.dummy = dummy
+        self.cache = cache
+        self.checkpoint_dir = checkpoint_dir
+        self.files = []     # (filename, dest_filename)
+        self.results = []   # (filename, dest_filename, bytes, seconds, OK)
+
+    def add(self, filename, dest_filename = None):
+        self.files.append((filename, dest_filename or os.path.basename(filename)))
+
+    def prepare(self, filename):
+        # Decide on the compression of a file and have its compressed copy ready in the cache
+        filetransfer = self.filetransfer
+        compression = self.compression
+        if not compression or not heatshrink_exists or filetransfer.compression['algorithm'] != 'heatshrink':
+            return False
+        if self.dummy:
+            return compression  # nothing is stored, leave it to copy()
+        digest = file_sha256(filename)
+        if compression == 'auto':
+            compression = filetransfer.choose_compression(filename, self.cache, digest) is not None
+        if compression:
+            self.cache.artifact(filename, filetransfer.compression['window'], filetransfer.compression['lookahead'], digest)
+        return compression
+
+    def run(self, query = True):
+        '''Copy the queued files in order, return True if they all made it.'''
+        if not self.files:
+            return True
+
+        start = millis()
+        if query: self.filetransfer.connect()
+        temporary = None
+        if self.cache is None and self.compression:
+            temporary = tempfile.mkdtemp(prefix='marlin-session-')
+            self.cache = CompressedArtifactCache(temporary)
+
+        self.results = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                prepared = executor.submit(self.prepare, self.files[0][0])
+                for index, (filename, dest_filename) in enumerate(self.files):
+                    compression = prepared.result()
+                    if index + 1 < len(self.files):
+                        prepared = executor.submit(self.prepare, self.files[index + 1][0])
+                    print("[{0}/{1}] {2} -> {3}{4}".format(index + 1, len(self.files), filename, dest_filename, ", compressed" if compression else ""))
+                    file_start = millis()
+                    ok = self.filetransfer.copy(filename, dest_filename, compression, self.dummy,
+                                                checkpoint_dir = self.checkpoint_dir, cache = self.cache, query = False)
+                    self.results.append((filename, dest_filename, os.path.getsize(filename), (millis() - file_start) / 1000, ok))
+        finally:
+            if temporary:
+                shutil.rmtree(temporary, ignore_errors=True)
+                self.cache = None
+            self.summary((millis() - start) / 1000)
+        return all(ok for _, _, _, _, ok in self.results) and len(self.results) == len(self.files)
+
+    def summary(self, seconds):
+        sent = sum(size for _, _, size, _, ok in self.results if ok)
+        failed = [ dest_filename for _, dest_filename, _, _, ok in self.results if not ok ]
+        print("Session: {0} of {1} files, {2} bytes in {3:.1f}s, {4:.2f}KiB/s overall".format(
+              len(self.results) - len(failed), len(self.files), sent, seconds, sent / 1024 / seconds if seconds else 0))
+        if failed:
+            print("Failed: " + ", ".join(failed))
+        if len(self.results) < len(self.files):
+            print("Not sent: " + ", ".join(dest_filename for _, dest_filename in self.files[len(self.results):]))
+
 class EchoProtocol(object):
     def __init__(self, protocol):
         protocol.register(['echo:'], self.process_input)
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+#
+# MarlinBinaryProtocolAsync.py
+# asyncio version of MarlinBinaryProtocol, to drive many printers from a single event loop.
+#
+# Uses the same packet format and the same sync/resend handling (SendWindow) as the threaded
+# Protocol. Instead of a receive thread per port, the serial port is watched with
+# loop.add_reader, so this needs a POSIX host (Linux, macOS).
+#
+# Usage: MarlinBinaryProtocolAsync.py [-w WINDOW] [-b BLOCKSIZE] [-c] [--fixed] file [port ...]
+#   Copy 'file' to every port concurrently. Without ports, transfer to emulated printers.
+#
+import asyncio, os, sys, serial
+from collections import deque
+
+import MarlinBinaryProtocol
+from MarlinBinaryProtocol import TimeOut, SendWindow, LineReader, ReadTimeout, ConnectionLost, FileTransferProtocol, millis
+
+class AsyncResponseQueue(object):
+    '''
+    Same interface as ResponseQueue, but waiters are coroutines on the event loop.
+    '''
+    def __init__(self):
+        self.queue = deque()
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def append(self, data):
+        self.queue.append(data)
+        self.ready.set()
+
+    def popleft(self):
+        data = self.queue.popleft()
+        if not len(self.queue): self.ready.clear()
+        return data
+
+    async def wait(self, milliseconds):
+        # Return True if a response is available within the given time
+        if not len(self.queue):
+            try:
+                await asyncio.wait_for(self.ready.wait(), milliseconds / 1000)
+            except asyncio.TimeoutError:
+                pass
+        return len(self.queue) > 0
+
+class AsyncProtocol(MarlinBinaryProtocol.Protocol):
+    '''
+    Must be created from a coroutine running in the event loop that will serve it.
+    '''
+    def __init__(self, device, baud, bsize, simerr, timeout, window = 1, adaptive = True):
+        self.port = serial.Serial(device, baudrate = baud, write_timeout = 0, timeout = 0)
+        self.device = device
+        self.baud = baud
+        self.block_size = int(bsize)
+        self.simulate_errors = max(min(simerr, 1.0), 0.0)
+        self.response_timeout = timeout
+        self.window_size = max(min(int(window), MarlinBinaryProtocol.Protocol.MAX_WINDOW), 1)
+        self.tuner = MarlinBinaryProtocol.LinkTuner(self) if adaptive else None
+        self.applications = []
+        self.responses = AsyncResponseQueue()
+        self.rx = LineReader()
+        self.tx = bytearray()
+
+        self.register(['ok', 'rs', 'ss', 'fe'], self.process_input)
+
+        self.fd = self.port.fileno()
+        os.set_blocking(self.fd, False)
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.fd, self.receive)
+        self.connected = True
+
+    def receive(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # Port closed or device unplugged, senders will time out
+            self.close()
+            return
+
+        for line in self.rx.feed(data):
+            self.dispatch(line)
+
+    def write(self, data):
+        if not self.connected:
+            raise ConnectionLost()
+        if not len(self.tx):
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                written = 0
+            if written == len(data):
+                return
+            data = data[written:]
+            self.loop.add_writer(self.fd, self.flush)
+        self.tx += data
+
+    def flush(self):
+        try:
+            written = os.write(self.fd, self.tx)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            return
+        del self.tx[:written]
+        if not len(self.tx):
+            self.loop.remove_writer(self.fd)
+
+    def close(self):
+        if not self.connected: return
+        self.connected = False
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+
+    async def shutdown(self):
+        timeout = TimeOut(self.response_timeout)
+        while len(self.tx) and self.connected and not timeout.timedout():
+            await asyncio.sleep(0.01)
+        self.close()
+        self.port.close()
+
+    async def send(self, protocol, packet_type, data = bytearray()):
+        self.packet_transit = self.build_packet(protocol, packet_type, data)
+        self.packet_status = 0
+        self.transmit_attempt = 0
+
+        timeout = TimeOut(self.response_timeout * 20)
+        while self.packet_status == 0:
+            try:
+                if timeout.timedout() or not self.connected:
+                    raise ConnectionLost()
+                start = millis()
+                self.transmit_packet(self.packet_transit)
+                await self.await_response()
+                if self.packet_status and self.transmit_attempt == 1:
+                    self.link_acknowledged(millis() - start, len(data))
+            except ReadTimeout:
+                self.link_error(True)
+        self.packet_transit = None
+
+    async def send_stream(self, protocol, packet_type, payloads, progress = None):
+        window = SendWindow(self, protocol, packet_type, payloads, progress)
+        while True:
+            for packet in window.fill():
+                self.transmit_packet(packet)
+
+            if window.idle():
+                return window.acked
+
+            if window.stalled.timedout() or not self.connected:
+                raise ConnectionLost()
+
+            if not await self.responses.wait(window.timeout.remaining()):
+                resend = window.expired()
+            else:
+                resend = window.response(*self.responses.popleft())
+            for packet in resend:
+                self.transmit_packet(packet)
+
+    async def await_response(self):
+        timeout = TimeOut(self.packet_timeout())
+        handled = False
+        while not handled:
+            if not await self.responses.wait(timeout.remaining()):
+                raise ReadTimeout()
+
+            while len(self.responses):
+                token, data = self.responses.popleft()
+                if self.ascii_reply(token, data):
+                    continue    # late reply to M28B1, not to this packet
+                switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error}
+                switch[token](data)
+                handled = True
+
+    async def send_ascii(self, data, send_and_forget = False):
+        self.packet_transit = bytearray(data, "utf8") + b'\n'
+        self.packet_status = 0
+        self.transmit_attempt = 0
+
+        timeout = TimeOut(self.response_timeout * 20)
+        while self.packet_status == 0:
+            try:
+                if timeout.timedout():
+                    return
+                self.write(self.packet_transit)
+                if send_and_forget:
+                    self.packet_status = 1
+                else:
+                    await self.await_response_ascii()
+            except ReadTimeout:
+                self.errors += 1
+            except ConnectionLost:
+                return
+        self.packet_transit = None
+
+    async def await_response_ascii(self):
+        if not await self.responses.wait(self.response_timeout):
+            raise ReadTimeout()
+        token, data = self.responses.popleft()
+        self.packet_status = 1
+
+    async def connect(self):
+        print(self.device, "Connecting: Switching Marlin to Binary Protocol...")
+        # Start a new line, packets of an interrupted session may be left in the client's line buffer
+        await self.send_ascii("\nM28B1")
+        await self.send(0, 1)
+
+    async def disconnect(self):
+        await self.send(0, 2)
+        self.syncronised = False
+
+class AsyncFileTransferProtocol(FileTransferProtocol):
+    def __init__(self, protocol, timeout = None):
+        self.responses = AsyncResponseQueue()
+        protocol.register(['PFT:success', 'PFT:version:', 'PFT:fail', 'PFT:busy', 'PFT:ioerror', 'PTF:invalid', 'PFT:checksum:'], self.process_input)
+        self.protocol = protocol
+        self.response_timeout = timeout or protocol.response_timeout
+
+    async def await_response(self, timeout = None):
+        if not await self.responses.wait(timeout or self.response_timeout):
+            raise ReadTimeout()
+
+        return self.responses.popleft()
+
+    async def connect(self):
+        # The reply is plain text without a checksum, ask again if it's lost or garbled
+        for attempt in range(3):
+            await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.QUERY)
+            try:
+                token, data = await self.await_response()
+            except ReadTimeout:
+                continue
+            if token == 'PFT:version:' and self.process_version(data):
+                return True
+        raise ReadTimeout()
+
+    async def open(self, filename, compression, dummy):
+        payload = self.open_payload(filename, compression, dummy)
+
+        timeout = TimeOut(5000)
+        token = None
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
+        while token != 'PFT:success' and not timeout.timedout():
+            try:
+                token, data = await self.await_response(1000)
+                if token == 'PFT:success':
+                    print(self.protocol.device, filename, "opened")
+                    return
+                elif token == 'PFT:busy':
+                    print(self.protocol.device, "Broken transfer detected, purging")
+                    await self.abort()
+                    await asyncio.sleep(0.1)
+                    await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
+                    timeout.reset()
+                elif token == 'PFT:fail':
+                    raise Exception("Can not open file on client")
+            except ReadTimeout:
+                pass
+        raise ReadTimeout()
+
+    async def write(self, data):
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.WRITE, data)
+
+    async def close(self):
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.CLOSE)
+        token, data = await self.await_response(1000)
+        if token == 'PFT:success':
+            print(self.protocol.device, "File closed")
+            return True
+        elif token == 'PFT:ioerror':
+            print(self.protocol.device, "Client storage device IO error")
+            return False
+        elif token == 'PFT:invalid':
+            print(self.protocol.device, "No open file")
+            return False
+
+    async def abort(self):
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.ABORT)
+        token, data = await self.await_response()
+        if token == 'PFT:success':
+            print(self.protocol.device, "Transfer Aborted")
+
+    async def checksum(self, filename, timeout = 10000):
+        '''
+        Return (size, Adler-32) of a file on the client, or None if it can't be read.
+        '''
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.CHECKSUM, bytearray(filename, 'utf8') + b'\0')
+        token, data = await self.await_response(timeout)
+        if token != 'PFT:checksum:':
+            return None
+        size, checksum = data.split(':')
+        return int(size), int(checksum)
+
+    async def rename(self, filename, new_filename):
+        '''
+        Rename a file on the client, replacing any file with the new name. True on success.
+        '''
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.RENAME, bytearray(filename, 'utf8') + b'\0' + bytearray(new_filename, 'utf8') + b'\0')
+        token, data = await self.await_response()
+        if token == 'PFT:success':
+            print(self.protocol.device, "Renamed {0} to {1}".format(filename, new_filename))
+            return True
+        print(self.protocol.device, "Can not rename {0} to {1}".format(filename, new_filename))
+        return False
+
+    async def publish(self, filename, dest_filename, final_filename):
+        '''
+        Give 'dest_filename' its final name, only if it matches the local 'filename'. True on success.
+        '''
+        if not await self.identical(filename, dest_filename):
+            print(self.protocol.device, "{0} doesn't match {1}, not renamed".format(dest_filename, os.path.basename(filename)))
+            return False
+        return await self.rename(dest_filename, final_filename)
+
+    async def identical(self, filename, dest_filename):
+        # True if the client already holds a copy of the local file 'filename' as 'dest_filename'
+        remote = await self.checksum(dest_filename)
+        return remote is not None and remote == (os.path.getsize(filename), MarlinBinaryProtocol.file_adler32(filename))
+
+    async def copy(self, filename, dest_filename, compression, dummy):
+        await self.connect()
+
+        has_heatshrink = MarlinBinaryProtocol.heatshrink_exists and self.compression['algorithm'] == 'heatshrink'
+        if compression and not has_heatshrink:
+            print(self.protocol.device, "Compression not supported by client. Use 'pip install heatshrink2' to fix.")
+            compression = False
+
+        with open(filename, "rb") as source:
+            filesize = os.fstat(source.fileno()).st_size
+
+            await self.open(dest_filename, compression, dummy)
+
+            def done(sent): return source.tell() / filesize if filesize else 1
+            return await self.transfer(self.stream_blocks(source, None, compression), done, filesize, compression)
+
+    async def transfer(self, blocks, done, filesize, compression, offset = 0, acknowledged = None):
+        # Send the payload blocks, see FileTransferProtocol.transfer for the arguments
+        sent = 0
+        ends = []   # payload offset at the end of each block sent
+        dump_pctg = offset / filesize if filesize else 0
+        start_time = millis()
+
+        def acked_bytes(count):
+            return ends[count - 1] if count else 0
+
+        def payloads():
+            nonlocal sent
+            for block in blocks:
+                sent += len(block)
+                ends.append(sent)
+                yield block
+
+        # One line per 10%, transfers to many printers are interleaved
+        acked = 0
+        def progress(count):
+            nonlocal dump_pctg, acked
+            acked = count
+            fraction = done(sent)
+            if dump_pctg <= fraction < 1:
+                kibs = (acked_bytes(count) / 1024) / (millis() + 1 - start_time) * 1000
+                cratio = (filesize * fraction - offset) / sent if sent else 1
+                print("{0} {1:3.0f}% {2:4.2f}KiB/s {3} Errors: {4}".format(self.protocol.device, fraction * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors))
+                dump_pctg += 0.1
+                if acknowledged: acknowledged(count, acked_bytes(count))
+            return not self.protocol.link_failing()
+
+        await self.protocol.send_stream(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.WRITE, payloads(), progress)
+
+        if self.protocol.link_failing():
+            if acknowledged: acknowledged(acked, acked_bytes(acked))
+            await self.close()
+            print(self.protocol.device, "Transfer aborted due to protocol errors")
+            return False
+
+        if not await self.close():
+            print(self.protocol.device, "Transfer failed")
+            return False
+        print(self.protocol.device, "Transfer complete")
+        return True
+
+async def upload(device, filename, dest_filename, args):
+    protocol = AsyncProtocol(device, args.baud, args.blocksize, 0, args.timeout, args.window, not args.fixed)
+    try:
+        await protocol.connect()
+        filetransfer = AsyncFileTransferProtocol(protocol)
+        ok = await filetransfer.copy(filename, dest_filename, args.compression, False)
+        await protocol.disconnect()
+        return ok
+    finally:
+        await protocol.shutdown()
+
+async def run(args):
+    emulators = []
+    ports = args.ports
+    if not ports:
+        from MarlinBinaryEmulator import BinaryStreamEmulator
+        emulators = [ BinaryStreamEmulator(args.blocksize) for _ in range(args.emulate) ]
+        ports = [ e.device for e in emulators ]
+
+    dest = os.path.basename(args.file)
+    results = await asyncio.gather(*(upload(port, args.file, dest, args) for port in ports), return_exceptions=True)
+
+    expect = open(args.file, 'rb').read()
+    failed = 0
+    for i, (port, result) in enumerate(zip(ports, results)):
+        if emulators and result is True and emulators[i].filetransfer.files.get(dest) != expect:
+            result = 'data mismatch'
+        if result is not True: failed += 1
+        print("{0}: {1}".format(port, 'OK' if result is True else 'FAILED ({0})'.format(result)))
+
+    for e in emulators: e.shutdown()
+    return 1 if failed else 0
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Upload a file to several Marlin printers concurrently')
+    parser.add_argument('file', help='File to upload')
+    parser.add_argument('ports', nargs='*', help='Serial ports (default: emulated printers)')
+    parser.add_argument('-e', '--emulate', type=int, default=4, help='Number of emulated printers without ports')
+    parser.add_argument('-w', '--window', type=int, default=1, help='Packets in flight')
+    parser.add_argument('-b', '--blocksize', type=int, default=512, help='Transfer block size')
+    parser.add_argument('-c', '--compression', action='store_true', help='Compress the transfer with heatshrink')
+    parser.add_argument('-t', '--timeout', type=int, default=1000, help='Response timeout (ms)')
+    parser.add_argument('--fixed', action='store_true', help='Fixed block size and timeout, abort on the first error')
+    parser.add_argument('--baud', type=int, default=250000, help='Baud rate')
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,50 @@
-import argparse, sys, os, time, random, serial
+import argparse, sys, os, re, time, random, serial, glob, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from SCons.Script import DefaultEnvironment
 env = DefaultEnvironment()
 
 import MarlinBinaryProtocol
 
+#--------------#
+# Fleet output #
+#--------------#
+class FleetOutput(object):
+    '''
+    Stand-in for sys.stdout while uploading to several printers at once.
+    Output of each upload thread goes to that port's log file, and the last
+    line it printed is kept as the port's status for the progress display.
+    '''
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.lock = threading.Lock()
+        self.threads = {}   # thread id -> port
+        self.logs = {}      # port -> log file
+        self.status = {}    # port -> last status line
+
+    def attach(self, port, logname):
+        with self.lock:
+            self.threads[threading.get_ident()] = port
+            self.logs[port] = open(logname, 'w')
+            self.status[port] = 'Starting'
+
+    def detach(self):
+        with self.lock:
+            port = self.threads.pop(threading.get_ident(), None)
+            if port in self.logs: self.logs.pop(port).close()
+
+    def write(self, data):
+        port = self.threads.get(threading.get_ident())
+        if port is None:
+            return self.stdout.write(data)
+        self.logs[port].write(data)
+        line = data.replace('\r', '\n').strip().split('\n')[-1].strip()
+        if line: self.status[port] = line
+        return len(data)
+
+    def flush(self):
+        self.stdout.flush()
+
 #-----------------#
 # Upload Callback #
 #-----------------#
@@ -35,108 +76,569 @@ def Upload(source, target, env):
         debugPrint('OK')
         return portName
 
-    #-------------------------#
-    # Simple serial functions #
-    #-------------------------#
-    def _OpenPort():
-        # Open serial port
-        if port.is_open: return
-        debugPrint('Opening upload port...')
-        port.open()
-        port.reset_input_buffer()
-        debugPrint('OK')
-
-    def _ClosePort():
-        # Open serial port
-        if port is None: return
-        if not port.is_open: return
-        debugPrint('Closing upload port...')
-        port.close()
-        debugPrint('OK')
-
-    def _Send(data):
-        debugPrint(f'>> {data}')
-        strdata = bytearray(data, 'utf8') + b'\n'
-        port.write(strdata)
-        time.sleep(0.010)
-
-    def _Recv():
-        clean_responses = []
-        responses = port.readlines()
-        for Resp in responses:
-            # Suppress invalid chars (coming from debug info)
-            try:
-                clean_response = Resp.decode('utf8').rstrip().lstrip()
-                clean_responses.append(clean_response)
-                debugPrint(f'<< {clean_response}')
-            except:
-                pass
-        return clean_responses
+    def _GetUploadPorts(env):
+        # 'custom_upload_ports' lists ports (or glob patterns) to upload to, separated by spaces, commas or newlines
+        Ports = []
+        for Pattern in re.split(r'[\s,]+', env.GetProjectOption('custom_upload_ports', '').strip()):
+            if not Pattern: continue
+            Matches = sorted(glob.glob(Pattern)) if any(c in Pattern for c in '*?[') else [Pattern]
+            if not Matches: print(f"No port matches '{Pattern}'")
+            Ports += [p for p in Matches if p not in Ports]
+        return Ports
+
+    def _GetUploadFiles(env):
+        # 'custom_upload_files' lists extra files (or glob patterns, relative to the project) to copy to the SD card root with the firmware
+        Files = []
+        for Pattern in re.split(r'[\s,]+', env.GetProjectOption('custom_upload_files', '').strip()):
+            if not Pattern: continue
+            Matches = sorted(glob.glob(os.path.join(env.subst('$PROJECT_DIR'), Pattern)))
+            if not Matches: print(f"No file matches '{Pattern}'")
+            Files += [f for f in Matches if os.path.isfile(f) and f not in Files]
+        return Files
 
     #------------------#
-    # SDCard functions #
+    # Option functions #
     #------------------#
-    def _CheckSDCard():
-        debugPrint('Checking SD card...')
-        _Send('M21')
-        Responses = _Recv()
-        if len(Responses) < 1 or not any('SD card ok' in r for r in Responses):
-            raise Exception('Error accessing SD card')
-        debugPrint('SD Card OK')
-        return True
+    def _GetUploadFlag(env, option, default):
+        # A yes/no option: yes/no, true/false, on/off or 1/0, 'default' if not set
+        Value = str(env.GetProjectOption(option, '')).strip().lower()
+        if not Value: return default
+        return Value in ('yes', 'true', 'on', '1')
+
+    #-------------------#
+    # Per-port workflow #
+    #-------------------#
+    def _UploadPort(upload_port):
+        port = None
+        protocol = None
+        filetransfer = None
+        rollback = False
+
+        upload_firmware_target_name = os.path.basename(upload_firmware_source_path)
+                                                        # Target firmware filename
+        upload_checkpoint_dir = os.path.join(upload_checkpoint_root, re.sub(r'[^\w.-]', '_', upload_port))
+                                                        # Resumable upload checkpoints of this port
+        reader = MarlinBinaryProtocol.LineReader()      # Splits the G-code responses into lines
+        lines = deque()                                 # Response lines received, not yet consumed
+
+        #-------------------------#
+        # Simple serial functions #
+        #-------------------------#
+        def _OpenPort():
+            # Open serial port
+            nonlocal port
+            if port is None:
+                port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
+            if port.is_open: return
+            debugPrint('Opening upload port...')
+            port.open()
+            port.reset_input_buffer()
+            reader.clear()
+            lines.clear()
+            debugPrint('OK')
+
+        def _ClosePort():
+            # Open serial port
+            if port is None: return
+            if not port.is_open: return
+            debugPrint('Closing upload port...')
+            port.close()
+            debugPrint('OK')
+
+        def _Send(data):
+            debugPrint(f'>> {data}')
+            strdata = bytearray(data, 'utf8') + b'\n'
+            port.write(strdata)
+            port.flush()
+
+        def _Recv():
+            # Next response line, None if the client stays silent for upload_response_timeout
+            # Lines with invalid chars (coming from debug info) are suppressed by the reader
+            Deadline = time.monotonic() + upload_response_timeout
+            while not lines:
+                if time.monotonic() > Deadline: return None
+                for Line in reader.feed(port.read(port.in_waiting or 1)):
+                    debugPrint(f'<< {Line.strip()}')
+                    lines.append(Line.strip())
+            return lines.popleft()
+
+        def _IsOk(Line):
+            return Line == 'ok' or Line.startswith('ok ')
+
+        def _Command(data):
+            # Send a command and return its response lines, up to its 'ok' (or silence)
+            _Send(data)
+            Responses = []
+            while True:
+                Line = _Recv()
+                if Line is None or _IsOk(Line): return Responses
+                Responses.append(Line)
+
+        #------------------#
+        # SDCard functions #
+        #------------------#
+        def _CheckSDCard():
+            debugPrint('Checking SD card...')
+            Responses = _Command('M21')
+            if not any('SD card ok' in r for r in Responses):
+                raise Exception('Error accessing SD card')
+            debugPrint('SD Card OK')
+            return True
+
+        #----------------#
+        # File functions #
+        #----------------#
+        def _GetFirmwareFiles(UseLongFilenames):
+            # Return the entries of the listing, parsed as they arrive: '[DOS name] [size] ([long name])'
+            debugPrint('Get firmware files...')
+            _Send(f"M20 F{'L' if UseLongFilenames else ''}")
+            Entries = None
+            while True:
+                Line = _Recv()
+                if Line is None:
+                    raise Exception('Error getting firmware files')
+                if Line.startswith('Begin file list'):
+                    Entries = []
+                elif Line.startswith('End file list'):
+                    if Entries is None: raise Exception('Error getting firmware files')
+                elif _IsOk(Line):
+                    if Entries is None: raise Exception('Error getting firmware files')
+                    debugPrint('OK')
+                    return Entries
+                elif Entries is not None:
+                    Entries.append(Line)
+
+        def _FilterFirmwareFiles(FirmwareList, UseLongFilenames):
+            Firmwares = []
+            for FWFile in FirmwareList:
+                # For long filenames take the 3rd column of the firmwares list
+                if UseLongFilenames:
+                    Space = 0
+                    Space = FWFile.find(' ')
+                    if Space >= 0: Space = FWFile.find(' ', Space + 1)
+                    if Space >= 0: FWFile = FWFile[Space + 1:]
+                if not '/' in FWFile and '.BIN' in FWFile.upper():
+                    Firmwares.append(FWFile[:FWFile.upper().index('.BIN') + 4])
+            return Firmwares
+
+        def _RemoveFirmwareFiles(FirmwareFiles):
+            # Delete files with pipelined M30s, returning { file: removed }. Each 'ok' acknowledges the
+            # oldest command in flight. A few go at once, within Marlin's default 128 byte RX buffer.
+            Results = {}
+            Queue = deque(FirmwareFiles)
+            Pending = deque()       # [file, command length, removed] awaiting their 'ok'
+            InFlight = 0
+            while Queue or Pending:
+                while Queue and (not Pending or (len(Pending) < 4 and InFlight + len(Queue[0]) + 6 <= 128)):
+                    FirmwareFile = Queue.popleft()
+                    _Send(f'M30 /{FirmwareFile}')
+                    Pending.append([FirmwareFile, len(FirmwareFile) + 6, False])
+                    InFlight += len(FirmwareFile) + 6
+                Line = _Recv()
+                if Line is None:
+                    break
+                if 'File deleted' in Line:
+                    Pending[0][2] = True
+                elif _IsOk(Line):
+                    FirmwareFile, Length, Removed = Pending.popleft()
+                    Results[FirmwareFile] = Removed
+                    InFlight -= Length
+            # Unanswered commands count as failed
+            for FirmwareFile, _, _ in Pending: Results[FirmwareFile] = False
+            for FirmwareFile in Queue: Results[FirmwareFile] = False
+            return Results
+
+        def _FindIdenticalFirmware(Candidates):
+            # Return the first candidate on the SD card with the size and checksum of the local firmware
+            if not Candidates: return None
+            print('Checking firmware on the SD card...')
+            # Any protocol error just means a normal upload
+            CheckErrors = (MarlinBinaryProtocol.ReadTimeout, MarlinBinaryProtocol.ConnectionLost, MarlinBinaryProtocol.FatalError, MarlinBinaryProtocol.SycronisationError)
+            checker = MarlinBinaryProtocol.Protocol(upload_port, upload_speed, upload_blocksize, 0, int(upload_timeout))
+            try:
+                checker.connect()
+                checkertransfer = MarlinBinaryProtocol.FileTransferProtocol(checker)
+                checkertransfer.connect()
+                if not checkertransfer.checksums:
+                    print('Remote checksums not supported by the firmware (file transfer protocol 0.3+)')
+                    return None
+                for Candidate in Candidates:
+                    if checkertransfer.identical(upload_firmware_source_path, Candidate):
+                        return Candidate
+                return None
+            except CheckErrors:
+                print('Firmware check failed, uploading anyway')
+                return None
+            finally:
+                try:
+                    if checker.syncronised: checker.disconnect()
+                except CheckErrors:
+                    pass
+                checker.shutdown()
+
+        # A resumable upload goes to a name the bootloader ignores, renamed once verified,
+        # so a partial firmware file is never flashed
+        def _Resumable():
+            return upload_resume and not upload_test and filetransfer is not None and filetransfer.resumable and filetransfer.renames
+
+        def _PartialName(FirmwareFile):
+            return os.path.splitext(FirmwareFile)[0] + '.PRT'
+
+        def _RollbackUpload(FirmwareFile):
+            # Called from the error handlers, so it reports problems rather than raising them
+            nonlocal rollback
+            if not rollback: return
+            rollback = False
+            if _Resumable():
+                # The final name was never written, keep the partial file to resume
+                print(f"Keeping '{_PartialName(FirmwareFile)}' to resume the upload")
+                return
+            print(f"Rollback: trying to delete firmware '{FirmwareFile}'...")
+            try:
+                _OpenPort()
+                # Wait for SD card release
+                time.sleep(1)
+                # Remount SD card
+                _CheckSDCard()
+                print(' OK' if _RemoveFirmwareFiles([FirmwareFile])[FirmwareFile] else ' Error!')
+            except Exception as ex:
+                print(f' Error! {ex}')
+            _ClosePort()
 
-    #----------------#
-    # File functions #
-    #----------------#
-    def _GetFirmwareFiles(UseLongFilenames):
-        debugPrint('Get firmware files...')
-        _Send(f"M20 F{'L' if UseLongFilenames else ''}")
-        Responses = _Recv()
-        if len(Responses) < 3 or not any('file list' in r for r in Responses):
-            raise Exception('Error getting firmware files')
-        debugPrint('OK')
-        return Responses
-
-    def _FilterFirmwareFiles(FirmwareList, UseLongFilenames):
-        Firmwares = []
-        for FWFile in FirmwareList:
-            # For long filenames take the 3rd column of the firmwares list
-            if UseLongFilenames:
-                Space = 0
-                Space = FWFile.find(' ')
-                if Space >= 0: Space = FWFile.find(' ', Space + 1)
-                if Space >= 0: FWFile = FWFile[Space + 1:]
-            if not '/' in FWFile and '.BIN' in FWFile.upper():
-                Firmwares.append(FWFile[:FWFile.upper().index('.BIN') + 4])
-        return Firmwares
-
-    def _RemoveFirmwareFile(FirmwareFile):
-        _Send(f'M30 /{FirmwareFile}')
-        Responses = _Recv()
-        Removed = len(Responses) >= 1 and any('File deleted' in r for r in Responses)
-        if not Removed:
-            raise Exception(f"Firmware file '{FirmwareFile}' not removed")
-        return Removed
-
-    def _RollbackUpload(FirmwareFile):
-        if not rollback: return
-        print(f"Rollback: trying to delete firmware '{FirmwareFile}'...")
-        _OpenPort()
-        # Wait for SD card release
-        time.sleep(1)
-        # Remount SD card
-        _CheckSDCard()
-        print(' OK' if _RemoveFirmwareFile(FirmwareFile) else ' Error!')
-        _ClosePort()
+        def _VerifyUpload(FirmwareFile, FirmwareSize):
+            # The uploaded file must be listed on the SD card with the size of the source
+            if not marlin_long_filename_host_support and not re.match(r'^[^.]{1,8}(\.[^.]{1,3})?$', FirmwareFile):
+                print(f"Can't verify '{FirmwareFile}' without LONG_FILENAME_HOST_SUPPORT, skipped")
+                return True
+            debugPrint('Verifying upload...')
+            _OpenPort()
+            _CheckSDCard()
+            for Entry in _GetFirmwareFiles(marlin_long_filename_host_support):
+                # [DOS name] [size] ([long name])
+                Fields = Entry.split(' ', 2)
+                if len(Fields) < 2 or FirmwareFile.upper() not in [f.upper() for f in Fields[:1] + Fields[2:]]:
+                    continue
+                if Fields[1] == str(FirmwareSize):
+                    print(f"Verified '{FirmwareFile}', {FirmwareSize} bytes")
+                    return True
+                print(f"Verify failed: '{FirmwareFile}' is {Fields[1]} bytes, expected {FirmwareSize}")
+                return False
+            print(f"Verify failed: '{FirmwareFile}' not found on SD card")
+            return False
+
+        def _AttachTelemetry(Protocol):
+            # Append the transfer metrics (and packet trace, if enabled) of this port as JSON lines
+            if not upload_telemetry_dir: return
+            os.makedirs(upload_telemetry_dir, exist_ok=True)
+            TelemetryFile = open(os.path.join(upload_telemetry_dir, re.sub(r'[^\w.-]', '_', upload_port) + '.jsonl'), 'a')
+            Protocol.telemetry = MarlinBinaryProtocol.TransferTelemetry(TelemetryFile, upload_trace_packets)
+            Protocol.telemetry.event('upload', port=upload_port, baud=upload_speed, source=upload_firmware_source_path, target=upload_firmware_target_name,
+                                     block_size=upload_blocksize, window=upload_window, adaptive=upload_adaptive, compression=upload_compression)
+
+        def _DetachTelemetry(Protocol):
+            if Protocol.telemetry:
+                Protocol.telemetry.output.close()
+                Protocol.telemetry = None
+
+        try:
+
+            # Start upload job
+            print(f"Uploading firmware '{os.path.basename(upload_firmware_target_name)}' to '{marlin_motherboard}' via '{upload_port}'")
+
+            # Dump some debug info
+            if Debug:
+                print('Upload using:')
+                print('---- Marlin -----------------------------------')
+                print(f' PIOENV                      : {marlin_pioenv}')
+                print(f' SHORT_BUILD_VERSION         : {marlin_short_build_version}')
+                print(f' STRING_CONFIG_H_AUTHOR      : {marlin_string_config_h_author}')
+                print(f' MOTHERBOARD                 : {marlin_motherboard}')
+                print(f' BOARD_INFO_NAME             : {marlin_board_info_name}')
+                print(f' CUSTOM_BUILD_FLAGS          : {marlin_board_custom_build_flags}')
+                print(f' FIRMWARE_BIN                : {marlin_firmware_bin}')
+                print(f' LONG_FILENAME_HOST_SUPPORT  : {marlin_long_filename_host_support}')
+                print(f' LONG_FILENAME_WRITE_SUPPORT : {marlin_longname_write}')
+                print(f' CUSTOM_FIRMWARE_UPLOAD      : {marlin_custom_firmware_upload}')
+                print('---- Upload parameters ------------------------')
+                print(f' Source                      : {upload_firmware_source_path}')
+                print(f' Target                      : {upload_firmware_target_name}')
+                print(f' Port                        : {upload_port} @ {upload_speed} baudrate')
+                print(f' Timeout                     : {upload_timeout}')
+                print(f' Block size                  : {upload_blocksize}')
+                print(f' Window                      : {upload_window}')
+                print(f' Adaptive                    : {upload_adaptive}')
+                print(f' Compression                 : {upload_compression}')
+                print(f' Error ratio                 : {upload_error_ratio}')
+                print(f' Test                        : {upload_test}')
+                print(f' Reset                       : {upload_reset}')
+                print(f' Resume                      : {upload_resume}')
+                print(f' Verify                      : {upload_verify}')
+                print(f' Skip identical              : {upload_skip_identical}')
+                print(f' Telemetry                   : {upload_telemetry_dir}')
+                print(f' Extra files                 : {len(upload_extra_files)}')
+                print('-----------------------------------------------')
+
+            # An unfinished upload of this same firmware can be resumed
+            upload_resume_name = None
+            if upload_resume and not upload_test:
+                upload_resume_name = MarlinBinaryProtocol.TransferCheckpoint.pending(upload_checkpoint_dir, upload_firmware_source_path)
+
+            # Custom implementations based on board parameters
+            # Generate a new 8.3 random filename (or reuse the one being resumed)
+            if upload_random_filename:
+                if upload_resume_name:
+                    upload_firmware_target_name = os.path.splitext(upload_resume_name)[0] + '.BIN'
+                    print(f"Board {marlin_motherboard}: Resuming upload to '{upload_firmware_target_name}'")
+                else:
+                    upload_firmware_target_name = f"fw-{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=5))}.BIN"
+                    print(f"Board {marlin_motherboard}: Overriding firmware filename to '{upload_firmware_target_name}'")
+
+            # Get all 1st level firmware files on the SD Card (if flagged, to remove)
+            OldFirmwareFiles = []
+            if upload_delete_old_bins:
+                # CUSTOM_FIRMWARE_UPLOAD is needed for this feature
+                if not marlin_custom_firmware_upload:
+                    raise Exception(f"CUSTOM_FIRMWARE_UPLOAD must be enabled in 'Configuration_adv.h' for '{marlin_motherboard}'")
+
+                # Init & Open serial port
+                _OpenPort()
+
+                # Check SD card status
+                _CheckSDCard()
+
+                # Get firmware files
+                FirmwareFiles = _GetFirmwareFiles(marlin_long_filename_host_support)
+                if Debug:
+                    for FirmwareFile in FirmwareFiles:
+                        print(f'Found: {FirmwareFile}')
+
+                OldFirmwareFiles = _FilterFirmwareFiles(FirmwareFiles, marlin_long_filename_host_support)
+
+                # Close serial
+                _ClosePort()
+
+            # Pre-flight: is this exact firmware already on the SD Card? (any old firmware file if the name is random)
+            upload_identical_name = None
+            # (not with extra files, they go with the firmware transfer)
+            if upload_skip_identical and not upload_test and not upload_extra_files:
+                upload_identical_name = _FindIdenticalFirmware(OldFirmwareFiles if upload_random_filename else [upload_firmware_target_name])
+                if upload_identical_name:
+                    upload_firmware_target_name = upload_identical_name
+
+            # Delete all *.bin files on the root of SD Card (if flagged)
+            if upload_delete_old_bins:
+                _OpenPort()
+                _CheckSDCard()
+
+                if len(OldFirmwareFiles) == 0:
+                    print('No old firmware files to delete')
+                else:
+                    print(f"Remove {len(OldFirmwareFiles)} old firmware file{'s' if len(OldFirmwareFiles) != 1 else ''}:")
+                    RemoveFiles = []
+                    for OldFirmwareFile in OldFirmwareFiles:
+                        if upload_identical_name and OldFirmwareFile.upper() == upload_identical_name.upper():
+                            print(f" -Keeping- '{OldFirmwareFile}', identical to the new firmware")
+                        else:
+                            RemoveFiles.append(OldFirmwareFile)
+                    Removed = _RemoveFirmwareFiles(RemoveFiles)
+                    for OldFirmwareFile in RemoveFiles:
+                        print(f" -Removing- '{OldFirmwareFile}'... {'OK' if Removed[OldFirmwareFile] else 'Error!'}")
+                    if not all(Removed.values()):
+                        raise Exception('Old firmware files not removed')
+
+                # Close serial
+                _ClosePort()
+
+                # Cleanup completed
+                debugPrint('Cleanup completed')
+
+            # Identical firmware already on the SD Card, just trigger the update
+            if upload_identical_name:
+                print(f"'{upload_firmware_target_name}' on the SD card is identical to '{os.path.basename(upload_firmware_source_path)}', transfer skipped")
+                if upload_reset:
+                    _OpenPort()
+                    print('Trigger firmware update...')
+                    _Send('M997')
+                    _ClosePort()
+                print('Firmware update completed')
+                return True
+
+            # WARNING! The serial port must be closed here because the serial transfer that follow needs it!
+
+            # Upload firmware file
+            debugPrint(f"Copy '{upload_firmware_source_path}' --> '{upload_firmware_target_name}'")
+            protocol = MarlinBinaryProtocol.Protocol(upload_port, upload_speed, upload_blocksize, float(upload_error_ratio), int(upload_timeout), int(upload_window), upload_adaptive)
+            #echologger = MarlinBinaryProtocol.EchoProtocol(protocol)
+            _AttachTelemetry(protocol)
+            protocol.connect()
+            filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
+            filetransfer.connect()
+            if upload_resume and not upload_test and not _Resumable():
+                print(f'Resumable firmware upload not supported by client (version {filetransfer.version}), file transfer protocol 0.4+ needed')
+            upload_transfer_name = _PartialName(upload_firmware_target_name) if _Resumable() else upload_firmware_target_name
+            upload_transfer_checkpoints = upload_checkpoint_dir if _Resumable() else None
+            # Mark the rollback (delete broken transfer) from this point on
+            rollback = True
+            compressionCache = MarlinBinaryProtocol.CompressedArtifactCache(upload_compression_cache) if upload_compression_cache else None
+            if upload_extra_files:
+                # One session for the firmware and the extra files, preparing each file while the previous one is sent
+                session = MarlinBinaryProtocol.TransferSession(filetransfer, upload_compression, upload_test, compressionCache, upload_transfer_checkpoints)
+                session.add(upload_firmware_source_path, upload_transfer_name)
+                for ExtraFile in upload_extra_files:
+                    session.add(ExtraFile)
+                transferOK = session.run(query=False)
+            else:
+                transferOK = filetransfer.copy(upload_firmware_source_path, upload_transfer_name, upload_compression, upload_test,
+                                               checkpoint_dir = upload_transfer_checkpoints, cache = compressionCache, query = False)
+            # Only a complete, verified firmware gets the name the bootloader looks for
+            if transferOK and upload_transfer_name != upload_firmware_target_name:
+                transferOK = filetransfer.publish(upload_firmware_source_path, upload_transfer_name, upload_firmware_target_name)
+            protocol.disconnect()
+            _DetachTelemetry(protocol)
+
+            # Notify upload completed
+            protocol.send_ascii('M117 Firmware uploaded' if transferOK else 'M117 Firmware upload failed')
+
+            # Remount SD card
+            print('Wait for SD card release...')
+            time.sleep(1)
+            print('Remount SD card')
+            protocol.send_ascii('M21')
+
+            # Transfer failed?
+            if not transferOK:
+                protocol.shutdown()
+                protocol = None
+                _RollbackUpload(upload_firmware_target_name)
+            elif upload_verify and not upload_test:
+                # Check the file on the SD card before triggering the update
+                protocol.shutdown()
+                protocol = None
+                transferOK = _VerifyUpload(upload_firmware_target_name, os.path.getsize(upload_firmware_source_path))
+                if not transferOK:
+                    print(f"Removing unverified firmware '{upload_firmware_target_name}'...")
+                    print(' OK' if _RemoveFirmwareFiles([upload_firmware_target_name])[upload_firmware_target_name] else ' Error!')
+                elif upload_reset:
+                    print('Trigger firmware update...')
+                    _Send('M997')
+                _ClosePort()
+            else:
+                # Trigger firmware update
+                if upload_reset:
+                    print('Trigger firmware update...')
+                    protocol.send_ascii('M997', True)
+                protocol.shutdown()
+                protocol = None
+
+            print('Firmware update completed' if transferOK else 'Firmware update failed')
+            return transferOK
+
+        except KeyboardInterrupt:
+            print('Aborted by user')
+            if filetransfer:
+                if _Resumable(): filetransfer.close()
+                else: filetransfer.abort()
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
+            _RollbackUpload(upload_firmware_target_name)
+            _ClosePort()
+            raise
+
+        except serial.SerialException as se:
+            # This exception is raised only for send_ascii data (not for binary transfer)
+            print(f'Serial excepion: {se}, transfer aborted')
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
+            _RollbackUpload(upload_firmware_target_name)
+            _ClosePort()
+            raise Exception(se)
 
+        except MarlinBinaryProtocol.FatalError:
+            print('Too many retries, transfer aborted')
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
+            _RollbackUpload(upload_firmware_target_name)
+            _ClosePort()
+            raise
+
+        except Exception as ex:
+            print(f"\nException: {ex}, transfer aborted")
+            if protocol:
+                protocol.disconnect()
+                protocol.shutdown()
+            _RollbackUpload(upload_firmware_target_name)
+            _ClosePort()
+            print('Firmware not updated')
+            raise
+
+    #-----------------#
+    # Fleet functions #
+    #-----------------#
+    def _UploadFleet(upload_ports):
+        # Upload to every port with a bounded pool of workers, each port logging to its own file
+        output = FleetOutput(sys.stdout)
+        results = {}    # port -> (OK, seconds, error)
+
+        def _Worker(upload_port):
+            output.attach(upload_port, os.path.join(upload_log_dir, re.sub(r'[^\w.-]', '_', upload_port) + '.log'))
+            start = time.time()
+            try:
+                results[upload_port] = (_UploadPort(upload_port), time.time() - start, None)
+            except BaseException as ex:
+                results[upload_port] = (False, time.time() - start, str(ex) or type(ex).__name__)
+            finally:
+                output.detach()
+
+        os.makedirs(upload_log_dir, exist_ok=True)
+        print(f"Uploading firmware to {len(upload_ports)} printers, {upload_jobs} at a time (logs in '{upload_log_dir}')")
+        for upload_port in upload_ports:
+            output.status[upload_port] = 'Waiting'
+
+        sys.stdout = output
+        executor = ThreadPoolExecutor(max_workers=upload_jobs)
+        try:
+            futures = [ executor.submit(_Worker, upload_port) for upload_port in upload_ports ]
+            shown = None
+            while True:
+                running = any(not f.done() for f in futures)
+                # Overall progress, reprinted when a port's status changes
+                snapshot = [ (p, output.status.get(p, '')) for p in upload_ports ]
+                if snapshot != shown:
+                    shown = snapshot
+                    output.stdout.write(f"Fleet progress: {len(results)}/{len(upload_ports)} finished\n")
+                    for upload_port, status in snapshot:
+                        output.stdout.write(f"  {upload_port:24} {status}\n")
+                    output.stdout.flush()
+                if not running: break
+                time.sleep(2)
+        except KeyboardInterrupt:
+            # Uploads already running can't be interrupted safely, they run to completion
+            print('Aborted by user, pending uploads cancelled, waiting for running uploads to finish')
+            for future in futures: future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            sys.stdout = output.stdout
+
+        # Per-port report
+        print('---- Fleet upload report ----------------------')
+        for upload_port in upload_ports:
+            if upload_port not in results:
+                print(f" {upload_port:24} CANCELLED")
+                continue
+            ok, seconds, error = results[upload_port]
+            print(f" {upload_port:24} {'OK    ' if ok else 'FAILED'} {seconds:6.1f}s{'  ' + error if error else ''}")
+        print('-----------------------------------------------')
+        failed = sum(1 for p in upload_ports if not results.get(p, (False,))[0])
+        print(f"{len(upload_ports) - failed} of {len(upload_ports)} printers updated")
+        return failed == 0
 
     #---------------------#
     # Callback Entrypoint #
     #---------------------#
-    port = None
-    protocol = None
-    filetransfer = None
-    rollback = False
 
     # Get Marlin evironment vars
     MarlinEnv = env['MARLIN_FEATURES']
@@ -156,17 +658,37 @@ def Upload(source, target, env):
                                                     # Source firmware filename
     upload_speed = env['UPLOAD_SPEED'] if 'UPLOAD_SPEED' in env else 115200
                                                     # baud rate of serial connection
-    upload_port = _GetUploadPort(env)               # Serial port to use
+    upload_ports = _GetUploadPorts(env)             # Fleet upload: all the ports to update (custom_upload_ports)
+    upload_jobs = int(env.GetProjectOption('custom_upload_jobs', 4))
+                                                    # Fleet upload: printers updated at the same time
+    upload_extra_files = _GetUploadFiles(env)       # Files copied to the SD card along with the firmware (custom_upload_files)
 
     # Set local upload params
-    upload_firmware_target_name = os.path.basename(upload_firmware_source_path)
-                                                    # Target firmware filename
     upload_timeout = 1000                           # Communication timout, lossy/slow connections need higher values
+    upload_response_timeout = 2                     # Seconds of silence before a G-code command (M20/M21/M30) is considered unanswered
     upload_blocksize = 512                          # Transfer block size. 512 = Autodetect
-    upload_compression = True                       # Enable compression
+    upload_window = 1                               # Packets in flight. Values > 1 pipeline the transfer (USB links only)
+    upload_adaptive = True                          # Tune block size and timeout to the link quality, ride out transient errors
+    upload_compression = 'auto' if str(env.GetProjectOption('custom_upload_compression', '')).strip().lower() == 'auto' else \
+                         _GetUploadFlag(env, 'custom_upload_compression', True)
+                                                    # Enable compression: yes, no or 'auto' (only where it speeds up the transfer)
     upload_error_ratio = 0                          # Simulated corruption ratio
     upload_test = False                             # Benchmark the serial link without storing the file
     upload_reset = True                             # Trigger a soft reset for firmware update after the upload
+    upload_verify = _GetUploadFlag(env, 'custom_upload_verify', False)
+                                                    # Check the uploaded file size on the SD card before the reset
+    upload_skip_identical = _GetUploadFlag(env, 'custom_upload_skip_identical', False)
+                                                    # Skip the transfer if the SD card already holds this firmware (file transfer protocol 0.3+)
+    upload_resume = False                           # Keep a failed upload on the media (as *.PRT, renamed once verified) and resume it next time (file transfer protocol 0.4+)
+    upload_checkpoint_root = os.path.join(env["PROJECT_BUILD_DIR"], env["PIOENV"], "upload")
+                                                    # Where resumable upload checkpoints are kept
+    upload_compression_cache = os.path.join(env["PROJECT_BUILD_DIR"], env["PIOENV"], "upload", "compressed") if _GetUploadFlag(env, 'custom_upload_compression_cache', False) else None
+                                                    # Compressed firmware kept for repeated and fleet uploads (custom_upload_compression_cache)
+    upload_log_dir = os.path.join(env["PROJECT_BUILD_DIR"], env["PIOENV"], "upload", "logs")
+                                                    # Fleet upload: per port logs
+    upload_telemetry_dir = os.path.join(env["PROJECT_BUILD_DIR"], env["PIOENV"], "upload", "telemetry") if _GetUploadFlag(env, 'custom_upload_telemetry', False) else None
+                                                    # Transfer metrics appended per port as JSON lines (custom_upload_telemetry)
+    upload_trace_packets = False                    # Also record every packet in the telemetry (send/ack time, retries, wire bytes)
 
     # Set local upload params based on board type to change script behavior
     # "upload_delete_old_bins": delete all *.bin files in the root of SD Card
@@ -191,152 +713,12 @@ def Upload(source, target, env):
                print("Installing 'heatshrink' python module...")
                env.Execute(env.subst("$PYTHONEXE -m pip install heatshrink"))
 
-    try:
-
-        # Start upload job
-        print(f"Uploading firmware '{os.path.basename(upload_firmware_target_name)}' to '{marlin_motherboard}' via '{upload_port}'")
-
-        # Dump some debug info
-        if Debug:
-            print('Upload using:')
-            print('---- Marlin -----------------------------------')
-            print(f' PIOENV                      : {marlin_pioenv}')
-            print(f' SHORT_BUILD_VERSION         : {marlin_short_build_version}')
-            print(f' STRING_CONFIG_H_AUTHOR      : {marlin_string_config_h_author}')
-            print(f' MOTHERBOARD                 : {marlin_motherboard}')
-            print(f' BOARD_INFO_NAME             : {marlin_board_info_name}')
-            print(f' CUSTOM_BUILD_FLAGS          : {marlin_board_custom_build_flags}')
-            print(f' FIRMWARE_BIN                : {marlin_firmware_bin}')
-            print(f' LONG_FILENAME_HOST_SUPPORT  : {marlin_long_filename_host_support}')
-            print(f' LONG_FILENAME_WRITE_SUPPORT : {marlin_longname_write}')
-            print(f' CUSTOM_FIRMWARE_UPLOAD      : {marlin_custom_firmware_upload}')
-            print('---- Upload parameters ------------------------')
-            print(f' Source                      : {upload_firmware_source_path}')
-            print(f' Target                      : {upload_firmware_target_name}')
-            print(f' Port                        : {upload_port} @ {upload_speed} baudrate')
-            print(f' Timeout                     : {upload_timeout}')
-            print(f' Block size                  : {upload_blocksize}')
-            print(f' Compression                 : {upload_compression}')
-            print(f' Error ratio                 : {upload_error_ratio}')
-            print(f' Test                        : {upload_test}')
-            print(f' Reset                       : {upload_reset}')
-            print('-----------------------------------------------')
-
-        # Custom implementations based on board parameters
-        # Generate a new 8.3 random filename
-        if upload_random_filename:
-            upload_firmware_target_name = f"fw-{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=5))}.BIN"
-            print(f"Board {marlin_motherboard}: Overriding firmware filename to '{upload_firmware_target_name}'")
-
-        # Delete all *.bin files on the root of SD Card (if flagged)
-        if upload_delete_old_bins:
-            # CUSTOM_FIRMWARE_UPLOAD is needed for this feature
-            if not marlin_custom_firmware_upload:
-                raise Exception(f"CUSTOM_FIRMWARE_UPLOAD must be enabled in 'Configuration_adv.h' for '{marlin_motherboard}'")
-
-            # Init & Open serial port
-            port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
-            _OpenPort()
-
-            # Check SD card status
-            _CheckSDCard()
-
-            # Get firmware files
-            FirmwareFiles = _GetFirmwareFiles(marlin_long_filename_host_support)
-            if Debug:
-                for FirmwareFile in FirmwareFiles:
-                    print(f'Found: {FirmwareFile}')
+    if len(upload_ports) > 1:
+        return 0 if _UploadFleet(upload_ports) else -1
 
-            # Get all 1st level firmware files (to remove)
-            OldFirmwareFiles = _FilterFirmwareFiles(FirmwareFiles[1:len(FirmwareFiles)-2], marlin_long_filename_host_support)   # Skip header and footers of list
-            if len(OldFirmwareFiles) == 0:
-                print('No old firmware files to delete')
-            else:
-                print(f"Remove {len(OldFirmwareFiles)} old firmware file{'s' if len(OldFirmwareFiles) != 1 else ''}:")
-                for OldFirmwareFile in OldFirmwareFiles:
-                    print(f" -Removing- '{OldFirmwareFile}'...")
-                    print(' OK' if _RemoveFirmwareFile(OldFirmwareFile) else ' Error!')
-
-            # Close serial
-            _ClosePort()
-
-            # Cleanup completed
-            debugPrint('Cleanup completed')
-
-        # WARNING! The serial port must be closed here because the serial transfer that follow needs it!
-
-        # Upload firmware file
-        debugPrint(f"Copy '{upload_firmware_source_path}' --> '{upload_firmware_target_name}'")
-        protocol = MarlinBinaryProtocol.Protocol(upload_port, upload_speed, upload_blocksize, float(upload_error_ratio), int(upload_timeout))
-        #echologger = MarlinBinaryProtocol.EchoProtocol(protocol)
-        protocol.connect()
-        # Mark the rollback (delete broken transfer) from this point on
-        rollback = True
-        filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
-        transferOK = filetransfer.copy(upload_firmware_source_path, upload_firmware_target_name, upload_compression, upload_test)
-        protocol.disconnect()
-
-        # Notify upload completed
-        protocol.send_ascii('M117 Firmware uploaded' if transferOK else 'M117 Firmware upload failed')
-
-        # Remount SD card
-        print('Wait for SD card release...')
-        time.sleep(1)
-        print('Remount SD card')
-        protocol.send_ascii('M21')
-
-        # Transfer failed?
-        if not transferOK:
-            protocol.shutdown()
-            _RollbackUpload(upload_firmware_target_name)
-        else:
-            # Trigger firmware update
-            if upload_reset:
-                print('Trigger firmware update...')
-                protocol.send_ascii('M997', True)
-            protocol.shutdown()
-
-        print('Firmware update completed' if transferOK else 'Firmware update failed')
-        return 0 if transferOK else -1
-
-    except KeyboardInterrupt:
-        print('Aborted by user')
-        if filetransfer: filetransfer.abort()
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        raise
-
-    except serial.SerialException as se:
-        # This exception is raised only for send_ascii data (not for binary transfer)
-        print(f'Serial excepion: {se}, transfer aborted')
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        raise Exception(se)
-
-    except MarlinBinaryProtocol.FatalError:
-        print('Too many retries, transfer aborted')
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        raise
-
-    except Exception as ex:
-        print(f"\nException: {ex}, transfer aborted")
-        if protocol:
-            protocol.disconnect()
-            protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
-        print('Firmware not updated')
-        raise
+    upload_port = upload_ports[0] if upload_ports else _GetUploadPort(env)
+                                                    # Serial port to use
+    return 0 if _UploadPort(upload_port) else -1
 
 # Attach custom upload callback
 env.Replace(UPLOADCMD=Upload)